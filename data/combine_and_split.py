@@ -3,6 +3,10 @@ import json
 import os
 import random
 import copy
+import time
+import argparse
+import multiprocessing
+from functools import partial
 
 
 
@@ -52,6 +56,38 @@ def data_to_turns(data,shuffle=False):
     return ans
 
 
+# 整段对话格式：一个对话只生成一条样本，不再按每个 assistant/search 轮次拆成上下文重复的多条样本
+# 训练时对整段对话中所有 assistant 和 search 轮次计算损失（见 qwen2/data_preprocess.py 中的 PromptEncoder.encode_dialog）
+# 只有包含可训练轮次（前面至少有一轮的 assistant 或 search）的对话才会被保留，与 process_dialog 生成样本的条件一致
+def process_dialog_whole(dialog, data):
+    if any(turn["role"] in ["assistant","search"] for turn in dialog[1:]):
+        data.append({"dialog": json.dumps(dialog,ensure_ascii=False)})
+    return data
+
+
+# 将对话数据集 data 转换为整段对话格式的样本列表
+def data_to_dialogs(data):
+    ans = []
+    for dial in data:
+        process_dialog_whole(dial,ans)
+    return ans
+
+
+# 样本格式：turns 为按轮次拆分的上下文-回复对，dialogs 为整段对话
+SAMPLE_FORMATS = {
+    "turns": process_dialog,
+    "dialogs": process_dialog_whole,
+}
+
+
+# 输出文件名：n 为 None 时带 .full，整段对话格式带 .dialogs，例如 train.full.dialogs.jsonl
+def output_filename(split, n=None, sample_format="turns"):
+    name = split if n is not None else split + ".full"
+    if sample_format == "dialogs":
+        name += ".dialogs"
+    return name + ".jsonl"
+
+
 # 用于判断一个对话中是否包含多次搜索请求
 # dialog：表示对话内容，是一个包含多个对话轮次的列表
 def is_multi_search(dialog):
@@ -173,7 +209,8 @@ def write_jsonl(data,filename):
 # output_dir: 输出文件夹的路径，默认为当前目录 "."
 # ratio: 用于划分验证集和测试集的比例，默认为 0.1
 # n: 限定返回的单轮“search”对话的最大数量，默认为 None
-def main(raw_data_path, more_data_path=None, output_dir=".",ratio=0.1,n=None):
+# sample_format: 样本格式，turns（默认）按轮次拆分，dialogs 每个对话一条样本
+def main(raw_data_path, more_data_path=None, output_dir=".",ratio=0.1,n=None,sample_format="turns"):
     # 检查输出目录是否存在，如果不存在则创建该目录
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -187,24 +224,143 @@ def main(raw_data_path, more_data_path=None, output_dir=".",ratio=0.1,n=None):
         data = process_dir_v2(more_data_path,data)
     # 调用 split_data 函数，按指定的 ratio 将数据拆分为训练集、开发集和测试集
     train_data, dev_data, test_data = split_data(data,ratio)
-    # 将训练集 train_data 转换为对话轮次格式，然后写入 .jsonl 文件
+    # 按样本格式选择转换函数：对话轮次格式或整段对话格式
+    to_samples = data_to_turns if sample_format == "turns" else data_to_dialogs
+    # 将训练集 train_data 转换为样本，然后写入 .jsonl 文件
     # 如果 n 参数为 None（即不限制单轮对话数量），则文件命名为 train.full.jsonl；否则为 train.jsonl
     write_jsonl(
-        data_to_turns(train_data),
-        os.path.join(output_dir,"train.jsonl" if n is not None else "train.full.jsonl")
+        to_samples(train_data),
+        os.path.join(output_dir,output_filename("train",n,sample_format))
     )
-    # 将开发集 dev_data 转换为对话轮次格式，并写入文件
+    # 将开发集 dev_data 转换为样本，并写入文件
     write_jsonl(
-        data_to_turns(dev_data),
-        os.path.join(output_dir,"dev.jsonl" if n is not None else "dev.full.jsonl" )
+        to_samples(dev_data),
+        os.path.join(output_dir,output_filename("dev",n,sample_format))
     )
-    # 将测试集 test_data 转换为对话轮次格式并写入文件
+    # 将测试集 test_data 转换为样本并写入文件
     write_jsonl(
-        data_to_turns(test_data),
-        os.path.join(output_dir,"test.jsonl" if n is not None else "test.full.jsonl")
+        to_samples(test_data),
+        os.path.join(output_dir,output_filename("test",n,sample_format))
     )
 
 
-# 指定原始数据目录 enhanced_hotel_data，额外数据目录 enhanced_more，和 n=None（即不限制 single 数量）
-#main("enhanced_hotel_data",more_data_path="enhanced_more",n=1500)
-main("enhanced_hotel_data",more_data_path="enhanced_more",n=None)
\ No newline at end of file
+# 列出目录下的所有文件路径，顺序与 process_dir / process_dir_v2 中 os.listdir 的顺序一致
+def list_files(dir_path):
+    files = []
+    for filename in os.listdir(dir_path):
+        file_path = os.path.join(dir_path, filename)
+        if os.path.isfile(file_path):
+            files.append(file_path)
+    return files
+
+
+# 进程池 worker：解析一个原始对话文件，只返回分类所需的结果（是否多次搜索），不把对话本身传回主进程
+def _scan_dialog_file(file_path):
+    with open(file_path,'r',encoding="utf-8") as fp:
+        return is_multi_search(json.load(fp))
+
+
+# 进程池 worker：解析一个包含多个对话的文件，返回每个对话在文件中的字节区间 (start, end)
+# 第二遍处理时只需 seek 到对应区间读取单个对话，不必重复解析整个文件
+def _scan_dialog_spans(file_path):
+    with open(file_path,'rb') as fp:
+        raw = fp.read()
+    text = raw.decode("utf-8")
+    decoder = json.JSONDecoder()
+    spans = []
+    # pos 为字符下标，byte_pos 为对应的字节偏移
+    pos = text.index('[') + 1
+    byte_pos = len(text[:pos].encode("utf-8"))
+    while True:
+        # 跳过元素之间的空白和逗号
+        start = pos
+        while text[pos] in ' \t\r\n,':
+            pos += 1
+        byte_pos += pos - start
+        if text[pos] == ']':
+            break
+        _, end = decoder.raw_decode(text, pos)
+        byte_end = byte_pos + len(text[pos:end].encode("utf-8"))
+        spans.append((byte_pos, byte_end))
+        pos, byte_pos = end, byte_end
+    return spans
+
+
+# 进程池 worker：读取 ref 指向的一个对话，按样本格式转换（默认调用 process_dialog 拆成单轮样本），并直接序列化成 jsonl 行
+# ref：(文件路径, 字节区间)，字节区间为 None 表示整个文件就是一个对话
+def _dialog_to_lines(ref, sample_format="turns"):
+    file_path, span = ref
+    if span is None:
+        with open(file_path,'r',encoding="utf-8") as fp:
+            dialog = json.load(fp)
+    else:
+        with open(file_path,'rb') as fp:
+            fp.seek(span[0])
+            dialog = json.loads(fp.read(span[1]-span[0]).decode("utf-8"))
+    return [json.dumps(example,ensure_ascii=False)+"\n" for example in SAMPLE_FORMATS[sample_format](dialog,[])]
+
+
+# 并行、流式版本的 main：与 main 使用相同的随机种子时输出逐字节一致
+# 第一遍用进程池解析所有文件，只在主进程中保留每个对话的引用 (文件路径, 字节区间)，并在引用列表上重放 main 中的两次 shuffle
+# （random.shuffle 的结果只取决于列表长度和随机数状态，因此打乱引用与打乱对话本身得到相同的顺序）
+# 第二遍按划分后的顺序把引用分发给进程池，process_dialog 生成的样本直接写入 train/dev/test 文件，内存中同时只保留一个窗口的样本
+# workers：进程数，默认为 CPU 核数
+# seed：随机种子，与模块顶部的 random.seed(42) 对应
+# chunksize：每次分发给 worker 的任务数
+# sample_format：样本格式，与 main 相同
+def build_parallel(raw_data_path, more_data_path=None, output_dir=".", ratio=0.1, n=None, workers=None, seed=42, chunksize=16, sample_format="turns"):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # 使用独立的随机数生成器，不受模块级随机状态被其他调用消耗的影响
+    rng = random.Random(seed)
+    start_time = time.perf_counter()
+    raw_files = list_files(raw_data_path)
+    more_files = list_files(more_data_path) if more_data_path is not None else []
+    turn_count = 0
+    with multiprocessing.Pool(workers) as pool:
+        # 对应 process_dir：按是否多次搜索分类，打乱单次搜索对话并按 n 截断
+        flags = pool.map(_scan_dialog_file, raw_files, chunksize)
+        multi = [(path, None) for path, is_multi in zip(raw_files, flags) if is_multi]
+        single = [(path, None) for path, is_multi in zip(raw_files, flags) if not is_multi]
+        rng.shuffle(single)
+        if n is not None:
+            single = single[:n-len(multi)]
+        refs = multi + single
+        # 对应 process_dir_v2：每个文件中的对话按原顺序追加
+        for path, spans in zip(more_files, pool.map(_scan_dialog_spans, more_files)):
+            refs.extend((path, span) for span in spans)
+        # 对应 split_data
+        rng.shuffle(refs)
+        dev_size = int(len(refs)*ratio)
+        train_size = len(refs)-dev_size-dev_size
+        splits = [
+            (refs[:train_size], output_filename("train",n,sample_format)),
+            (refs[train_size:train_size+dev_size], output_filename("dev",n,sample_format)),
+            (refs[train_size+dev_size:], output_filename("test",n,sample_format)),
+        ]
+        # pool.imap 没有背压，按窗口提交任务，保证主进程中待写入的样本数量有上界
+        window = chunksize * (workers or os.cpu_count() or 1) * 4
+        to_lines = partial(_dialog_to_lines, sample_format=sample_format)
+        for split_refs, filename in splits:
+            with open(os.path.join(output_dir,filename),"w",encoding="utf-8") as fp:
+                for i in range(0, len(split_refs), window):
+                    for lines in pool.imap(to_lines, split_refs[i:i+window], chunksize):
+                        fp.writelines(lines)
+                        turn_count += len(lines)
+    elapsed = time.perf_counter() - start_time
+    file_count = len(raw_files) + len(more_files)
+    print(f"{file_count} files, {len(refs)} dialogs, {turn_count} samples in {elapsed:.2f}s "
+          f"({file_count/elapsed:.1f} files/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="使用 build_parallel 并行构建时的进程数，不指定则使用原来的 main")
+    parser.add_argument("--format", choices=list(SAMPLE_FORMATS), default="turns", help="样本格式：turns 按轮次拆分，dialogs 每个对话一条样本")
+    args = parser.parse_args()
+    # 指定原始数据目录 enhanced_hotel_data，额外数据目录 enhanced_more，和 n=None（即不限制 single 数量）
+    #main("enhanced_hotel_data",more_data_path="enhanced_more",n=1500)
+    if args.workers is None:
+        main("enhanced_hotel_data",more_data_path="enhanced_more",n=None,sample_format=args.format)
+    else:
+        build_parallel("enhanced_hotel_data",more_data_path="enhanced_more",n=None,workers=args.workers,sample_format=args.format)
@@ -1,4 +1,13 @@
+import os
 import json
+import time
+import heapq
+import bisect
+import hashlib
+import tempfile
+import random
+import argparse
+from array import array
 
 tools = [{
     "type": "function",
@@ -33,38 +42,207 @@ def write_jsonl(data, filename):
 def is_subset(sub_list, main_list):
     return all(item in main_list for item in sub_list)
 
-def filter_subsets(lst):
+def filter_subsets_bruteforce(lst):
     parsed_contexts = [(item, json.loads(item['context'])) for item in lst]
     return [item for item, context in parsed_contexts if not any(
         is_subset(context, json.loads(main_item['context'])) and item != main_item
         for main_item in lst)]
 
-def convert(input_filename, output_filename):
-    dataset = []
-    lines = filter_subsets(read_jsonl(input_filename))
-    for line in lines:
-        messages = [{"role":"system","content":"","tools":tools}]
+def turn_key(turn):
+    return json.dumps(turn, ensure_ascii=False, sort_keys=True)
+
+def contained_flags(contexts, item_keys):
+    # contexts[i] 为第 i 个样本的轮次集合，只需能按顺序遍历两次；若它的每个轮次都出现在另一个样本 j 中且
+    # item_keys[j] != item_keys[i]，则第 i 个样本被包含。候选的 j 由各轮次的倒排表从短到长求交集得到
+    # 倒排表常驻内存，大小与所有样本的轮次总数成正比
+    postings = {}
+    for i, turns in enumerate(contexts):
+        for key in turns:
+            postings.setdefault(key, set()).add(i)
+    everything = range(len(contexts))
+    flags = []
+    for i, turns in enumerate(contexts):
+        if not turns:
+            candidates = everything
+        else:
+            lists = sorted((postings[key] for key in turns), key=len)
+            candidates = lists[0]
+            for posting in lists[1:]:
+                if len(candidates) <= 1:
+                    break
+                candidates = candidates & posting
+        flags.append(any(item_keys[j] != item_keys[i] for j in candidates))
+    return flags
+
+def filter_subsets(lst):
+    contexts = [set(map(turn_key, json.loads(item['context']))) for item in lst]
+    flags = contained_flags(contexts, lst)
+    return [item for item, contained in zip(lst, flags) if not contained]
+
+def make_synthetic_turns(n_dialogs, turns_per_dialog, seed=0):
+    rng = random.Random(seed)
+    lst = []
+    for d in range(n_dialogs):
         dialog = []
-        dialog.extend(eval(line['context']))
-        dialog.append(eval(line['response']))
-        for turn in dialog:
-            if turn["role"] == "search":
-                content = "search_hotels\n"+json.dumps(turn["arguments"],ensure_ascii=False)
-                messages.append({'role':'assistant','content':content})
-            elif turn["role"] == "return":
-                content = json.dumps(turn["records"], ensure_ascii=False)
-                messages.append({'role':'observation','content':content})
+        for t in range(turns_per_dialog):
+            if t % 2 == 0:
+                dialog.append({"role": "user", "content": f"dialog {d} question {rng.randint(0, 9)}"})
             else:
-                messages.append(turn)
-        dataset.append({"messages":messages})
-        tuples = [(item, len(json.dumps(item,ensure_ascii=False))) for item in dataset]
-        sorted_tuple = sorted(tuples, key=lambda x: x[1])
-        sorted_dataset = [item[0] for item in sorted_tuple]
-        sorted_len = [item[1] for item in sorted_tuple]
-        sorted_dataset = sorted_dataset[:sum(1 for num in sorted_len if num <= 3400)]
-    write_jsonl(sorted_dataset, output_filename)
+                lst.append({
+                    "context": json.dumps(dialog, ensure_ascii=False),
+                    "response": json.dumps({"role": "assistant", "content": f"answer {t}"}, ensure_ascii=False)
+                })
+                dialog.append({"role": "assistant", "content": f"answer {t}"})
+    return lst
+
+def benchmark_filter_subsets(sizes=(250, 500, 1000, 2000, 8000, 32000, 128000), turns_per_dialog=10, max_bruteforce=2000):
+    for size in sizes:
+        lst = make_synthetic_turns(size // (turns_per_dialog // 2), turns_per_dialog)
+        start = time.perf_counter()
+        fast = filter_subsets(lst)
+        fast_time = time.perf_counter() - start
+        line = f"n={len(lst):>6}  indexed={fast_time:8.3f}s"
+        if len(lst) <= max_bruteforce:
+            start = time.perf_counter()
+            slow = filter_subsets_bruteforce(lst)
+            slow_time = time.perf_counter() - start
+            assert slow == fast, "indexed filter_subsets disagrees with brute force"
+            line += f"  bruteforce={slow_time:8.3f}s  speedup={slow_time / fast_time:7.1f}x"
+        print(line)
+
+def content_hash(turn):
+    return int.from_bytes(hashlib.blake2b(turn_key(turn).encode('utf-8'), digest_size=8).digest(), 'little')
+
+# 写入临时文件的每行轮次编号，按行的顺序可以反复遍历，每次从头读回，内存中只保留当前一行
+class SpilledContexts:
+    def __init__(self):
+        self.file = tempfile.TemporaryFile('w+b')
+        self.count = 0
+
+    def append(self, ids):
+        array('q', [len(ids)]).tofile(self.file)
+        array('q', ids).tofile(self.file)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.file.flush()
+        self.file.seek(0)
+        for _ in range(self.count):
+            size = array('q')
+            size.fromfile(self.file, 1)
+            ids = array('q')
+            ids.fromfile(self.file, size[0])
+            yield ids
+
+    def close(self):
+        self.file.close()
+
+# 转换分两遍读取输入文件：第一遍（本函数）找出被其他样本包含的行，第二遍（iter_converted）只转换保留的行
+# 被包含的样本可能出现在包含它的样本之前，所以不能边读边决定，必须先读完整个文件
+# 第一遍不保存样本本身：每行的轮次编号写入临时文件；常驻内存的是
+#   轮次哈希到编号的字典（与不同轮次的个数成正比）、每行一个 8 字节的样本哈希，
+#   以及 contained_flags 中的倒排表（与所有行的轮次总数成正比，是内存占用的主要部分）
+def contained_lines(input_filename):
+    turn_ids = {}
+    contexts = SpilledContexts()
+    item_keys = array('Q')
+    try:
+        with open(input_filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                item = json.loads(line)
+                contexts.append([turn_ids.setdefault(content_hash(turn), len(turn_ids))
+                                 for turn in json.loads(item['context'])])
+                item_keys.append(content_hash(item))
+        del turn_ids
+        return contained_flags(contexts, item_keys)
+    finally:
+        contexts.close()
+
+def convert_sample(item):
+    messages = [{"role":"system","content":"","tools":tools}]
+    dialog = json.loads(item['context'])
+    dialog.append(json.loads(item['response']))
+    for turn in dialog:
+        if turn["role"] == "search":
+            content = "search_hotels\n"+json.dumps(turn["arguments"],ensure_ascii=False)
+            messages.append({'role':'assistant','content':content})
+        elif turn["role"] == "return":
+            content = json.dumps(turn["records"], ensure_ascii=False)
+            messages.append({'role':'observation','content':content})
+        else:
+            messages.append(turn)
+    return {"messages":messages}
+
+def iter_converted(input_filename, max_length=3400):
+    # 第二遍：每个保留的样本只转换、序列化一次，按写出的那一行的长度过滤
+    flags = contained_lines(input_filename)
+    with open(input_filename, 'r', encoding='utf-8') as f:
+        for line, contained in zip(f, flags):
+            if contained:
+                continue
+            json_str = json.dumps(convert_sample(json.loads(line)), ensure_ascii=False)
+            if len(json_str) <= max_length:
+                yield json_str + '\n'
+
+def external_sort(lines, key, run_size=100000):
+    # 稳定的外部排序：每 run_size 行排好序写入一个临时文件，最后逐行归并；长度相同时 heapq.merge 先取前面的文件
+    runs = []
+    buffer = []
+    try:
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) >= run_size:
+                runs.append(_spill_run(sorted(buffer, key=key)))
+                buffer = []
+        if not runs:
+            yield from sorted(buffer, key=key)
+            return
+        if buffer:
+            runs.append(_spill_run(sorted(buffer, key=key)))
+        for run in runs:
+            run.seek(0)
+        yield from heapq.merge(*runs, key=key)
+    finally:
+        for run in runs:
+            run.close()
+
+def _spill_run(lines):
+    run = tempfile.TemporaryFile('w+', encoding='utf-8')
+    run.writelines(lines)
+    return run
+
+def bucket_filename(output_filename, upper):
+    root, ext = os.path.splitext(output_filename)
+    return f"{root}.len{upper}{ext}"
+
+def convert(input_filename, output_filename, max_length=3400, buckets=None, run_size=100000):
+    lines = iter_converted(input_filename, max_length)
+    if buckets is None:
+        # 与把整个数据集按序列化后的长度排序的结果相同
+        with open(output_filename, 'w', encoding='utf-8') as f:
+            f.writelines(external_sort(lines, key=len, run_size=run_size))
+        return
+    # 按长度分桶输出：每个长度上限一个文件，桶内保持输入顺序，不需要排序
+    uppers = sorted(b for b in buckets if b < max_length) + [max_length]
+    files = [open(bucket_filename(output_filename, upper), 'w', encoding='utf-8') for upper in uppers]
+    try:
+        for line in lines:
+            files[bisect.bisect_left(uppers, len(line) - 1)].write(line)
+    finally:
+        for f in files:
+            f.close()
 
 if __name__ == '__main__':
-    convert('train.llama3.jsonl', 'train.glm4.jsonl')
-    convert('dev.llama3.jsonl', 'dev.glm4.jsonl')
-    convert('test.llama3.jsonl', 'test.glm4.jsonl')
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", action="store_true", help="benchmark filter_subsets against the brute-force version")
+    parser.add_argument("--buckets", type=int, nargs="*", default=None, help="write length-bucketed files with these upper bounds instead of one length-sorted file")
+    args = parser.parse_args()
+    if args.bench:
+        benchmark_filter_subsets()
+    else:
+        convert('train.llama3.jsonl', 'train.glm4.jsonl', buckets=args.buckets)
+        convert('dev.llama3.jsonl', 'dev.glm4.jsonl', buckets=args.buckets)
+        convert('test.llama3.jsonl', 'test.glm4.jsonl', buckets=args.buckets)
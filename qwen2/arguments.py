@@ -58,6 +58,16 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "The name of the column in the datasets containing the history of chat."},
     )
+    sample_format: str = field(
+        default="turns",
+        metadata={
+            "help": (
+                "turns: one sample per assistant/search turn (prompt_column/response_column). "
+                "dialogs: one sample per whole dialog read from prompt_column, with loss on every assistant and search turn."
+            ),
+            "choices": ["turns", "dialogs"],
+        },
+    )
     train_file: Optional[str] = field(
         default=None, metadata={"help": "The input training data file (a jsonlines or csv file)."}
     )
@@ -82,6 +92,10 @@ class DataTrainingArguments:
         default=None,
         metadata={"help": "The number of processes to use for the preprocessing."},
     )
+    tokenized_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Where to store the pre-tokenized datasets. Defaults to a .token_cache directory next to each data file."},
+    )
     max_source_length: Optional[int] = field(
         default=2048,
         metadata={
@@ -100,6 +114,24 @@ class DataTrainingArguments:
             )
         },
     )
+    packing: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Pack several samples into each training window of max_source_length + max_target_length tokens, "
+                "with per-sample position ids and a block-diagonal attention mask."
+            )
+        },
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Form training batches by total padded token count instead of per_device_train_batch_size, "
+                "using a length-bucketed sampler capped at this many tokens per batch."
+            )
+        },
+    )
     ignore_pad_token_for_loss: bool = field(
         default=True,
         metadata={
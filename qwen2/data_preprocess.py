@@ -1,4 +1,6 @@
 import json
+import hashlib
+from collections import OrderedDict
 from torch.utils.data import Dataset
 
 
@@ -10,6 +12,7 @@ class InputOutputDataset(Dataset):
         super(InputOutputDataset, self).__init__()
         self.data = data
         self.tokenizer = tokenizer
+        self.encoder = PromptEncoder(tokenizer)
         self.prompt_column = args.prompt_column
         self.response_column = args.response_column
         self.max_source_length = args.max_source_length
@@ -22,22 +25,16 @@ class InputOutputDataset(Dataset):
     # 通过索引访问数据集中的样本
     def __getitem__(self, i):
         item = self.data[i]
-        # add_special_tokens 不在开头加 special_tokens
-        # 调用分词器，对构建的提示文本进行编码
-        context = self.tokenizer(
-            build_prompt(item[self.prompt_column]), 
-            max_length=self.max_source_length, 
-            add_special_tokens=False)
-        response = self.tokenizer(
-            build_response(item[self.response_column]), 
-            max_length=self.max_target_length, 
-            add_special_tokens=False)
+        # 通过 PromptEncoder 按轮次编码上下文和响应，结果与直接对 build_prompt/build_response 的文本分词相同
+        # （不在开头加 special_tokens，并分别截断到 max_source_length 和 max_target_length）
+        context_ids = self.encoder.encode_prompt(item[self.prompt_column], self.max_source_length)
+        response_ids = self.encoder.encode_response(item[self.response_column], self.max_target_length)
         # 将上下文和响应的 input_ids 连接起来，形成一个完整的输入序列
-        input_ids = context["input_ids"] + response["input_ids"]
-        # 将上下文和响应的注意力掩码连接起来，确保模型在计算注意力时能够正确地关注输入序列的相关部分
-        attention_mask = context["attention_mask"] + response["attention_mask"]
+        input_ids = context_ids + response_ids
+        # 注意力掩码全部为 1，模型在计算注意力时关注整个输入序列
+        attention_mask = [1] * len(input_ids)
         # 创建标签数组，标记上下文部分为 -100（表示在计算损失时忽略），而响应部分使用真实的 input_ids
-        labels = [-100] * len(context["input_ids"]) + response["input_ids"]
+        labels = [-100] * len(context_ids) + response_ids
         # 确保输入 ID 和标签的长度一致，如果不一致，将抛出断言错误，提供长度信息以便调试
         assert len(input_ids) == len(labels), f"length mismatch: {len(input_ids)} vs {len(labels)}"
         # 返回一个字典，其中包含编码后的输入 ID、注意力掩码和标签，供模型训练使用
@@ -48,60 +45,161 @@ class InputOutputDataset(Dataset):
         }
 
 
+# 用于构建单个上下文轮次在 <|im_start|> 与 <|im_end|> 之间的文本（角色 + 换行 + 内容）
+def turn_body(turn):
+    # 检查角色是否为用户或助手
+    if turn["role"] in ["user","assistant"]:
+        # 将当前对话的角色和内容以指定格式返回
+        return f'{turn["role"]}\n{turn["content"]}'
+    # 检查角色是否为 search
+    if turn["role"] == "search":
+        # 提取搜索参数对象
+        obj = turn["arguments"]
+        # 过滤掉值为 None 的参数，创建新的字典
+        filtered_obj = {k: v for k, v in obj.items() if v is not None}
+        # 将过滤后的搜索参数转换为格式化的 JSON 字符串
+        return 'search\n' + json.dumps(filtered_obj,indent=4,ensure_ascii=False)
+    # 处理角色为返回（return）的情况，提取记录数据
+    obj = turn["records"]
+    return 'return\n' + json.dumps(obj,indent=4,ensure_ascii=False)
+
+
 # 用于构建提示字符串
 def build_prompt(context):
     # 检查上下文是否为字符串类型，如果是，则将其解析为 JSON 对象
     if isinstance(context,str):
         context = json.loads(context)
-    # 初始化一个空字符串，用于存储构建的提示文本
-    prompt = ''
-    # 遍历上下文中的每个对话轮次
-    for turn in context:
-        # 检查角色是否为用户或助手
-        if turn["role"] in ["user","assistant"]:
-            # 将当前对话的角色和内容以指定格式添加到提示字符串中
-            prompt += f'<|im_start|>{turn["role"]}\n{turn["content"]}<|im_end|>\n'
-        # 处理角色不为用户或助手的情况
-        else:
-            # 检查角色是否为 search
-            if turn["role"] == "search":
-                # 提取搜索参数对象
-                obj = turn["arguments"]
-                # 过滤掉值为 None 的参数，创建新的字典
-                filtered_obj = {k: v for k, v in obj.items() if v is not None}
-                # 添加搜索的开始标记
-                prompt += '<|im_start|>search\n'
-                # 将过滤后的搜索参数转换为格式化的 JSON 字符串，并添加到提示中
-                prompt += json.dumps(filtered_obj,indent=4,ensure_ascii=False)
-            # 处理角色为返回（return）的情况
-            else:
-                # 提取记录数据
-                obj = turn["records"]
-                # 添加返回数据的结束标记，完成这一轮对话的提示构建
-                prompt += '<|im_start|>return\n'
-                prompt += json.dumps(obj,indent=4,ensure_ascii=False)
-            prompt += '<|im_end|>\n'
-    # 返回构建好的完整提示字符串
-    return prompt
+    # 每个对话轮次格式化为 <|im_start|>角色\n内容<|im_end|>\n 后依次拼接
+    return ''.join(f'<|im_start|>{turn_body(turn)}<|im_end|>\n' for turn in context)
 
 
-# 用于构建响应字符串
-def build_response(response):
-    # 检查响应是否为字符串类型，若是则解析为 JSON 对象
-    if isinstance(response,str):
-        response = json.loads(response)
+# 用于构建响应在 <|im_start|> 与 <|im_end|> 之间的文本
+def response_body(response):
     # 判断角色是否为助手
     if response["role"] == "assistant":
-        # 构建助手的响应字符串，格式为
-        return '<|im_start|>assistant\n' + response["content"] + '<|im_end|>'
+        return 'assistant\n' + response["content"]
     # 处理角色不是助手的情况
     else:
         # 提取响应中的参数对象
         obj = response["arguments"]
         # 过滤掉值为 None 的参数，创建新的字典
         filtered_obj = {k: v for k, v in obj.items() if v is not None}
-        # 构建搜索的响应字符串，格式为
-        return '<|im_start|>search\n' + json.dumps(filtered_obj,indent=4,ensure_ascii=False) + '<|im_end|>'
+        return 'search\n' + json.dumps(filtered_obj,indent=4,ensure_ascii=False)
+
+
+# 用于构建响应字符串
+def build_response(response):
+    # 检查响应是否为字符串类型，若是则解析为 JSON 对象
+    if isinstance(response,str):
+        response = json.loads(response)
+    # 构建响应字符串，格式为 <|im_start|>角色\n内容<|im_end|>，末尾没有换行
+    return '<|im_start|>' + response_body(response) + '<|im_end|>'
+
+
+# 按轮次分段编码提示的编码器，输出与 tokenizer(build_prompt(context)) 完全相同的 token ID
+# <|im_start|>、<|im_end|> 是特殊 token，分词器总是在它们的边界处切分文本，
+# 因此每个轮次 <|im_start|>正文<|im_end|>\n 可以单独编码后再拼接。
+# 同一对话拆出的多个样本共享前面的轮次，正文按内容哈希缓存，重复出现的轮次只分词一次
+class PromptEncoder:
+    def __init__(self, tokenizer, max_cache_size=65536):
+        self.tokenizer = tokenizer
+        self.max_cache_size = max_cache_size
+        self._cache = OrderedDict()
+        # 特殊 token 与轮次之间的换行只解析一次
+        self.im_start_id = tokenizer.convert_tokens_to_ids("<|im_start|>")
+        self.im_end_id = tokenizer.convert_tokens_to_ids("<|im_end|>")
+        self.newline_ids = tokenizer("\n", add_special_tokens=False)["input_ids"]
+        # 分段编码的前提是分词器把 <|im_start|>、<|im_end|> 当作特殊 token，构造时用一个样例确认
+        probe = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "hello"}]
+        if self.encode_prompt(probe) != tokenizer(build_prompt(probe), add_special_tokens=False)["input_ids"]:
+            raise ValueError("tokenizer does not split on <|im_start|>/<|im_end|>, segment encoding is not exact")
+
+    # 批量编码多段正文，只有未命中缓存的正文才交给分词器，且一次批量调用完成
+    def _encode_bodies(self, bodies):
+        keys = [hashlib.blake2b(body.encode("utf-8"), digest_size=16).digest() for body in bodies]
+        found = {}
+        missing = {}
+        for key, body in zip(keys, bodies):
+            if key in found or key in missing:
+                continue
+            ids = self._cache.get(key)
+            if ids is None:
+                missing[key] = body
+            else:
+                self._cache.move_to_end(key)
+                found[key] = ids
+        if missing:
+            encoded = self.tokenizer(list(missing.values()), add_special_tokens=False)["input_ids"]
+            for key, ids in zip(missing, encoded):
+                found[key] = ids
+                self._cache[key] = ids
+            while len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+        return [found[key] for key in keys]
+
+    # 按分词器的截断方向截断到 max_length，与 tokenizer(..., max_length=max_length) 的结果一致
+    def _truncate(self, ids, max_length):
+        if max_length is None or len(ids) <= max_length:
+            return ids
+        if self.tokenizer.truncation_side == "left":
+            return ids[len(ids) - max_length:]
+        return ids[:max_length]
+
+    # 批量编码多个上下文，等价于 [tokenizer(build_prompt(c), max_length=max_length)["input_ids"] for c in contexts]
+    def encode_prompts(self, contexts, max_length=None):
+        contexts = [json.loads(context) if isinstance(context, str) else context for context in contexts]
+        bodies = self._encode_bodies([turn_body(turn) for context in contexts for turn in context])
+        results = []
+        pos = 0
+        for context in contexts:
+            ids = []
+            for body in bodies[pos:pos + len(context)]:
+                ids.append(self.im_start_id)
+                ids.extend(body)
+                ids.append(self.im_end_id)
+                ids.extend(self.newline_ids)
+            pos += len(context)
+            results.append(self._truncate(ids, max_length))
+        return results
+
+    def encode_prompt(self, context, max_length=None):
+        return self.encode_prompts([context], max_length)[0]
+
+    # 批量编码多个响应，等价于 [tokenizer(build_response(r), max_length=max_length)["input_ids"] for r in responses]
+    def encode_responses(self, responses, max_length=None):
+        responses = [json.loads(response) if isinstance(response, str) else response for response in responses]
+        bodies = self._encode_bodies([response_body(response) for response in responses])
+        return [self._truncate([self.im_start_id] + body + [self.im_end_id], max_length) for body in bodies]
+
+    def encode_response(self, response, max_length=None):
+        return self.encode_responses([response], max_length)[0]
+
+    # 整段对话编码，返回 (input_ids, labels) 列表，input_ids 与 tokenizer(build_prompt(dialog)) 相同
+    # 除第一轮以外的 assistant、search 轮次的 <|im_start|>正文<|im_end|> 参与损失，与按轮次拆分时的响应 token 完全对应；
+    # user、return 轮次以及轮次之间的换行为 -100。截断到 max_length 时 input_ids 与 labels 一起截断
+    def encode_dialogs(self, dialogs, max_length=None):
+        dialogs = [json.loads(dialog) if isinstance(dialog, str) else dialog for dialog in dialogs]
+        bodies = self._encode_bodies([turn_body(turn) for dialog in dialogs for turn in dialog])
+        results = []
+        pos = 0
+        for dialog in dialogs:
+            input_ids = []
+            labels = []
+            for i, (turn, body) in enumerate(zip(dialog, bodies[pos:pos + len(dialog)])):
+                segment = [self.im_start_id] + body + [self.im_end_id]
+                input_ids.extend(segment)
+                if i > 0 and turn["role"] in ["assistant", "search"]:
+                    labels.extend(segment)
+                else:
+                    labels.extend([-100] * len(segment))
+                input_ids.extend(self.newline_ids)
+                labels.extend([-100] * len(self.newline_ids))
+            pos += len(dialog)
+            results.append((self._truncate(input_ids, max_length), self._truncate(labels, max_length)))
+        return results
+
+    def encode_dialog(self, dialog, max_length=None):
+        return self.encode_dialogs([dialog], max_length)[0]
 
 
 # 接受一个字符串并尝试从中解析出 JSON 对象
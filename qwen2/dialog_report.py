@@ -0,0 +1,108 @@
+import os
+import json
+import torch
+import argparse
+from tqdm import tqdm
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from data_preprocess import PromptEncoder
+
+
+# 读取目录下的对话文件：enhanced_hotel_data 中每个文件是一个对话，enhanced_more 中每个文件是对话列表
+def load_dialogs(data_dir):
+    dialogs = []
+    for filename in sorted(os.listdir(data_dir)):
+        file_path = os.path.join(data_dir, filename)
+        if not os.path.isfile(file_path):
+            continue
+        with open(file_path, "r", encoding="utf-8") as fp:
+            obj = json.load(fp)
+        if obj and isinstance(obj[0], list):
+            dialogs.extend(obj)
+        else:
+            dialogs.append(obj)
+    return dialogs
+
+
+# 按轮次拆分时的样本：与 data/combine_and_split.py 中 process_dialog 的条件相同，返回 (上下文, 回复) 列表
+def exploded_samples(dialog):
+    return [(dialog[:i], turn) for i, turn in enumerate(dialog)
+            if i > 0 and turn["role"] in ["assistant", "search"]]
+
+
+# 统计两种格式下的训练 token 总数（不截断）
+def count_tokens(encoder, dialogs):
+    exploded = 0
+    whole = 0
+    for dialog in tqdm(dialogs, desc="count tokens"):
+        samples = exploded_samples(dialog)
+        if not samples:
+            continue
+        for context, response in samples:
+            exploded += len(encoder.encode_prompt(context)) + len(encoder.encode_response(response))
+        whole += len(encoder.encode_dialog(dialog)[0])
+    return exploded, whole
+
+
+# 一个序列上 labels 中每段连续的非 -100 区间的损失之和，按区间顺序返回
+def span_losses(model, input_ids, labels, device):
+    with torch.no_grad():
+        logits = model(torch.tensor([input_ids], device=device)).logits[0].float()
+    log_probs = torch.log_softmax(logits[:-1], dim=-1)
+    targets = torch.tensor(labels[1:], device=device)
+    token_losses = -log_probs.gather(1, targets.clamp(min=0).unsqueeze(1)).squeeze(1)
+    losses = []
+    pos = 1
+    while pos < len(labels):
+        if labels[pos] == -100:
+            pos += 1
+            continue
+        start = pos
+        while pos < len(labels) and labels[pos] != -100:
+            pos += 1
+        losses.append(token_losses[start - 1:pos - 1].sum().item())
+    return losses
+
+
+# 校验整段对话格式下每个轮次的损失与按轮次拆分的样本损失一致
+def check_turn_losses(model, encoder, dialogs, device):
+    max_diff = 0.0
+    turns = 0
+    for dialog in tqdm(dialogs, desc="check losses"):
+        samples = exploded_samples(dialog)
+        if not samples:
+            continue
+        input_ids, labels = encoder.encode_dialog(dialog)
+        whole = span_losses(model, input_ids, labels, device)
+        exploded = []
+        for context, response in samples:
+            context_ids = encoder.encode_prompt(context)
+            response_ids = encoder.encode_response(response)
+            exploded.extend(span_losses(model, context_ids + response_ids,
+                                        [-100] * len(context_ids) + response_ids, device))
+        assert len(whole) == len(exploded), f"turn count mismatch: {len(whole)} vs {len(exploded)}"
+        for a, b in zip(whole, exploded):
+            max_diff = max(max_diff, abs(a - b) / max(abs(b), 1.0))
+        turns += len(exploded)
+    return turns, max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, required=True, help="tokenizer (or model) path")
+    parser.add_argument("--data_dir", type=str, default="../data/enhanced_hotel_data", help="directory of dialog json files")
+    parser.add_argument("--model", type=str, default=None, help="model used to check per-turn losses; skipped if not given")
+    parser.add_argument("--check_dialogs", type=int, default=20, help="number of dialogs used for the loss check")
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    encoder = PromptEncoder(tokenizer)
+    dialogs = load_dialogs(args.data_dir)
+    exploded, whole = count_tokens(encoder, dialogs)
+    print(f"{len(dialogs)} dialogs: {exploded} training tokens as turns, {whole} as whole dialogs "
+          f"({1 - whole / exploded:.2%} fewer)")
+
+    if args.model is not None:
+        model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).to(args.device).eval()
+        turns, max_diff = check_turn_losses(model, encoder, dialogs[:args.check_dialogs], args.device)
+        print(f"per-turn loss check on {turns} turns: max relative difference {max_diff:.2e}")
@@ -5,4 +5,6 @@ CHECKPOINT_DIR="output/hotel_qwen2-20241103-132703/checkpoint-2150"
 CUDA_VISIBLE_DEVICES=0 python evaluate.py \
   --model $MODEL_DIR \
   --ckpt $CHECKPOINT_DIR \
-  --data ../data/test.jsonl
+  --data ../data/test.jsonl \
+  --batch_size 16 \
+  --cache eval_cache.sqlite
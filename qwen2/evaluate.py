@@ -1,18 +1,20 @@
-
 import json
+import time
 import torch
 import argparse
 from tqdm import tqdm
 from peft import PeftModel
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
-from data_preprocess import build_prompt, parse_json
+from transformers import AutoTokenizer, AutoModelForCausalLM, LogitsProcessorList
+from data_preprocess import PromptEncoder, build_prompt, parse_json
+from metrics import char_bleu4, slot_metrics
+from generation_cache import GenerationCache, model_fingerprint, adapter_fingerprint, prompt_hash
+from kv_cache import PrefixKVCache, group_dialogs
 
 
-def load_model(model_path, checkpoint_path):
+def load_model(model_path, checkpoint_path, device="cuda"):
     tokenizer = AutoTokenizer.from_pretrained(model_path)
     model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.bfloat16)
-    model = PeftModel.from_pretrained(model, model_id=checkpoint_path).to("cuda").eval()
+    model = PeftModel.from_pretrained(model, model_id=checkpoint_path).to(device).eval()
     return tokenizer, model
 
 
@@ -27,78 +29,221 @@ def origin_load_model(model_path):
     return tokenizer, model
 
 class Evaluator:
-    def __init__(self,tokenizer,model,data_path):
+    # batch_size：每次 generate 的提示数，1 即逐条生成
+    # max_new_tokens：按回复角色（assistant/search）设置的最大生成长度，search 轮次只是一段简短的 JSON
+    # cache：GenerationCache，已缓存的提示不再生成；tokenizer 和 model 为 None 时只从缓存重新打分
+    # metric_workers：计算 BLEU 的进程数
+    # prefix_reuse：按对话复用前缀 KV cache，同一对话的样本只 prefill 新增的轮次（逐条生成，忽略 batch_size）
+    # constrained：search 回复按 search_hotels 的 schema 约束解码（json_constraint）
+    def __init__(self,tokenizer,model,data_path,device="cuda",batch_size=1,max_new_tokens=None,cache=None,metric_workers=None,
+                 prefix_reuse=False,constrained=False):
         self.tokenizer = tokenizer
         self.model = model
         self.data_path = data_path
+        self.device = device
+        self.batch_size = batch_size
+        self.max_new_tokens = {"assistant": 1024, "search": 1024}
+        self.max_new_tokens.update(max_new_tokens or {})
+        self.cache = cache
+        self.metric_workers = metric_workers
+        self.prefix_reuse = prefix_reuse
+        self.constrained = constrained
+        # prompt_tokens：提示的 token 数；prefill_tokens：实际输入模型做 prefill 的 token 数（含左侧填充，不含复用的前缀）
+        # search_turns/search_tokens：生成的 search 轮次数及其生成的 token 数（含结尾的 <|im_end|>）
+        self.stats = {"prompt_tokens": 0, "prefill_tokens": 0, "reused_tokens": 0, "seconds": 0.0,
+                      "search_turns": 0, "search_tokens": 0}
+        if tokenizer is not None:
+            self.encoder = PromptEncoder(tokenizer)
+            # 遇到 <|im_end|> 即停止，左侧填充使用 pad token（没有时退化为 eos）
+            self.stop_token_ids = [self.encoder.im_end_id]
+            if tokenizer.eos_token_id is not None and tokenizer.eos_token_id != self.encoder.im_end_id:
+                self.stop_token_ids.append(tokenizer.eos_token_id)
+            self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+            # 词表前缀树和各状态的 token 掩码在所有 generate 调用之间共享；只在约束解码时才导入 json_constraint
+            self.schema_index = None
+            if constrained:
+                from json_constraint import SearchSchemaIndex
+                self.schema_index = SearchSchemaIndex(tokenizer)
 
-    def slot_accuracy(self, pred, label):
-        correct = 0
-        if pred is not None:
-            for k, v in pred.items():
-                if v is None:
-                    continue
-                if label and k in label:
-                    if not isinstance(v,list):
-                        correct += int(v==label[k])
-                    else:
-                        for t in v:
-                            correct += int(t in label[k])
-        pred_slots = sum(len(v) if isinstance(v, list) else 1 for v in pred.values()) if pred else 0
-        true_slots = sum(len(v) if isinstance(v, list) else 1 for v in label.values()) if label else 0
-        return correct, pred_slots, true_slots
-
-    def bleu4(self, pred, label):
-        pred = pred.strip()
-        label = label.strip()
-
-        hypothesis = list(pred)
-        reference = list(label)
-
-        if len(hypothesis) == 0 or len(reference) == 0:
-            return 0
-
-        bleu_score = sentence_bleu([reference], hypothesis, smoothing_function=SmoothingFunction().method3)
-        return bleu_score
+    def load_dataset(self):
+        with open(self.data_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
 
-    def compute_metrics(self):
-        score_dict = { "slot_P": 0.0, "slot_R": 0.0, "slot_F1": 0.0 }
-        bleu_scores = []
-        true_slot_count = 0
-        pred_slot_count = 0
-        correct_slot_count = 0
+    # 每次 generate 使用新的约束处理器（其中保存各行的状态机状态）
+    def logits_processor(self):
+        if self.schema_index is None:
+            return None
+        from json_constraint import SearchJsonLogitsProcessor
+        return LogitsProcessorList([SearchJsonLogitsProcessor(self.schema_index)])
 
-        with open(self.data_path, "r", encoding="utf-8") as f:
-            test_dataset = [json.loads(line) for line in f]
-
-        for item in tqdm(test_dataset):
-            template = build_prompt(item["context"])
-            inputs = self.tokenizer([template], return_tensors="pt").to("cuda")
-            with torch.no_grad():
-                outputs = self.model.generate(**inputs, max_new_tokens=1024)
-                response = self.tokenizer.decode(outputs[:,inputs['input_ids'].shape[1]:][0], skip_special_tokens=True)
+    # 生成的 token 数，到第一个停止 token 为止（含停止 token）
+    def generated_length(self, output_ids):
+        for n, token in enumerate(output_ids, 1):
+            if token in self.stop_token_ids:
+                return n
+        return len(output_ids)
+
+    # 对一批已编码的提示做左侧填充后一起生成，返回解码后的回复和各自生成的 token 数
+    def generate_batch(self, prompts, max_new_tokens):
+        max_length = max(len(ids) for ids in prompts)
+        input_ids = torch.full((len(prompts), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), max_length), dtype=torch.long)
+        for row, ids in enumerate(prompts):
+            input_ids[row, max_length - len(ids):] = torch.tensor(ids)
+            attention_mask[row, max_length - len(ids):] = 1
+        self.stats["prompt_tokens"] += sum(len(ids) for ids in prompts)
+        self.stats["prefill_tokens"] += len(prompts) * max_length
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                max_new_tokens=max_new_tokens,
+                eos_token_id=self.stop_token_ids,
+                pad_token_id=self.pad_token_id,
+                logits_processor=self.logits_processor())
+        outputs = outputs[:, max_length:].tolist()
+        return ([self.tokenizer.decode(output, skip_special_tokens=True) for output in outputs],
+                [self.generated_length(output) for output in outputs])
+
+    # 在已缓存前缀 past（覆盖 ids 的前若干个 token）的基础上生成一条回复，只 prefill 剩下的 token
+    # 返回生成的 token 和新的 KV cache（覆盖提示和除最后一个以外的生成 token）
+    def generate_with_past(self, ids, past, max_new_tokens):
+        reused = past[0][0].shape[2] if past is not None else 0
+        input_ids = torch.tensor([ids], dtype=torch.long, device=self.device)
+        self.stats["prompt_tokens"] += len(ids)
+        self.stats["prefill_tokens"] += len(ids) - reused
+        self.stats["reused_tokens"] += reused
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=tuple(past) if past is not None else None,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=self.stop_token_ids,
+                pad_token_id=self.pad_token_id,
+                logits_processor=self.logits_processor(),
+                return_dict_in_generate=True)
+        past = outputs.past_key_values
+        if hasattr(past, "to_legacy_cache"):
+            past = past.to_legacy_cache()
+        return outputs.sequences[0, len(ids):].tolist(), past
+
+    # 按对话生成：data_to_turns 拆出的样本是同一对话逐渐变长的前缀，用 group_dialogs 分组后按上下文长度依次生成
+    # 每个样本从 PrefixKVCache 中取出与之前样本（提示加生成的回复）最长的公共前缀的 KV cache，只 prefill 其后新增的轮次
+    # 已缓存前缀的长度各不相同，无法合成一个 batch，因此逐条生成
+    def generate_dialogs(self, test_dataset, indices, roles, hashes, responses, progress):
+        indices = set(indices)
+        prefix_cache = PrefixKVCache()
+        for session, dialog in enumerate(group_dialogs(test_dataset)):
+            dialog = [i for i in dialog if i in indices]
+            if not dialog:
+                continue
+            prompts = self.encoder.encode_prompts([test_dataset[i]["context"] for i in dialog])
+            for i, ids in zip(dialog, prompts):
+                _, past = prefix_cache.lookup(session, ids, limit=len(ids) - 1)
+                output_ids, past = self.generate_with_past(ids, past, self.max_new_tokens[roles[i]])
+                prefix_cache.store(session, (ids + output_ids)[:past[0][0].shape[2]], past)
+                responses[i] = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+                self.count_generated(roles[i], [len(output_ids)])
+                if self.cache:
+                    self.cache.put_many([(hashes[i], responses[i])], self.generation_config(roles[i]))
+                progress.update(1)
+            prefix_cache.drop_session(session)
+
+    def count_generated(self, role, lengths):
+        if role == "search":
+            self.stats["search_turns"] += len(lengths)
+            self.stats["search_tokens"] += sum(lengths)
+
+    # 某个角色的生成配置，作为生成缓存键的一部分
+    def generation_config(self, role):
+        config = {"max_new_tokens": self.max_new_tokens[role], "do_sample": False, "stop": ["<|im_end|>"]}
+        if self.constrained:
+            config["constraint"] = "search_hotels"
+        return config
+
+    # 为所有样本生成回复，结果与 test_dataset 一一对应
+    # 按回复角色分组（各自使用自己的生成长度上限），组内按提示的 token 长度排序后切成 batch，使同一 batch 中的填充最少
+    # 配置了缓存时先取出已缓存的回复，只生成剩下的样本，每个 batch 生成后立即写入缓存
+    def generate(self, test_dataset):
+        roles = [json.loads(item["response"])["role"] for item in test_dataset]
+        hashes = [prompt_hash(build_prompt(item["context"])) for item in test_dataset]
+        responses = [None] * len(test_dataset)
+        pending = {}
+        for role in sorted(set(roles)):
+            indices = [i for i, r in enumerate(roles) if r == role]
+            cached = self.cache.get_many({hashes[i] for i in indices}, self.generation_config(role)) if self.cache else {}
+            for i in indices:
+                responses[i] = cached.get(hashes[i])
+            pending[role] = [i for i in indices if responses[i] is None]
+        missing = sum(len(indices) for indices in pending.values())
+        if missing and self.model is None:
+            raise ValueError(f"{missing} of {len(test_dataset)} responses are not cached and no model is loaded")
+        if not missing:
+            return responses
+        begin = time.perf_counter()
+        with tqdm(total=len(test_dataset), initial=len(test_dataset) - missing) as progress:
+            if self.prefix_reuse:
+                self.generate_dialogs(test_dataset, [i for indices in pending.values() for i in indices],
+                                      roles, hashes, responses, progress)
+            else:
+                for role, indices in pending.items():
+                    prompts = dict(zip(indices, self.encoder.encode_prompts([test_dataset[i]["context"] for i in indices])))
+                    indices = sorted(indices, key=lambda i: len(prompts[i]))
+                    for start in range(0, len(indices), self.batch_size):
+                        batch = indices[start:start + self.batch_size]
+                        outputs, lengths = self.generate_batch([prompts[i] for i in batch], self.max_new_tokens[role])
+                        self.count_generated(role, lengths)
+                        for i, response in zip(batch, outputs):
+                            responses[i] = response
+                        if self.cache:
+                            self.cache.put_many([(hashes[i], responses[i]) for i in batch], self.generation_config(role))
+                        progress.update(len(batch))
+        self.stats["seconds"] += time.perf_counter() - begin
+        return responses
+
+    # 对全部回复一次性打分：search 轮次计算槽位 P/R/F1（另给出按槽位分组的 F1）和解析失败或不符合 schema 的比例，
+    # 其余轮次计算字符级 BLEU-4 的平均值
+    def score(self, test_dataset, responses):
+        preds, truths = [], []
+        hypotheses, references = [], []
+        for item, response in zip(test_dataset, responses):
             label = json.loads(item["response"])
             if label["role"] == "search":
                 try:
-                    preds = parse_json(response)
+                    preds.append(parse_json(response))
                 except:
-                    preds = {}
-                truth = label["arguments"]
-                correct, pred_slots, true_slots = self.slot_accuracy(preds, truth)
-                true_slot_count += true_slots
-                pred_slot_count += pred_slots
-                correct_slot_count += correct
+                    preds.append({})
+                truths.append(label["arguments"])
             else:
-                response = response.replace("assistant","")
-                bleu_scores.append(self.bleu4(response, label['content']))
+                hypotheses.append(response.replace("assistant",""))
+                references.append(label['content'])
 
-        score_dict["slot_P"] = float(correct_slot_count/pred_slot_count) if pred_slot_count > 0 else 0
-        score_dict["slot_R"] = float(correct_slot_count/true_slot_count) if true_slot_count > 0 else 0
-        score_dict["slot_F1"] = 2*score_dict["slot_P"]*score_dict["slot_R"]/(score_dict["slot_P"]+score_dict["slot_R"]) if (score_dict["slot_P"]+score_dict["slot_R"]) > 0 else 0
-        score_dict["bleu-4"] = sum(bleu_scores) / len(bleu_scores)
+        (slot_p, slot_r, slot_f1), per_slot = slot_metrics(preds, truths)
+        score_dict = {"slot_P": slot_p, "slot_R": slot_r, "slot_F1": slot_f1}
+        # 解析不出对象，或对象不符合 search_hotels 的 schema（未知的键、值的类型不对、enum 之外的值、数字越界）都算失败
+        from json_constraint import SchemaMachine, search_hotels_schema
+        machine = SchemaMachine(search_hotels_schema())
+        failures = sum(not machine.accepts(pred) for pred in preds)
+        score_dict["search_parse_failure"] = failures / len(preds) if preds else 0.0
+        score_dict["bleu-4"] = float(char_bleu4(hypotheses, references, workers=self.metric_workers).mean())
+        for slot, (_, _, f1) in sorted(per_slot.items()):
+            score_dict[f"slot_F1/{slot}"] = f1
         for k, v in score_dict.items():
             score_dict[k] = round(v * 100, 4)
+        return score_dict
+
+    def compute_metrics(self):
+        test_dataset = self.load_dataset()
+        responses = self.generate(test_dataset)
+        if self.stats["prompt_tokens"]:
+            stats = dict(self.stats)
+            if stats["search_turns"]:
+                stats["search_tokens_per_turn"] = stats["search_tokens"] / stats["search_turns"]
+            print(f"generation stats: {stats}")
+        score_dict = self.score(test_dataset, responses)
         print(f"score dict: {score_dict}")
+        return score_dict
 
 
 if __name__ == "__main__":
@@ -106,8 +251,30 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, default=None, required=True, help="main model weights")
     parser.add_argument("--ckpt", type=str, default=None, required=True, help="The checkpoint path")
     parser.add_argument("--data", type=str, default=None, required=True, help="The dataset file path")
+    parser.add_argument("--device", type=str, default="cuda", help="Device to run generation on, e.g. cuda or cpu")
+    parser.add_argument("--batch_size", type=int, default=1, help="Number of prompts generated together")
+    parser.add_argument("--assistant_max_new_tokens", type=int, default=1024, help="Max new tokens for assistant turns")
+    parser.add_argument("--search_max_new_tokens", type=int, default=256, help="Max new tokens for search turns")
+    parser.add_argument("--cache", type=str, default=None, help="SQLite file caching generations; an interrupted run resumes from it")
+    parser.add_argument("--metric_workers", type=int, default=None, help="Processes used to compute BLEU")
+    parser.add_argument("--prefix_reuse", action="store_true", help="Generate dialog by dialog, prefilling only the turns not shared with earlier samples")
+    parser.add_argument("--constrained", action="store_true", help="Constrain search turns to the search_hotels JSON schema while decoding")
+    parser.add_argument("--rescore", action="store_true", help="Score cached generations only, without loading the model")
     args = parser.parse_args()
 
-    tokenizer, model = load_model(args.model, args.ckpt)
-    evaluator = Evaluator(tokenizer, model, args.data)
+    cache = None
+    if args.cache is not None:
+        cache = GenerationCache(args.cache, model_fingerprint(args.model), adapter_fingerprint(args.ckpt))
+    elif args.rescore:
+        parser.error("--rescore requires --cache")
+    tokenizer, model = (None, None) if args.rescore else load_model(args.model, args.ckpt, args.device)
+    evaluator = Evaluator(
+        tokenizer, model, args.data,
+        device=args.device,
+        batch_size=args.batch_size,
+        max_new_tokens={"assistant": args.assistant_max_new_tokens, "search": args.search_max_new_tokens},
+        cache=cache,
+        metric_workers=args.metric_workers,
+        prefix_reuse=args.prefix_reuse,
+        constrained=args.constrained)
     evaluator.compute_metrics()
@@ -1,5 +1,4 @@
 # 导入所需模块和库，包含用于加载模型、配置低秩适应（LoRA）参数、定义数据预处理等功能
-import json
 import torch
 from transformers import (
     AutoTokenizer, 
@@ -8,11 +7,51 @@ from transformers import (
     DataCollatorForSeq2Seq, 
     HfArgumentParser,
     TrainingArguments, 
-    Trainer
+    Trainer,
+    TrainerCallback
 )
+from torch.utils.data import DataLoader
 from peft import LoraConfig, TaskType, get_peft_model
 from arguments import ModelArguments, DataTrainingArguments, PeftArguments
-from data_preprocess import InputOutputDataset
+from token_cache import load_tokenized_dataset
+from packing import PackedDataset, PackedDataCollator, padding_ratio
+from sampler import TokenBudgetBatchSampler
+
+# 每个 epoch 开始时把 epoch 传给 TokenBudgetBatchSampler
+# 单进程时 accelerate 的 DataLoader 也会转发 set_epoch，但分布式训练时 batch_sampler 被包装成 BatchSamplerShard，不会转发
+# state.epoch 在一个 epoch 结束时恰好是下一个 epoch 的序号，从检查点恢复时取整数部分即当前 epoch
+class SamplerEpochCallback(TrainerCallback):
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        if self.trainer.batch_sampler is not None:
+            self.trainer.batch_sampler.set_epoch(int(state.epoch or 0))
+
+
+# 设置了 max_tokens_per_batch 时，训练集按 token 预算组成大小可变的 batch，而不是固定的 per_device_train_batch_size
+class TokenBudgetTrainer(Trainer):
+    def __init__(self, *args, max_tokens_per_batch=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.batch_sampler = None
+        if max_tokens_per_batch is not None:
+            self.add_callback(SamplerEpochCallback(self))
+
+    def get_train_dataloader(self):
+        if self.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+        batch_sampler = self.batch_sampler = TokenBudgetBatchSampler(
+            self.train_dataset.lengths, self.max_tokens_per_batch, seed=self.args.seed)
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self._get_collator_with_removed_columns(self.data_collator, description="training"),
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(dataloader)
+
 
 def main():
     # 使用 HfArgumentParser 解析命令行参数，并将参数解析成数据类对象：model_args（模型相关）、data_args（数据相关）、peft_args（LoRA参数）、training_args（训练配置）
@@ -20,7 +59,11 @@ def main():
     model_args, data_args, peft_args, training_args = parser.parse_args_into_dataclasses()
 
     # 加载预训练的生成式语言模型 (AutoModelForCausalLM) 和分词器 (AutoTokenizer)。模型加载时设定了数据类型为 torch.bfloat16
-    model = AutoModelForCausalLM.from_pretrained(model_args.model_name_or_path, torch_dtype=torch.bfloat16)
+    # 打包模式需要传入块对角的 4D 注意力掩码，只有 eager 注意力实现支持，其余情况使用默认实现
+    model = AutoModelForCausalLM.from_pretrained(
+        model_args.model_name_or_path,
+        torch_dtype=torch.bfloat16,
+        attn_implementation="eager" if data_args.packing else None)
     tokenizer = AutoTokenizer.from_pretrained(model_args.model_name_or_path)
 
     # 设置LoRA的配置
@@ -45,19 +88,34 @@ def main():
         padding=True
     )
 
-    # 如果启用了 do_train 标志，读取训练数据文件（JSONL 格式）并加载为列表格式，然后通过 InputOutputDataset 类预处理数据
+    # 如果启用了 do_train 标志，加载训练数据文件（JSONL 格式）对应的预分词缓存，缓存不存在时先用 preprocessing_num_workers 个进程一次性分词并写入缓存
+    # 分布式训练时由（每台机器的）主进程先构建缓存，其他进程在 main_process_first 的屏障处等待，之后直接复用，
+    # 设置了 overwrite_cache 时也不再重复重建
+    main_process = training_args.local_process_index == 0
     if training_args.do_train:
-        with open(data_args.train_file, "r", encoding="utf-8") as f:
-            train_data = [json.loads(line) for line in f]
-        train_dataset = InputOutputDataset(train_data, tokenizer, data_args)
-    # 如果启用了 do_eval 标志，类似地读取验证数据文件并加载为验证数据集
+        with training_args.main_process_first(desc="tokenize train dataset"):
+            train_dataset = load_tokenized_dataset(data_args.train_file, tokenizer, data_args, main_process)
+    # 如果启用了 do_eval 标志，类似地加载验证数据集
     if training_args.do_eval:
-        with open(data_args.validation_file, "r", encoding="utf-8") as f:
-            eval_data = [json.loads(line) for line in f]
-        eval_dataset = InputOutputDataset(eval_data, tokenizer, data_args)
+        with training_args.main_process_first(desc="tokenize validation dataset"):
+            eval_dataset = load_tokenized_dataset(data_args.validation_file, tokenizer, data_args, main_process)
+
+    # 打包模式：把多个样本装进长度为 max_source_length + max_target_length 的窗口，并输出打包前后的填充比例
+    if data_args.packing:
+        capacity = data_args.max_source_length + data_args.max_target_length
+        data_collator = PackedDataCollator(tokenizer)
+        if training_args.do_train:
+            before = padding_ratio(train_dataset.lengths, training_args.per_device_train_batch_size)
+            train_dataset = PackedDataset(train_dataset, capacity)
+            after = padding_ratio(train_dataset.lengths, training_args.per_device_train_batch_size)
+            print(f"packing: {len(train_dataset.dataset)} samples -> {len(train_dataset)} windows, "
+                  f"padding ratio {before:.2%} -> {after:.2%}")
+        if training_args.do_eval:
+            eval_dataset = PackedDataset(eval_dataset, capacity)
 
     # 实例化 Trainer 对象，用于训练和评估。传入模型、分词器、数据规整器、训练参数以及（如果启用训练或评估）数据集
-    trainer = Trainer(
+    trainer = TokenBudgetTrainer(
+        max_tokens_per_batch=data_args.max_tokens_per_batch,
         model=model,
         tokenizer=tokenizer,
         data_collator=data_collator,
@@ -0,0 +1,92 @@
+import os
+import json
+import sqlite3
+import hashlib
+
+
+def _sha256_file(path, h=None, chunk_size=1 << 20):
+    h = h or hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h
+
+
+# 基座模型指纹：本地目录时取 config.json / generation_config.json 的内容以及权重文件的文件名和大小
+# （完整哈希几十 GB 的权重太慢），否则（hub 上的模型名）直接使用名称
+def model_fingerprint(model_path):
+    h = hashlib.sha256()
+    if not os.path.isdir(model_path):
+        h.update(model_path.encode("utf-8"))
+        return h.hexdigest()
+    for name in ["config.json", "generation_config.json"]:
+        path = os.path.join(model_path, name)
+        if os.path.exists(path):
+            _sha256_file(path, h)
+    for name in sorted(os.listdir(model_path)):
+        if name.endswith((".safetensors", ".bin")):
+            h.update(f"{name}:{os.path.getsize(os.path.join(model_path, name))}".encode("utf-8"))
+    return h.hexdigest()
+
+
+# LoRA checkpoint 指纹：adapter 权重和配置文件较小，直接哈希完整内容
+def adapter_fingerprint(checkpoint_path):
+    if checkpoint_path is None:
+        return ""
+    h = hashlib.sha256()
+    for name in ["adapter_config.json", "adapter_model.safetensors", "adapter_model.bin"]:
+        path = os.path.join(checkpoint_path, name)
+        if os.path.exists(path):
+            _sha256_file(path, h)
+    return h.hexdigest()
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+# 评估生成结果的本地缓存（SQLite），键为 (基座模型指纹, adapter 指纹, 提示哈希, 生成配置)
+# 每生成一个 batch 就提交一次，评估被中断后重新运行会跳过已缓存的提示，从中断处继续；
+# 只修改指标代码时可以完全从缓存重新打分，不需要加载模型
+class GenerationCache:
+    def __init__(self, path, model_fp, adapter_fp):
+        self.path = path
+        self.model_fp = model_fp
+        self.adapter_fp = adapter_fp
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "model TEXT NOT NULL, adapter TEXT NOT NULL, prompt TEXT NOT NULL, config TEXT NOT NULL, "
+            "response TEXT NOT NULL, PRIMARY KEY (model, adapter, prompt, config))")
+        self.conn.commit()
+
+    # 生成配置序列化为稳定的字符串，作为键的一部分
+    @staticmethod
+    def config_key(config):
+        return json.dumps(config, sort_keys=True, ensure_ascii=False)
+
+    # 批量查询，返回 {提示哈希: 回复}，只包含命中的提示
+    def get_many(self, prompt_hashes, config):
+        config = self.config_key(config)
+        found = {}
+        hashes = list(prompt_hashes)
+        # SQLite 对单条语句的参数个数有限制，分块查询
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT prompt, response FROM generations WHERE model = ? AND adapter = ? AND config = ? "
+                f"AND prompt IN ({','.join('?' * len(chunk))})",
+                [self.model_fp, self.adapter_fp, config] + chunk)
+            found.update(rows)
+        return found
+
+    # 批量写入并立即提交
+    def put_many(self, items, config):
+        config = self.config_key(config)
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO generations (model, adapter, prompt, config, response) VALUES (?, ?, ?, ?, ?)",
+            [(self.model_fp, self.adapter_fp, h, config, response) for h, response in items])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,298 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+import json
+from collections import OrderedDict
+import torch
+from transformers import LogitsProcessor
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+from convert_format import tools
+
+# search 轮次的回复以 "search\n" 开头，其后是 search_hotels 的参数对象
+SEARCH_HEADER = b"search\n"
+WHITESPACE = b" \t\r\n"
+# 连续空白的最大字节数（json.dumps(indent=4) 的缩进加换行远小于它），避免模型一直生成空白
+MAX_WHITESPACE = 16
+ESCAPES = b'"\\/bfnrt'
+DIGITS = b"0123456789"
+
+
+def search_hotels_schema():
+    return next(tool["function"]["parameters"] for tool in tools if tool["function"]["name"] == "search_hotels")
+
+
+# 按字节运行的 JSON 状态机，只接受符合对象 schema 的文本：
+#   键只能是 properties 中尚未出现过的键；enum 字符串只能是其中的某个值；数字不能超出 minimum/maximum，也不带指数；
+#   数组的元素是字符串；对象闭合后不再接受任何字节
+# 状态是可哈希的元组，字符串内容本身不记入状态（enum 和键除外），因此不同样本的状态大多相同，便于缓存 token 掩码
+# 结构字符都是 ASCII，字符串中的非 ASCII 字节（UTF-8 多字节字符，可能跨 token）原样接受
+class SchemaMachine:
+    START = ("start", 0)
+    DONE = ("done",)
+
+    def __init__(self, schema):
+        self.properties = {}
+        for key, spec in schema["properties"].items():
+            kind = spec["type"]
+            if kind == "array" and spec.get("items", {}).get("type", "string") != "string":
+                raise ValueError(f"unsupported array items for {key}: {spec['items']}")
+            if kind not in ("string", "number", "integer", "array"):
+                raise ValueError(f"unsupported type for {key}: {kind}")
+            self.properties[key] = spec
+        self.keys = {key.encode("utf-8"): key for key in self.properties}
+        self.enums = {key: {json.dumps(v, ensure_ascii=False)[1:-1].encode("utf-8") for v in spec["enum"]}
+                      for key, spec in self.properties.items() if "enum" in spec}
+        self.memo = {}
+
+    # 依次输入一段字节，返回新状态；不被接受时返回 None
+    def feed(self, state, data):
+        for b in data:
+            state = self.step(state, b)
+            if state is None:
+                return None
+        return state
+
+    def step(self, state, b):
+        key = (state, b)
+        if key not in self.memo:
+            if len(self.memo) > 1 << 20:
+                self.memo.clear()
+            self.memo[key] = self._step(state, b)
+        return self.memo[key]
+
+    def _step(self, state, b):
+        mode = state[0]
+        # 允许空白的状态，最后一项是当前连续空白的字节数
+        if b in WHITESPACE and mode in ("start", "obj", "colon", "value", "array", "after"):
+            return state[:-1] + (state[-1] + 1,) if state[-1] < MAX_WHITESPACE else None
+        if mode == "start":
+            return ("obj", frozenset(), False, 0) if b == ord("{") else None
+        if mode == "obj":
+            _, used, need_key, _ = state
+            if b == ord('"'):
+                return ("key", used, b"")
+            return self.DONE if b == ord("}") and not need_key else None
+        if mode == "key":
+            _, used, prefix = state
+            if b == ord('"'):
+                name = self.keys.get(prefix)
+                return ("colon", used, name, 0) if name is not None and name not in used else None
+            prefix += bytes([b])
+            return ("key", used, prefix) if any(k.startswith(prefix) and self.keys[k] not in used for k in self.keys) \
+                else None
+        if mode == "colon":
+            _, used, name, _ = state
+            return ("value", used, name, 0) if b == ord(":") else None
+        if mode == "value":
+            return self._value(state[1], state[2], b)
+        if mode == "string":
+            _, used, name, escape = state
+            if escape:
+                return ("string", used, name, False) if b in ESCAPES else None
+            if b == ord('"'):
+                return self._after(used, name)
+            if b < 0x20:
+                return None
+            return ("string", used, name, b == ord("\\"))
+        if mode == "enum":
+            _, used, name, prefix = state
+            if b == ord('"'):
+                return self._after(used, name) if prefix in self.enums[name] else None
+            prefix += bytes([b])
+            return ("enum", used, name, prefix) if any(v.startswith(prefix) for v in self.enums[name]) else None
+        if mode == "number":
+            _, used, name, text = state
+            if b in DIGITS or b == ord("."):
+                text = self._number(name, text, b)
+                return ("number", used, name, text) if text is not None else None
+            if not self._number_complete(name, text):
+                return None
+            return self._step(self._after(used, name), b)
+        if mode == "array":
+            _, used, name, position, _ = state
+            if b == ord('"') and position in ("open", "next"):
+                return ("item", used, name, False)
+            if b == ord("]") and position in ("open", "item"):
+                return self._after(used, name)
+            if b == ord(",") and position == "item":
+                return ("array", used, name, "next", 0)
+            return None
+        if mode == "item":
+            _, used, name, escape = state
+            if escape:
+                return ("item", used, name, False) if b in ESCAPES else None
+            if b == ord('"'):
+                return ("array", used, name, "item", 0)
+            if b < 0x20:
+                return None
+            return ("item", used, name, b == ord("\\"))
+        if mode == "after":
+            _, used, _ = state
+            if b == ord(","):
+                return ("obj", used, True, 0) if len(used) < len(self.properties) else None
+            return self.DONE if b == ord("}") else None
+        return None
+
+    def _after(self, used, name):
+        return ("after", used | {name}, 0)
+
+    # 值的第一个字节
+    def _value(self, used, name, b):
+        spec = self.properties[name]
+        kind = spec["type"]
+        if kind == "array":
+            return ("array", used, name, "open", 0) if b == ord("[") else None
+        if kind == "string":
+            if b != ord('"'):
+                return None
+            return ("enum", used, name, b"") if name in self.enums else ("string", used, name, False)
+        if b == ord("-") and spec.get("minimum", -1) < 0:
+            return ("number", used, name, b"-")
+        if b in DIGITS:
+            text = self._number(name, b"", b)
+            return ("number", used, name, text) if text is not None else None
+        return None
+
+    # 数字追加一个字节后的文本；不合法或已不可能落在 [minimum, maximum] 内时返回 None
+    # 非负数继续追加数字只会变大，所以只要当前前缀不超过 maximum 就还有合法的结尾；负数只检查格式
+    def _number(self, name, text, b):
+        digits = text.lstrip(b"-")
+        if b == ord("."):
+            if not digits or b"." in digits or self.properties[name]["type"] == "integer":
+                return None
+        elif digits == b"0":
+            return None
+        text += bytes([b])
+        maximum = self.properties[name].get("maximum")
+        if maximum is not None and not text.startswith(b"-") and float(text.rstrip(b".")) > maximum:
+            return None
+        return text
+
+    # 已解析出的对象是否符合 schema：把它序列化成 JSON 后交给状态机，整段被接受且对象闭合即符合
+    def accepts(self, obj):
+        if not isinstance(obj, dict):
+            return False
+        try:
+            data = json.dumps(obj, ensure_ascii=False, allow_nan=False).encode("utf-8")
+        except (TypeError, ValueError):
+            return False
+        return self.feed(self.START, data) == self.DONE
+
+    def _number_complete(self, name, text):
+        if not text.lstrip(b"-") or text.endswith(b"."):
+            return False
+        minimum = self.properties[name].get("minimum")
+        maximum = self.properties[name].get("maximum")
+        value = float(text)
+        return (minimum is None or value >= minimum) and (maximum is None or value <= maximum)
+
+
+# 每个 token 对应的字节串；特殊 token（<|im_start|> 等添加的 token）为 None
+def token_bytes(tokenizer):
+    byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+    special = set(tokenizer.added_tokens_decoder)
+    result = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token is None or token_id in special:
+            result.append(None)
+        elif all(c in byte_decoder for c in token):
+            result.append(bytes(byte_decoder[c] for c in token))
+        else:
+            # 不是字节级 BPE 的分词器
+            result.append(tokenizer.decode([token_id]).encode("utf-8"))
+    return result
+
+
+# 词表的字节前缀树与各状态下允许的 token 缓存，由同一分词器的所有生成共享
+#   计算某个状态允许的 token 时沿前缀树遍历，状态机拒绝某个字节时跳过整棵子树
+#   对象闭合（DONE）后只允许 <|im_end|>
+class SearchSchemaIndex:
+    def __init__(self, tokenizer, schema=None, max_cache_size=4096):
+        self.machine = SchemaMachine(schema or search_hotels_schema())
+        self.token_bytes = token_bytes(tokenizer)
+        self.im_end_id = tokenizer.convert_tokens_to_ids("<|im_end|>")
+        self.max_cache_size = max_cache_size
+        self.cache = OrderedDict()
+        # 节点为 (子节点字典, 在此结束的 token)
+        self.trie = ({}, [])
+        for token_id, data in enumerate(self.token_bytes):
+            if not data:
+                continue
+            node = self.trie
+            for b in data:
+                node = node[0].setdefault(b, ({}, []))
+            node[1].append(token_id)
+
+    # 状态 state 下允许的 token，放在 device 上的 LongTensor
+    def allowed(self, state, device):
+        key = (state, str(device))
+        ids = self.cache.get(key)
+        if ids is not None:
+            self.cache.move_to_end(key)
+            return ids
+        ids = torch.tensor(self._collect(state), dtype=torch.long, device=device)
+        self.cache[key] = ids
+        while len(self.cache) > self.max_cache_size:
+            self.cache.popitem(last=False)
+        return ids
+
+    def _collect(self, state):
+        if state == SchemaMachine.DONE:
+            return [self.im_end_id]
+        allowed = []
+        stack = [(self.trie, state)]
+        while stack:
+            node, current = stack.pop()
+            for b, child in node[0].items():
+                following = self.machine.step(current, b)
+                if following is None:
+                    continue
+                allowed.extend(child[1])
+                if child[0]:
+                    stack.append((child, following))
+        return allowed
+
+
+# 约束 search 轮次的 JSON 输出：每行生成的文本（跳过特殊 token）以 "search\n" 开头后，
+# 之后的每个 token 都必须让状态机继续接受；对象闭合后只能生成 <|im_end|>，生成随即结束
+# 以其他内容开头（assistant 回复）的行不受约束。每次 generate 使用一个新的实例，第一次调用时的输入长度即提示长度
+class SearchJsonLogitsProcessor(LogitsProcessor):
+    def __init__(self, index):
+        self.index = index
+        self.rows = None
+
+    def __call__(self, input_ids, scores):
+        if self.rows is None:
+            # 每行为 [尚未确定角色时已生成的字节（确定后为 None）, 状态机状态（不受约束时为 None）]
+            self.rows = [[b"", None] for _ in range(input_ids.shape[0])]
+        else:
+            for row, token in zip(self.rows, input_ids[:, -1].tolist()):
+                self._push(row, token)
+        for i, (_, state) in enumerate(self.rows):
+            if state is None:
+                continue
+            ids = self.index.allowed(state, scores.device)
+            if len(ids) == 0:
+                continue
+            masked = torch.full_like(scores[i], float("-inf"))
+            masked[ids] = scores[i, ids]
+            scores[i] = masked
+        return scores
+
+    def _push(self, row, token):
+        header, state = row
+        data = self.index.token_bytes[token] if token < len(self.index.token_bytes) else None
+        if state is not None:
+            if data is not None:
+                row[1] = self.index.machine.feed(state, data)
+            return
+        if header is None or data is None:
+            return
+        header += data
+        if header.startswith(SEARCH_HEADER):
+            row[0] = None
+            row[1] = self.index.machine.feed(SchemaMachine.START, header[len(SEARCH_HEADER):])
+        elif SEARCH_HEADER.startswith(header):
+            row[0] = header
+        else:
+            row[0] = None
@@ -0,0 +1,115 @@
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+# KV cache（每层一个 (key, value)，形状为 (batch, heads, length, head_dim)）占用的字节数
+def kv_nbytes(past):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in past)
+
+
+# 只保留前 length 个位置；因果注意力下任意前缀的 KV 都与单独计算该前缀时相同
+def truncate_kv(past, length):
+    return [(k[:, :, :length], v[:, :, :length]) for k, v in past]
+
+
+def common_prefix_length(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    diff = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n]))
+    return int(diff[0]) if len(diff) else n
+
+
+# 按会话保存对话前缀的 KV cache，新的提示只需 prefill 与已缓存前缀不同的部分
+#   每个会话只保留一个条目：最近一次请求的 token 序列（提示加上生成的回复）及其 KV cache，每次保存时整体替换
+#   下一轮的提示通常以上一轮的提示和回复开头，查找时逐个 token 比较，取与该条目的公共前缀
+#   总字节数超过 max_bytes 时按会话的 LRU 淘汰；短于 min_tokens 的序列不值得缓存
+class PrefixKVCache:
+    def __init__(self, max_bytes=1 << 30, min_tokens=16):
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "prompt_tokens": 0, "reused_tokens": 0, "evictions": 0}
+
+    # 查找 ids 在该会话中已缓存的最长前缀，返回 (前缀长度, 该前缀的 KV cache)；没有命中时返回 (0, None)
+    # limit：前缀长度上限（提示至少要留一个 token 做 prefill 才能得到下一个 token 的 logits）
+    def lookup(self, session, ids, limit=None):
+        limit = len(ids) if limit is None else min(limit, len(ids))
+        with self.lock:
+            self.stats["lookups"] += 1
+            self.stats["prompt_tokens"] += len(ids)
+            entry = self.entries.get(session)
+            if entry is None:
+                return 0, None
+            self.entries.move_to_end(session)
+            entry_ids, past, _ = entry
+            length = min(common_prefix_length(ids, entry_ids), limit)
+            if length == 0:
+                return 0, None
+            self.stats["hits"] += 1
+            self.stats["reused_tokens"] += length
+            return length, truncate_kv(past, length)
+
+    # 保存一段 token 序列的 KV cache（past 的长度应与 ids 相同），替换该会话原有的条目
+    # 保存的是副本，不引用调用方的 batch 张量
+    def store(self, session, ids, past):
+        if len(ids) < self.min_tokens:
+            return
+        ids = list(ids)
+        past = [(k.detach().clone(), v.detach().clone()) for k, v in past]
+        nbytes = kv_nbytes(past)
+        with self.lock:
+            self._remove(session)
+            if nbytes > self.max_bytes:
+                return
+            self.entries[session] = (ids, past, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def _remove(self, session):
+        entry = self.entries.pop(session, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    # 会话结束（清空对话）时释放它的条目
+    def drop_session(self, session):
+        with self.lock:
+            self._remove(session)
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.bytes
+        stats["reuse_rate"] = stats["reused_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0
+        return stats
+
+
+# 把 data_to_turns 生成的样本按对话分组：同一对话的样本是逐渐变长的前缀，
+# 后一个样本的上下文以前一个样本的上下文加上其回复开头。返回每个对话的样本下标列表，按上下文长度排序
+def group_dialogs(samples):
+    contexts = [json.loads(s["context"]) if isinstance(s["context"], str) else s["context"] for s in samples]
+    responses = [json.loads(s["response"]) if isinstance(s["response"], str) else s["response"] for s in samples]
+    key = lambda turns: json.dumps(turns, ensure_ascii=False, sort_keys=True)
+    # 上下文加回复 → 样本下标
+    continued = {key(context + [response]): i for i, (context, response) in enumerate(zip(contexts, responses))}
+    parent = {}
+    for i, context in enumerate(contexts):
+        for length in range(len(context) - 1, 0, -1):
+            j = continued.get(key(context[:length]))
+            if j is not None and j != i:
+                parent[i] = j
+                break
+    groups = {}
+    for i in range(len(samples)):
+        root = i
+        while root in parent:
+            root = parent[root]
+        groups.setdefault(root, []).append(i)
+    return [sorted(indices, key=lambda i: len(contexts[i])) for _, indices in sorted(groups.items())]
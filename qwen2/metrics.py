@@ -0,0 +1,161 @@
+import multiprocessing
+import numpy as np
+
+# 分槽位统计时的分组：价格、评分的上下限各自合并为一组，其余字段按字段名单独统计
+SLOT_GROUPS = {
+    "price_range_lower": "price",
+    "price_range_upper": "price",
+    "rating_range_lower": "rating",
+    "rating_range_upper": "rating",
+}
+
+
+# 把假设和参考句子编码为字符 id：两侧共用一个稠密的字符表，每一侧的句子首尾相接成一个数组
+# 每一侧返回 (字符 id 数组, 每个字符所属的句子编号, 每个字符在句子中的位置, 每个句子的长度)
+def _encode_chars(hypotheses, references):
+    sentences = hypotheses + references
+    lengths = np.asarray([len(s) for s in sentences], dtype=np.int64)
+    codepoints = np.frombuffer("".join(sentences).encode("utf-32-le"), dtype=np.uint32)
+    vocab, ids = np.unique(codepoints, return_inverse=True)
+    ids = ids.astype(np.int64)
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(len(ids), dtype=np.int64) - np.repeat(starts, lengths)
+    split = int(lengths[:len(hypotheses)].sum())
+
+    def side(char_slice, sentence_slice):
+        side_lengths = lengths[sentence_slice]
+        owners = np.repeat(np.arange(len(side_lengths), dtype=np.int64), side_lengths)
+        return ids[char_slice], owners, positions[char_slice], side_lengths
+
+    return (side(slice(0, split), slice(0, len(hypotheses))),
+            side(slice(split, None), slice(len(hypotheses), None)),
+            len(vocab))
+
+
+# n-gram 键：把 n 个连续字符 id 按 bits 位拼成一个整数（无碰撞），只保留不跨句子的位置
+# 返回 (键数组, 所属句子编号数组)
+def _ngram_keys(chars, n, bits):
+    ids, owners, positions, lengths = chars
+    if len(ids) < n:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    valid = positions[:len(ids) - n + 1] <= lengths[owners[:len(ids) - n + 1]] - n
+    key = ids[:len(ids) - n + 1].copy()
+    for k in range(1, n):
+        key = (key << bits) | ids[k:len(ids) - n + 1 + k]
+    return key[valid], owners[:len(ids) - n + 1][valid]
+
+
+# 每个句子中第 n 阶 n-gram 的截断匹配数（与 nltk modified_precision 的分子相同）
+# 先把 (句子编号, n-gram) 映射为一个整数键，再对全语料一次性计数并求交集
+def _clipped_matches(hyp_chars, ref_chars, n, bits):
+    hyp_keys, hyp_owners = _ngram_keys(hyp_chars, n, bits)
+    ref_keys, ref_owners = _ngram_keys(ref_chars, n, bits)
+    matches = np.zeros(len(hyp_chars[3]), dtype=np.int64)
+    if len(hyp_keys) == 0 or len(ref_keys) == 0:
+        return matches
+    # n-gram 重新编号为稠密 id，与句子编号拼成 64 位键
+    _, dense = np.unique(np.concatenate([hyp_keys, ref_keys]), return_inverse=True)
+    hyp_pairs = (hyp_owners << 32) | dense[:len(hyp_keys)]
+    ref_pairs = (ref_owners << 32) | dense[len(hyp_keys):]
+    hyp_unique, hyp_counts = np.unique(hyp_pairs, return_counts=True)
+    ref_unique, ref_counts = np.unique(ref_pairs, return_counts=True)
+    common, hyp_pos, ref_pos = np.intersect1d(hyp_unique, ref_unique, assume_unique=True, return_indices=True)
+    clipped = np.minimum(hyp_counts[hyp_pos], ref_counts[ref_pos])
+    np.add.at(matches, common >> 32, clipped)
+    return matches
+
+
+# 一批句子的字符级 BLEU-4，逐句结果与 nltk sentence_bleu（单参考、method3 平滑）一致
+def _char_bleu4_chunk(pairs):
+    hypotheses = [h for h, _ in pairs]
+    references = [r for _, r in pairs]
+    hyp_chars, ref_chars, vocab_size = _encode_chars(hypotheses, references)
+    hyp_lens, ref_lens = hyp_chars[3], ref_chars[3]
+    bits = max(1, (vocab_size - 1).bit_length())
+    if 4 * bits > 63:
+        raise ValueError(f"too many distinct characters ({vocab_size}) to pack 4-grams into 64 bits")
+
+    numerators = np.stack([_clipped_matches(hyp_chars, ref_chars, n, bits) for n in range(1, 5)], axis=1)
+    denominators = np.stack([np.maximum(1, hyp_lens - n + 1) for n in range(1, 5)], axis=1)
+    # method3：第 k 个匹配数为 0 的阶数取 1 / (2^k * 分母)
+    zeros = numerators == 0
+    k = np.cumsum(zeros, axis=1)
+    precisions = np.where(zeros, 1.0 / (2.0 ** k * denominators), numerators / denominators)
+    log_mean = np.log(precisions).sum(axis=1) * 0.25
+    with np.errstate(divide="ignore"):
+        brevity = np.where(hyp_lens > ref_lens, 1.0, np.exp(1 - ref_lens / np.maximum(hyp_lens, 1)))
+    scores = brevity * np.exp(log_mean)
+    # 没有任何 1-gram 匹配（包括空句子）时为 0
+    scores[numerators[:, 0] == 0] = 0.0
+    return scores
+
+
+# 逐句字符级 BLEU-4：先去掉首尾空白，任一侧为空时得分为 0
+# workers > 1 时把语料切块后在进程池中计算
+def char_bleu4(hypotheses, references, workers=None, chunk_size=2000):
+    pairs = [(h.strip(), r.strip()) for h, r in zip(hypotheses, references)]
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    if not chunks:
+        return np.zeros(0)
+    if workers and workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(workers, len(chunks))) as pool:
+            results = pool.map(_char_bleu4_chunk, chunks)
+    else:
+        results = [_char_bleu4_chunk(chunk) for chunk in chunks]
+    return np.concatenate(results)
+
+
+# 单个样本的槽位统计，返回 {槽位分组: [正确数, 预测数, 真实数]}，计数方式与原 Evaluator.slot_accuracy 相同：
+# 列表类型的槽位按元素计数，值为 None 的预测槽位计入预测数但不参与匹配
+def slot_counts(pred, label):
+    counts = {}
+
+    def add(slot, index, value):
+        slot = SLOT_GROUPS.get(slot, slot)
+        counts.setdefault(slot, [0, 0, 0])[index] += value
+
+    if pred:
+        for k, v in pred.items():
+            add(k, 1, len(v) if isinstance(v, list) else 1)
+            if v is None or not label or k not in label:
+                continue
+            if not isinstance(v, list):
+                add(k, 0, int(v == label[k]))
+            else:
+                add(k, 0, sum(int(t in label[k]) for t in v))
+    if label:
+        for k, v in label.items():
+            add(k, 2, len(v) if isinstance(v, list) else 1)
+    return counts
+
+
+def precision_recall_f1(correct, pred, true):
+    precision = correct / pred if pred > 0 else 0
+    recall = correct / true if true > 0 else 0
+    f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0
+    return precision, recall, f1
+
+
+# 全部 search 样本的槽位 P/R/F1：返回 (总体 (P, R, F1), {槽位分组: (P, R, F1)})
+def slot_metrics(preds, labels):
+    totals = [0, 0, 0]
+    per_slot = {}
+    for pred, label in zip(preds, labels):
+        for slot, counts in slot_counts(pred, label).items():
+            slot_total = per_slot.setdefault(slot, [0, 0, 0])
+            for i in range(3):
+                slot_total[i] += counts[i]
+                totals[i] += counts[i]
+    return precision_recall_f1(*totals), {slot: precision_recall_f1(*c) for slot, c in per_slot.items()}
+
+
+# 与 nltk 的逐句实现对比，验证批量实现的结果
+def check_against_nltk(hypotheses, references):
+    from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+    smoothing = SmoothingFunction().method3
+    expected = []
+    for h, r in zip(hypotheses, references):
+        h, r = h.strip(), r.strip()
+        expected.append(sentence_bleu([list(r)], list(h), smoothing_function=smoothing) if h and r else 0)
+    diff = np.abs(char_bleu4(hypotheses, references) - np.asarray(expected, dtype=np.float64))
+    return float(diff.max()) if len(diff) else 0.0
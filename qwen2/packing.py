@@ -0,0 +1,106 @@
+import bisect
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+# 最佳适应递减（best-fit decreasing）装箱：按长度从长到短，把每个样本放入剩余容量最小且放得下的窗口
+# 剩余容量保存在有序列表中，用二分查找定位窗口，总复杂度约为 O(n log n)
+# lengths：每个样本的 token 数；capacity：每个窗口的最大 token 数
+# 返回窗口列表，每个窗口是样本下标列表
+def pack_lengths(lengths, capacity):
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    bins = []
+    # (剩余容量, 窗口编号) 的有序列表
+    free = []
+    for i in order:
+        length = int(lengths[i])
+        if length > capacity:
+            raise ValueError(f"sample {i} has {length} tokens, more than the packing capacity {capacity}")
+        pos = bisect.bisect_left(free, (length, -1))
+        if pos == len(free):
+            bins.append([i])
+            bin_id, remaining = len(bins) - 1, capacity - length
+        else:
+            remaining, bin_id = free.pop(pos)
+            bins[bin_id].append(i)
+            remaining -= length
+        if remaining > 0:
+            bisect.insort(free, (remaining, bin_id))
+    return bins
+
+
+# 按批次补齐到批内最长序列时的填充比例：填充 token 数 / 补齐后的 token 总数
+def padding_ratio(lengths, batch_size):
+    lengths = np.asarray(lengths)
+    padded = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start + batch_size]
+        padded += int(batch.max()) * len(batch)
+    total = int(lengths.sum())
+    return (padded - total) / padded if padded > 0 else 0.0
+
+
+# 把预分词数据集中的多个样本打包进同一个训练窗口
+# 每个窗口返回拼接后的 input_ids、labels，以及每个样本各自从 0 开始的 position_ids
+class PackedDataset(Dataset):
+    def __init__(self, dataset, capacity):
+        super(PackedDataset, self).__init__()
+        self.dataset = dataset
+        self.capacity = capacity
+        self.bins = pack_lengths(dataset.lengths, capacity)
+
+    def __len__(self):
+        return len(self.bins)
+
+    # 每个窗口的 token 数
+    @property
+    def lengths(self):
+        sample_lengths = self.dataset.lengths
+        return np.asarray([sum(int(sample_lengths[i]) for i in b) for b in self.bins])
+
+    def __getitem__(self, i):
+        samples = [self.dataset[j] for j in self.bins[i]]
+        return {
+            "input_ids": np.concatenate([s["input_ids"] for s in samples]),
+            "labels": np.concatenate([s["labels"] for s in samples]),
+            "position_ids": np.concatenate([np.arange(len(s["input_ids"])) for s in samples]),
+        }
+
+
+# 打包窗口的数据规整器
+# attention_mask 为 (batch, 1, seq, seq) 的块对角因果掩码（1 表示可见），窗口内的样本之间互不可见
+# 每个样本第一个位置的 label 置为 -100，保证上一个样本的最后一个 token 不会去预测下一个样本
+# 右侧填充的位置单独成块，只看得见填充部分，labels 为 -100
+class PackedDataCollator:
+    def __init__(self, tokenizer, label_pad_token_id=-100):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.label_pad_token_id = label_pad_token_id
+
+    def __call__(self, features):
+        max_length = max(len(f["input_ids"]) for f in features)
+        batch_size = len(features)
+        input_ids = torch.full((batch_size, max_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((batch_size, max_length), self.label_pad_token_id, dtype=torch.long)
+        position_ids = torch.zeros((batch_size, max_length), dtype=torch.long)
+        segment_ids = torch.zeros((batch_size, max_length), dtype=torch.long)
+        for row, f in enumerate(features):
+            length = len(f["input_ids"])
+            input_ids[row, :length] = torch.as_tensor(np.asarray(f["input_ids"], dtype=np.int64))
+            labels[row, :length] = torch.as_tensor(np.asarray(f["labels"], dtype=np.int64))
+            positions = torch.as_tensor(np.asarray(f["position_ids"], dtype=np.int64))
+            position_ids[row, :length] = positions
+            position_ids[row, length:] = torch.arange(max_length - length)
+            starts = positions == 0
+            labels[row, :length][starts] = self.label_pad_token_id
+            # 样本编号从 1 开始，填充部分为 0
+            segment_ids[row, :length] = torch.cumsum(starts.long(), dim=0)
+        causal = torch.tril(torch.ones((max_length, max_length), dtype=torch.bool))
+        same_segment = segment_ids[:, :, None] == segment_ids[:, None, :]
+        attention_mask = (same_segment & causal).unsqueeze(1).float()
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "labels": labels,
+        }
@@ -0,0 +1,49 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+# 按 token 预算组 batch 的采样器：每个 batch 补齐后的 token 数（批内最长长度 × 样本数）不超过 max_tokens
+# 全部样本按长度排序后贪心地切成 batch，同一 batch 内的样本长度接近、填充很少
+# 排序后的长度序列与随机顺序无关，因此 batch 的个数和每个 batch 的大小在各个 epoch 之间固定不变，__len__ 是稳定的；
+# 每个 epoch 的随机性来自：长度相同的样本之间随机排列（决定哪些样本进入同一 batch），以及 batch 的顺序随机打乱
+# 与 DistributedSampler 一样，epoch 只由 set_epoch 指定，随机种子为 seed + epoch
+# 长度直接取自预分词缓存（TokenizedDataset.lengths / PackedDataset.lengths），采样时不需要分词
+class TokenBudgetBatchSampler(Sampler):
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        # 每个 batch 在长度排序后序列中的 [start, end)，与 epoch 无关
+        self.bounds = self._make_bounds(np.sort(self.lengths, kind="stable"))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _make_bounds(self, sorted_lengths):
+        bounds = []
+        start = 0
+        for end, length in enumerate(sorted_lengths):
+            # 按长度升序，当前样本就是批内最长的样本；单个样本超过预算时单独成为一个 batch
+            if end > start and int(length) * (end - start + 1) > self.max_tokens:
+                bounds.append((start, end))
+                start = end
+        if start < len(sorted_lengths):
+            bounds.append((start, len(sorted_lengths)))
+        return bounds
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __iter__(self):
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            # 主键为长度，长度相同时按随机数排列
+            order = np.lexsort((rng.random(len(self.lengths)), self.lengths))
+        else:
+            order = np.argsort(self.lengths, kind="stable")
+        batches = [order[start:end].tolist() for start, end in self.bounds]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches)
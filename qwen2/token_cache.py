@@ -0,0 +1,205 @@
+import os
+import json
+import shutil
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+from torch.utils.data import Dataset
+from data_preprocess import PromptEncoder
+
+# 缓存格式版本，修改样本构造方式或文件布局时递增，使旧缓存自动失效
+CACHE_VERSION = 1
+
+
+# 流式计算数据文件的 sha256，不把整个文件读入内存
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# 分词器指纹：fast tokenizer 直接使用其完整的序列化配置（词表、merges、normalizer、特殊 token），否则退化为词表和特殊 token
+def tokenizer_fingerprint(tokenizer):
+    h = hashlib.sha256(type(tokenizer).__name__.encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        # truncation/padding 是调用时设置的运行状态，不属于分词器本身
+        config = json.loads(tokenizer.backend_tokenizer.to_str())
+        config.pop("truncation", None)
+        config.pop("padding", None)
+        h.update(json.dumps(config, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    else:
+        h.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+# 缓存键：分词器、数据文件内容、最大长度以及列名，任何一项变化都会对应到新的缓存目录
+def cache_key(data_file, tokenizer, args):
+    key = {
+        "version": CACHE_VERSION,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "data": file_hash(data_file),
+        "prompt_column": args.prompt_column,
+        "response_column": args.response_column,
+        "sample_format": args.sample_format,
+        "max_source_length": args.max_source_length,
+        "max_target_length": args.max_target_length,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# 缓存目录：默认放在数据文件旁边的 .token_cache 目录下，目录名包含数据文件名和缓存键
+def cache_path(data_file, tokenizer, args):
+    cache_dir = getattr(args, "tokenized_cache_dir", None) or os.path.join(
+        os.path.dirname(os.path.abspath(data_file)), ".token_cache")
+    name = os.path.splitext(os.path.basename(data_file))[0]
+    return os.path.join(cache_dir, f"{name}-{cache_key(data_file, tokenizer, args)[:16]}")
+
+
+# 进程池中每个 worker 持有的分词器和参数，由 _init_worker 在进程启动时设置一次
+_worker_state = {}
+
+
+def _init_worker(tokenizer, sample_format, prompt_column, response_column, max_source_length, max_target_length):
+    _worker_state.update(
+        encoder=PromptEncoder(tokenizer),
+        sample_format=sample_format,
+        prompt_column=prompt_column,
+        response_column=response_column,
+        max_source_length=max_source_length,
+        max_target_length=max_target_length,
+    )
+
+
+# 对一批 jsonl 行做批量分词，截断参数与 InputOutputDataset.__getitem__ 完全一致
+# 同一对话的多个样本在文件中相邻，PromptEncoder 对它们共享的轮次只分词一次
+# 整段对话格式下每行是一个对话，截断到 max_source_length + max_target_length
+# 返回 (input_ids, labels) 列表
+def _tokenize_batch(lines):
+    state = _worker_state
+    encoder = state["encoder"]
+    items = [json.loads(line) for line in lines]
+    if state["sample_format"] == "dialogs":
+        dialogs = encoder.encode_dialogs(
+            [item[state["prompt_column"]] for item in items],
+            state["max_source_length"] + state["max_target_length"])
+        return [(np.asarray(input_ids, dtype=np.int32), np.asarray(labels, dtype=np.int32))
+                for input_ids, labels in dialogs]
+    contexts = encoder.encode_prompts(
+        [item[state["prompt_column"]] for item in items], state["max_source_length"])
+    responses = encoder.encode_responses(
+        [item[state["response_column"]] for item in items], state["max_target_length"])
+    return [(np.asarray(context + response, dtype=np.int32), np.asarray([-100] * len(context) + response, dtype=np.int32))
+            for context, response in zip(contexts, responses)]
+
+
+# 按 batch_size 行一批读取 jsonl 文件
+def _iter_batches(data_file, batch_size):
+    with open(data_file, "r", encoding="utf-8") as f:
+        lines = (line for line in f if line.strip())
+        while True:
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+# 一次性分词并写入缓存目录：
+#   input_ids.bin / labels.bin：所有样本首尾相接的 int32 数组
+#   offsets.npy：长度为 n+1 的 int64 数组，第 i 个样本位于 [offsets[i], offsets[i+1])
+#   meta.json：样本数、token 总数等信息
+# 先写入临时目录再原子替换，训练被中断时不会留下半成品缓存
+def build_token_cache(data_file, tokenizer, args, path, batch_size=1000):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    init_args = (tokenizer, args.sample_format, args.prompt_column, args.response_column,
+                 args.max_source_length, args.max_target_length)
+    num_workers = args.preprocessing_num_workers or 1
+    offsets = [0]
+    with open(os.path.join(tmp_path, "input_ids.bin"), "wb") as ids_fp, \
+            open(os.path.join(tmp_path, "labels.bin"), "wb") as labels_fp:
+        def write(results):
+            for input_ids, labels in results:
+                input_ids.tofile(ids_fp)
+                labels.tofile(labels_fp)
+                offsets.append(offsets[-1] + len(input_ids))
+
+        batches = _iter_batches(data_file, batch_size)
+        if num_workers <= 1:
+            _init_worker(*init_args)
+            for batch in batches:
+                write(_tokenize_batch(batch))
+        else:
+            with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=init_args) as pool:
+                # 按窗口提交，避免主进程把整个文件读进任务队列
+                while True:
+                    window = list(itertools.islice(batches, num_workers * 4))
+                    if not window:
+                        break
+                    for results in pool.imap(_tokenize_batch, window):
+                        write(results)
+    np.save(os.path.join(tmp_path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(tmp_path, "meta.json"), "w", encoding="utf-8") as fp:
+        json.dump({
+            "version": CACHE_VERSION,
+            "data_file": os.path.abspath(data_file),
+            "num_samples": len(offsets) - 1,
+            "num_tokens": offsets[-1],
+        }, fp, ensure_ascii=False, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+# 读取预分词缓存的数据集：样本以 memmap 切片的形式返回，不发生拷贝
+# memmap 在首次访问时才打开，DataLoader 的 worker 进程各自打开自己的映射
+class TokenizedDataset(Dataset):
+    def __init__(self, path):
+        super(TokenizedDataset, self).__init__()
+        self.path = path
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self._input_ids = None
+        self._labels = None
+
+    def _open(self):
+        self._input_ids = np.memmap(os.path.join(self.path, "input_ids.bin"), dtype=np.int32, mode="r")
+        self._labels = np.memmap(os.path.join(self.path, "labels.bin"), dtype=np.int32, mode="r")
+
+    # 不把已打开的 memmap 序列化到 worker 进程中
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_input_ids"] = None
+        state["_labels"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # 每个样本的 token 数，供按长度分组、打包等场景使用，无需再次分词
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, i):
+        if self._input_ids is None:
+            self._open()
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {
+            "input_ids": self._input_ids[start:end],
+            "attention_mask": np.ones(end - start, dtype=np.int32),
+            "labels": self._labels[start:end]
+        }
+
+
+# 加载数据文件对应的预分词数据集，缓存不存在或设置了 overwrite_cache 时先构建缓存
+# 分布式训练时只有主进程（main_process=True）按 overwrite_cache 重建，其他进程在屏障之后直接复用主进程刚写好的缓存
+def load_tokenized_dataset(data_file, tokenizer, args, main_process=True):
+    path = cache_path(data_file, tokenizer, args)
+    if (args.overwrite_cache and main_process) or not os.path.exists(os.path.join(path, "meta.json")):
+        build_token_cache(data_file, tokenizer, args, path)
+    return TokenizedDataset(path)
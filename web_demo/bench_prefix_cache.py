@@ -0,0 +1,76 @@
+# 前缀 KV cache 的回放测量：把测试集中同一对话的样本（逐渐变长的上下文）按顺序作为同一会话的连续轮次提交给调度器，
+# 多个对话并发回放，分别在不使用和使用 PrefixKVCache 时统计 prefill 的 token 数和耗时，并检查两次的生成结果一致
+# 运行：python bench_prefix_cache.py --model /path/to/model（CPU 上可以用很小的因果语言模型）
+import sys
+sys.path.append('../qwen2')
+import json
+import time
+import argparse
+import threading
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from data_preprocess import build_prompt
+from kv_cache import PrefixKVCache, group_dialogs
+from scheduler import InferenceScheduler
+
+
+def replay(model, tokenizer, samples, dialogs, args, prefix_cache):
+    scheduler = InferenceScheduler(model, tokenizer, max_batch_size=args.max_batch_size, prefix_cache=prefix_cache)
+    outputs = [None] * len(samples)
+    next_dialog = iter(range(len(dialogs)))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                d = next(next_dialog, None)
+            if d is None:
+                return
+            for i in dialogs[d]:
+                request = scheduler.submit(build_prompt(samples[i]["context"]), max_new_tokens=args.max_new_tokens,
+                                           session=d)
+                outputs[i] = "".join(request)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    scheduler.close()
+    return outputs, scheduler.stats, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--data", type=str, default="../data/test.jsonl")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dialogs", type=int, default=64, help="number of dialogs to replay")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=32)
+    parser.add_argument("--cache_mb", type=float, default=256)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).to(args.device).eval()
+    with open(args.data, "r", encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f]
+    # 优先回放轮次多的对话
+    dialogs = sorted(group_dialogs(samples), key=len, reverse=True)[:args.dialogs]
+    print(f"{len(dialogs)} dialogs, {sum(map(len, dialogs))} turns")
+
+    baseline, baseline_stats, baseline_seconds = replay(model, tokenizer, samples, dialogs, args, None)
+    prefix_cache = PrefixKVCache(max_bytes=int(args.cache_mb * (1 << 20)))
+    cached, cached_stats, cached_seconds = replay(model, tokenizer, samples, dialogs, args, prefix_cache)
+
+    print(f"without cache: {baseline_stats['prefill_tokens']:8d} prefill tokens  {baseline_seconds:7.2f} s")
+    print(f"   with cache: {cached_stats['prefill_tokens']:8d} prefill tokens  {cached_seconds:7.2f} s  "
+          f"({cached_stats['reused_tokens']} reused, "
+          f"{1 - cached_stats['prefill_tokens'] / baseline_stats['prefill_tokens']:.1%} saved)")
+    print(f"cache: {prefix_cache.summary()}")
+    turns = [i for dialog in dialogs for i in dialog]
+    matched = sum(baseline[i] == cached[i] for i in turns)
+    print(f"{matched}/{len(turns)} outputs identical with and without the cache")
@@ -0,0 +1,100 @@
+# 推理调度器的多客户端压测：--clients 个客户端线程并发提交测试集中的提示，与逐个生成（batch 大小为 1）对比
+# 可以在 CPU 上用很小的因果语言模型运行，例如：python bench_scheduler.py --model /path/to/tiny-qwen2 --device cpu
+# 同时检查调度器的贪心解码结果与单独生成的结果一致，被取消的请求及时结束
+import sys
+sys.path.append('../qwen2')
+import json
+import time
+import random
+import argparse
+import threading
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from data_preprocess import build_prompt
+from scheduler import InferenceScheduler
+
+
+def load_prompts(data_path, n):
+    prompts = []
+    with open(data_path, "r", encoding="utf-8") as f:
+        for line in f:
+            prompts.append(build_prompt(json.loads(line)["context"]))
+            if len(prompts) == n:
+                break
+    return prompts
+
+
+def summarize(name, results, seconds):
+    tokens = sum(r["tokens"] for r in results)
+    ttft = [r["ttft"] for r in results if r["ttft"] is not None]
+    print(f"{name:>10}: {seconds:7.2f} s  {tokens / seconds:8.1f} tokens/s  "
+          f"ttft p50 {np.percentile(ttft, 50) * 1000:7.1f} ms  p95 {np.percentile(ttft, 95) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True, help="causal LM to serve; a tiny model is enough on CPU")
+    parser.add_argument("--data", type=str, default="../data/test.jsonl")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--max_batch_size", type=int, default=8)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--cancel_rate", type=float, default=0.1, help="fraction of requests cancelled after a few chunks")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForCausalLM.from_pretrained(args.model, torch_dtype=torch.float32).to(args.device).eval()
+    prompts = load_prompts(args.data, args.requests)
+    rng = random.Random(0)
+    cancel = [rng.random() < args.cancel_rate for _ in prompts]
+
+    # 基线：同一个调度器每次只处理一个请求（没有填充），也作为贪心解码的参考结果
+    start = time.perf_counter()
+    reference, sequential = [], []
+    baseline = InferenceScheduler(model, tokenizer, max_batch_size=1)
+    for prompt in prompts:
+        generation = baseline.submit(prompt, max_new_tokens=args.max_new_tokens)
+        reference.append("".join(generation))
+        sequential.append(generation.stats())
+    baseline.close()
+    summarize("sequential", sequential, time.perf_counter() - start)
+
+    scheduler = InferenceScheduler(model, tokenizer, max_batch_size=args.max_batch_size)
+    outputs = [None] * len(prompts)
+    stats = [None] * len(prompts)
+    next_index = iter(range(len(prompts)))
+    lock = threading.Lock()
+
+    # 每个客户端依次提交请求，上一个请求结束后再提交下一个
+    def client():
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            request = scheduler.submit(prompts[i], max_new_tokens=args.max_new_tokens)
+            chunks = []
+            for chunk in request:
+                chunks.append(chunk)
+                if cancel[i] and len(chunks) == 3:
+                    request.cancel()
+            outputs[i] = "".join(chunks)
+            stats[i] = request.stats()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summarize("scheduler", [s for s, c in zip(stats, cancel) if not c], time.perf_counter() - start)
+    scheduler.close()
+    print(f"scheduler stats: {scheduler.stats}")
+
+    matched = sum(out == ref for out, ref, c in zip(outputs, reference, cancel) if not c)
+    cancelled = sum(cancel)
+    stopped_early = sum(len(out) < len(ref) for out, ref, c in zip(outputs, reference, cancel) if c)
+    print(f"{matched}/{len(prompts) - cancelled} outputs identical to sequential generation; "
+          f"{stopped_early}/{cancelled} cancelled requests ended early")
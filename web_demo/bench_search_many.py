@@ -0,0 +1,53 @@
+# search_many 与逐个调用 search 的对比：查询取自测试集中 search 轮次的参数，重复到 --queries 条
+# 运行：python bench_search_many.py --db local（或 --db weaviate，连接方式见 db_client.connect_weaviate）
+import json
+import time
+import argparse
+from db_client import HotelDB
+from local_db import LocalHotelDB
+from search_cache import SearchCache
+
+
+def load_dsls(data_path, n):
+    dsls = []
+    with open(data_path, "r", encoding="utf-8") as f:
+        for line in f:
+            label = json.loads(json.loads(line)["response"])
+            if label["role"] == "search":
+                dsls.append(label["arguments"])
+    return [dsls[i % len(dsls)] for i in range(n)]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="local", choices=["local", "weaviate"])
+    parser.add_argument("--data", type=str, default="../data/test.jsonl")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=3)
+    args = parser.parse_args()
+
+    dsls = load_dsls(args.data, args.queries)
+    print(f"{len(dsls)} queries, {len({json.dumps(d, sort_keys=True, ensure_ascii=False) for d in dsls})} distinct")
+    # 关闭结果缓存，两种方式都真正执行每个查询
+    if args.db == "local":
+        make_db = lambda: LocalHotelDB("hotel.json")
+    else:
+        make_db = lambda: HotelDB(cache=SearchCache(max_entries=0))
+
+    db = make_db()
+    looped, loop_seconds = timed(lambda: [db.search(dsl, limit=args.limit) for dsl in dsls])
+    db.close()
+    db = make_db()
+    batched, batch_seconds = timed(lambda: db.search_many(dsls, limit=args.limit))
+    db.close()
+
+    assert batched == looped, "search_many results differ from search"
+    print(f"search loop: {loop_seconds:8.3f} s  ({loop_seconds / len(dsls) * 1000:.3f} ms/query)")
+    print(f"search_many: {batch_seconds:8.3f} s  ({batch_seconds / len(dsls) * 1000:.3f} ms/query)")
+    print(f"speedup: {loop_seconds / batch_seconds:.1f}x")
@@ -0,0 +1,118 @@
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+
+# 数据库客户端池，供并发的 Gradio 请求共享：
+#   首次使用时才建立连接（lazy connect），最多同时借出 size 个客户端，其余请求在信号量上等待
+#   借出空闲超过 health_interval 秒的客户端前先调用 is_ready() 检查，不健康的客户端关闭后重建
+#   建立连接失败或调用中出现 retry_on 中的异常时，按指数退避（带随机抖动）重试，最多 max_retries 次
+# connect：无参数的工厂函数，返回带有 is_ready()/close() 方法的客户端，可以替换为本地的替身服务
+class ClientPool:
+    def __init__(self, connect, size=4, health_interval=30, max_retries=5, backoff=0.5, max_backoff=10,
+                 retry_on=(ConnectionError, TimeoutError)):
+        self.connect = connect
+        self.size = size
+        self.health_interval = health_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = retry_on
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        # 空闲客户端及其上次确认健康的时间
+        self.idle = []
+        self.closed = False
+        self.stats = {"connects": 0, "reconnects": 0, "retries": 0}
+
+    def _sleep(self, attempt):
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        time.sleep(delay * (0.5 + random.random() / 2))
+
+    @staticmethod
+    def _close_quietly(client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def _healthy(self, client):
+        try:
+            return bool(client.is_ready())
+        except Exception:
+            return False
+
+    def _new_client(self):
+        for attempt in range(self.max_retries + 1):
+            try:
+                client = self.connect()
+                with self.lock:
+                    self.stats["connects"] += 1
+                return client
+            except self.retry_on:
+                if attempt == self.max_retries:
+                    raise
+                with self.lock:
+                    self.stats["retries"] += 1
+                self._sleep(attempt)
+
+    # 取出一个可用的客户端：优先复用空闲客户端，必要时先做健康检查
+    def _checkout(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError("client pool is closed")
+                entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                return self._new_client()
+            client, checked = entry
+            if time.monotonic() - checked < self.health_interval or self._healthy(client):
+                return client
+            self._close_quietly(client)
+            with self.lock:
+                self.stats["reconnects"] += 1
+
+    def _checkin(self, client):
+        with self.lock:
+            if not self.closed:
+                self.idle.append((client, time.monotonic()))
+                return
+        self._close_quietly(client)
+
+    # 借出一个客户端，离开 with 块时归还；块内出现连接类异常时丢弃该客户端，下次使用时重新连接
+    @contextmanager
+    def client(self):
+        with self.semaphore:
+            client = self._checkout()
+            try:
+                yield client
+            except self.retry_on:
+                self._close_quietly(client)
+                with self.lock:
+                    self.stats["reconnects"] += 1
+                raise
+            except BaseException:
+                self._checkin(client)
+                raise
+            self._checkin(client)
+
+    # 用一个借出的客户端执行 fn(client)，遇到连接类异常时换一个新连接重试
+    def run(self, fn):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.client() as client:
+                    return fn(client)
+            except self.retry_on:
+                if attempt == self.max_retries:
+                    raise
+                with self.lock:
+                    self.stats["retries"] += 1
+                self._sleep(attempt)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for client, _ in idle:
+            self._close_quietly(client)
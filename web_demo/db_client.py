@@ -1,23 +1,40 @@
 import json
+import heapq
+import asyncio
 
 from dotenv import load_dotenv
 load_dotenv("api_keys.env")
 import os
 import requests
+import numpy as np
 import json
 from tqdm import tqdm
 import weaviate
 from weaviate.classes.init import Auth
+from weaviate.exceptions import WeaviateConnectionError, WeaviateTimeoutError, WeaviateGRPCUnavailableError
+from client_pool import ClientPool
+from facilities import FacilityIndex
+from search_cache import SearchCache, canonical_dsl
+from local_db import tokenize, name_filter_tokens
 
 
 
+OUTPUT_FIELDS = ["hotel_id", "name", "type", "address", "phone", "subway", "facilities", "price", "rating"]
+# 决定 _build_filters 结果的查询字段
+FILTER_SLOTS = ["type", "price_range_lower", "price_range_upper", "rating_range_lower", "rating_range_upper",
+                "name", "facilities"]
+
+
 # 计算RRF分数
 # 它根据文档在各个搜索结果列表中的排名位置计算分数，将高排名位置给予更高的权重。
-def rrf(rankings, k=60):
+# weights：每个结果列表的权重，默认均为 1；top_k：只取得分最高的 top_k 个（用堆选出，不对全部得分排序）
+def rrf(rankings, k=60, weights=None, top_k=None):
     if not isinstance(rankings, list):
         raise ValueError("Rankings should be a list.")
+    if weights is None:
+        weights = [1.0] * len(rankings)
     scores = dict()
-    for ranking in rankings:
+    for ranking, weight in zip(rankings, weights):
         if not ranking:  # 如果ranking为空，跳过它
             continue
         for i, doc in enumerate(ranking):
@@ -28,157 +45,294 @@ def rrf(rankings, k=60):
                 raise ValueError("Each item should have 'hotel_id' key.")
             if doc_id not in scores:
                 scores[doc_id] = (0, doc)
-            scores[doc_id] = (scores[doc_id][0] + 1 / (k + i), doc)
+            scores[doc_id] = (scores[doc_id][0] + weight / (k + i), doc)
 
-    sorted_scores = sorted(scores.values(), key=lambda x: x[0], reverse=True)
+    if top_k is None:
+        sorted_scores = sorted(scores.values(), key=lambda x: x[0], reverse=True)
+    else:
+        sorted_scores = heapq.nlargest(top_k, scores.values(), key=lambda x: x[0])
     return [item[1] for item in sorted_scores]
 
 
+# 连接 Weaviate：设置了环境变量 WEAVIATE_LOCAL（host:port）时连接本地的替身服务，否则连接云端集群
+def connect_weaviate():
+    headers = {
+        "X-OpenAI-Api-Key": os.getenv("OPENAI_API_KEY"),
+        "X-HuggingFace-Api-Key": os.getenv("HUGGINGFACE_API_KEY")}
+    headers = {k: v for k, v in headers.items() if v}
+    additional_config = weaviate.config.AdditionalConfig(
+        timeout=weaviate.config.Timeout(init=10)
+    )
+    local = os.getenv("WEAVIATE_LOCAL")
+    if local:
+        host, _, port = local.partition(":")
+        return weaviate.connect_to_local(host=host, port=int(port or 8080), headers=headers,
+                                         additional_config=additional_config)
+    return weaviate.connect_to_weaviate_cloud(
+        cluster_url="https://ipu4fofq3cudvfcc1ek7a.c0.asia-southeast1.gcp.weaviate.cloud",
+        auth_credentials=Auth.api_key(os.getenv("WEAVIATE_API_KEY")),
+        headers=headers,
+        additional_config=additional_config
+    )
+
+
+CATALOG_URL = "https://raw.githubusercontent.com/hamburgerswang/hotel-chatbot/main/data/hotel.json"
+
+
+# 酒店数据文件不存在时从 GitHub 下载；返回文件是否可用
+def download_catalog(path="hotel.json", url=CATALOG_URL):
+    if os.path.exists(path):
+        print(f"📁 {path} 已存在")
+        return True
+    print(f"📥 正在下载 {path}...")
+    try:
+        response = requests.get(url, timeout=30)  # 增加超时时间
+        response.raise_for_status()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(response.json(), f, ensure_ascii=False, indent=2)
+        print("✅ 下载完成")
+        return True
+    except Exception as e:
+        print(f"❌ 下载失败: {e}")
+        return False
+
+
+# 逐个读出 JSON 数组中的元素，每次只读入 chunk_size 个字符，不把整个文件载入内存
+def iter_json_array(path, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} is not a JSON array")
+        buffer = buffer[1:]
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # 元素被截断在块的末尾：再读入一块后重试
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer += chunk
+                continue
+            yield item
+            buffer = buffer[end:]
+
+
+# 导入清单：记录集合中每家酒店 hotel_id → uuid，保存为只追加的 JSONL 日志
+# uuid 由酒店的全部字段生成（generate_uuid5），字段不变 uuid 就不变，因此 uuid 同时就是内容哈希
+# 每批写入成功后追加记录并 fsync，导入中断后重新运行时从日志恢复，已写入的酒店不会再发送
+class SyncManifest:
+    def __init__(self, path):
+        self.path = path
+        self.uuids = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # 中断时写了一半的最后一行
+                    if entry["uuid"] is None:
+                        self.uuids.pop(entry["hotel_id"], None)
+                    else:
+                        self.uuids[entry["hotel_id"]] = entry["uuid"]
+        self.file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    # 用给定的映射覆盖清单（临时文件写完后原子替换）
+    def reset(self, uuids):
+        self.close()
+        self.uuids = dict(uuids)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for hotel_id, uuid in self.uuids.items():
+                f.write(json.dumps({"hotel_id": hotel_id, "uuid": uuid}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    # 追加一批记录；uuid 为 None 表示该酒店已从集合中删除
+    def record(self, entries):
+        if not entries:
+            return
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        for hotel_id, uuid in entries:
+            if uuid is None:
+                self.uuids.pop(hotel_id, None)
+            else:
+                self.uuids[hotel_id] = uuid
+            self.file.write(json.dumps({"hotel_id": hotel_id, "uuid": uuid}) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # 合并日志中的重复记录
+    def compact(self):
+        self.reset(self.uuids)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# cache：查询结果缓存（SearchCache），默认使用只在内存中的缓存
+# connect：创建客户端的工厂函数，默认为 connect_weaviate；客户端由连接池管理，第一次查询时才建立连接
+# pool_size：最多同时使用的连接数
+# hybrid：search 默认是否使用混合检索；hybrid_weights：混合检索中各路结果（facilities/name/address）的 RRF 权重
+# max_distance：词表外设施与排序字段同时出现时，与查询的余弦距离不超过该值的酒店视为匹配，再按排序字段取前 limit 个；
+#   合适的取值与向量化模型有关
 class HotelDB():
-    def __init__(self):
-        client = weaviate.connect_to_weaviate_cloud(
-            cluster_url="https://ipu4fofq3cudvfcc1ek7a.c0.asia-southeast1.gcp.weaviate.cloud",
-            auth_credentials=Auth.api_key(os.getenv("WEAVIATE_API_KEY")),
-            headers={
-                "X-OpenAI-Api-Key": os.getenv("OPENAI_API_KEY"),
-                "X-HuggingFace-Api-Key": os.getenv("HUGGINGFACE_API_KEY")},
-            additional_config=weaviate.config.AdditionalConfig(
-                timeout=weaviate.config.Timeout(init=10)
-            )
+    def __init__(self, cache=None, connect=None, pool_size=4, hybrid=False, hybrid_weights=None, max_distance=0.5):
+        self.pool = ClientPool(
+            connect or connect_weaviate, size=pool_size,
+            retry_on=(WeaviateConnectionError, WeaviateTimeoutError, WeaviateGRPCUnavailableError,
+                      ConnectionError, TimeoutError))
+        self._facility_index = None
+        self.hybrid = hybrid
+        self.hybrid_weights = hybrid_weights or {}
+        self.max_distance = max_distance
+        self.cache = cache if cache is not None else SearchCache()
+
+    # 设施位集索引，基于本地的 hotel.json 构建；文件不存在时返回 None，设施查询全部走向量检索
+    def facility_index(self):
+        if self._facility_index is None and os.path.exists("hotel.json"):
+            with open("hotel.json", "r", encoding="utf-8") as f:
+                hotels = json.load(f)
+            self._facility_index = (FacilityIndex(hotels), [hotel["hotel_id"] for hotel in hotels])
+        return self._facility_index
+
+    def close(self):
+        self.pool.close()
+
+    # 创建 Hotel Collection：只有 facilities 字段被向量化，_name/_address 按空白分词供 BM25 检索
+    @staticmethod
+    def _create_collection(client, name):
+        from weaviate.classes.config import Configure, Property, DataType, Tokenization
+
+        client.collections.create(
+            name=name,
+            description="hotel info",
+            # vectorizer_config=Configure.Vectorizer.text2vec_huggingface(
+            #     model="sentence-transformers/all-MiniLM-L6-v2",  # 免费、轻量、中文可用
+            #     wait_for_model=False,
+            #     use_gpu=False,
+            #     vectorize_collection_name=False,
+            # ),
+            vectorizer_config=Configure.Vectorizer.text2vec_huggingface(
+                model="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",  # 多语言，支持中文
+                wait_for_model=False,
+                use_gpu=False,
+                vectorize_collection_name=False,
+            ),
+            properties=[
+                # hotel_id
+                Property(
+                    name="hotel_id",
+                    data_type=DataType.INT,
+                    description="id of hotel"
+                ),
+                # _name（用于 BM25 搜索）
+                # BM25 逻辑是一种关键词（Keyword）匹配的评分算法，主要用于信息检索领域，是现代搜索引擎和文本数据库（如 Elasticsearch、Lucene）中广泛使用的一种相关性评分函数。
+                Property(
+                    name="_name",
+                    data_type=DataType.TEXT,
+                    description="name of hotel (tokenized for search)",
+                    index_filterable=True,
+                    index_searchable=True,
+                    tokenization=Tokenization.WHITESPACE,  # ✅ 修复点1
+                    # skip_vectorization=True,
+                ),
+                # name（原始值）
+                Property(
+                    name="name",
+                    data_type=DataType.TEXT,
+                    description="type of hotel",
+                    # skip_vectorization=True,
+                ),
+                # type
+                Property(
+                    name="type",
+                    data_type=DataType.TEXT,
+                    description="type of hotel",
+                    # skip_vectorization=True,
+                ),
+                # _address（用于 BM25 搜索）
+                Property(
+                    name="_address",
+                    data_type=DataType.TEXT,
+                    description="address of hotel (tokenized for search)",
+                    index_filterable=True,
+                    index_searchable=True,
+                    tokenization=Tokenization.WHITESPACE,  # ✅ 修复点1
+                    # skip_vectorization=True,
+                ),
+                # address（原始值）
+                Property(
+                    name="address",
+                    data_type=DataType.TEXT,
+                    description="type of hotel",
+                    # skip_vectorization=True,
+                ),
+                # subway
+                Property(
+                    name="subway",
+                    data_type=DataType.TEXT,
+                    description="nearby subway",
+                    # skip_vectorization=True,
+                ),
+                # phone
+                Property(
+                    name="phone",
+                    data_type=DataType.TEXT,
+                    description="phone of hotel",
+                    # skip_vectorization=True,
+                ),
+                # price
+                Property(
+                    name="price",
+                    data_type=DataType.NUMBER,
+                    description="price of hotel"
+                ),
+                # rating
+                Property(
+                    name="rating",
+                    data_type=DataType.NUMBER,
+                    description="rating of hotel"
+                ),
+                # facilities（唯一被向量化的文本字段）
+                Property(
+                    name="facilities",
+                    data_type=DataType.TEXT,
+                    description="facilities provided",
+                    index_filterable=True,
+                    index_searchable=True,
+                    skip_vectorization=False,  # 允许 OpenAI 向量化
+                ),
+            ]
         )
-        self.client = client
+        print(f"✅ Collection '{name}' 创建成功")
 
     def insert(self):
         """用 v4 方式创建 Hotel Collection 并导入数据"""
-        from weaviate.classes.config import Configure, Property, DataType, Tokenization
-
         collection_name = "Hotel"
 
-        # 使用上下文管理器确保连接关闭
-        with self.client as client:
+        with self.pool.client() as client:
             # 删除已存在的 Collection
             if client.collections.exists(collection_name):
                 print(f"⚠️ Collection '{collection_name}' 已存在，正在删除...")
                 client.collections.delete(collection_name)
 
-            # 创建新 Collection
-            client.collections.create(
-                name=collection_name,
-                description="hotel info",
-                # vectorizer_config=Configure.Vectorizer.text2vec_huggingface(
-                #     model="sentence-transformers/all-MiniLM-L6-v2",  # 免费、轻量、中文可用
-                #     wait_for_model=False,
-                #     use_gpu=False,
-                #     vectorize_collection_name=False,
-                # ),
-                vectorizer_config=Configure.Vectorizer.text2vec_huggingface(
-                    model="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",  # 多语言，支持中文
-                    wait_for_model=False,
-                    use_gpu=False,
-                    vectorize_collection_name=False,
-                ),
-                properties=[
-                    # hotel_id
-                    Property(
-                        name="hotel_id",
-                        data_type=DataType.INT,
-                        description="id of hotel"
-                    ),
-                    # _name（用于 BM25 搜索）
-                    # BM25 逻辑是一种关键词（Keyword）匹配的评分算法，主要用于信息检索领域，是现代搜索引擎和文本数据库（如 Elasticsearch、Lucene）中广泛使用的一种相关性评分函数。
-                    Property(
-                        name="_name",
-                        data_type=DataType.TEXT,
-                        description="name of hotel (tokenized for search)",
-                        index_filterable=True,
-                        index_searchable=True,
-                        tokenization=Tokenization.WHITESPACE,  # ✅ 修复点1
-                        # skip_vectorization=True,
-                    ),
-                    # name（原始值）
-                    Property(
-                        name="name",
-                        data_type=DataType.TEXT,
-                        description="type of hotel",
-                        # skip_vectorization=True,
-                    ),
-                    # type
-                    Property(
-                        name="type",
-                        data_type=DataType.TEXT,
-                        description="type of hotel",
-                        # skip_vectorization=True,
-                    ),
-                    # _address（用于 BM25 搜索）
-                    Property(
-                        name="_address",
-                        data_type=DataType.TEXT,
-                        description="address of hotel (tokenized for search)",
-                        index_filterable=True,
-                        index_searchable=True,
-                        tokenization=Tokenization.WHITESPACE,  # ✅ 修复点1
-                        # skip_vectorization=True,
-                    ),
-                    # address（原始值）
-                    Property(
-                        name="address",
-                        data_type=DataType.TEXT,
-                        description="type of hotel",
-                        # skip_vectorization=True,
-                    ),
-                    # subway
-                    Property(
-                        name="subway",
-                        data_type=DataType.TEXT,
-                        description="nearby subway",
-                        # skip_vectorization=True,
-                    ),
-                    # phone
-                    Property(
-                        name="phone",
-                        data_type=DataType.TEXT,
-                        description="phone of hotel",
-                        # skip_vectorization=True,
-                    ),
-                    # price
-                    Property(
-                        name="price",
-                        data_type=DataType.NUMBER,
-                        description="price of hotel"
-                    ),
-                    # rating
-                    Property(
-                        name="rating",
-                        data_type=DataType.NUMBER,
-                        description="rating of hotel"
-                    ),
-                    # facilities（唯一被向量化的文本字段）
-                    Property(
-                        name="facilities",
-                        data_type=DataType.TEXT,
-                        description="facilities provided",
-                        index_filterable=True,
-                        index_searchable=True,
-                        skip_vectorization=False,  # 允许 OpenAI 向量化
-                    ),
-                ]
-            )
-            print(f"✅ Collection '{collection_name}' 创建成功")
-
-            url = "https://raw.githubusercontent.com/hamburgerswang/hotel-chatbot/main/data/hotel.json"
-            if not os.path.exists("hotel.json"):
-                print("📥 正在下载 hotel.json...")
-                try:
-                    response = requests.get(url, timeout=30)  # 增加超时时间
-                    response.raise_for_status()
-                    with open("hotel.json", "w", encoding="utf-8") as f:
-                        json.dump(response.json(), f, ensure_ascii=False, indent=2)
-                    print("✅ 下载完成")
-                except Exception as e:
-                    print(f"❌ 下载失败: {e}")
-                    return  # 如果下载失败，提前退出，避免后续操作
-            else:
-                print("📁 hotel.json 已存在")
+            self._create_collection(client, collection_name)
+
+            if not download_catalog():
+                return  # 如果下载失败，提前退出，避免后续操作
 
             with open("hotel.json", "r", encoding="utf-8") as f:
                 hotels = json.load(f)
@@ -201,15 +355,144 @@ class HotelDB():
             else:
                 print("✅ 所有数据导入成功！")
 
-    def search(self, dsl, name="Hotel", limit=1):
-        # 清理 DSL
-        dsl = {k: v for k, v in dsl.items() if v is not None}
-        _limit = limit + 10
-        output_fields = ["hotel_id", "name", "type", "address", "phone", "subway", "facilities", "price", "rating"]
+        # 集合已重建，缓存的查询结果全部失效
+        self.cache.invalidate()
+        self._facility_index = None
 
-        collection = self.client.collections.get(name)
+    # 增量导入：流式读取 path，与清单中记录的 uuid 比较，只写入新增或字段有变化的酒店，删除已不在数据中的酒店
+    # 修改一家酒店的价格只需重新写入（并向量化）这一家，而不是像 insert() 那样重建整个集合
+    # manifest_path：导入清单，默认为 path 旁边的 <name>.manifest.jsonl；清单不存在时从集合中读出现有的 uuid 重建
+    # batch_size、concurrent_requests：每批的对象数和并行发送的批数
+    # 返回 {"inserted", "updated", "deleted", "unchanged", "failed"} 计数
+    def sync(self, path="hotel.json", name="Hotel", manifest_path=None, batch_size=100, concurrent_requests=4):
+        from weaviate.classes.query import Filter
+
+        if not download_catalog(path):
+            return None
+        if manifest_path is None:
+            manifest_path = os.path.join(os.path.dirname(os.path.abspath(path)), f"{name}.manifest.jsonl")
+        manifest = SyncManifest(manifest_path)
+        stats = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0, "failed": 0}
+
+        try:
+            with self.pool.client() as client:
+                if not client.collections.exists(name):
+                    self._create_collection(client, name)
+                    manifest.reset({})
+                elif not manifest.exists():
+                    print(f"📋 正在从集合 '{name}' 重建导入清单...")
+                    collection = client.collections.get(name)
+                    manifest.reset({obj.properties["hotel_id"]: str(obj.uuid)
+                                    for obj in collection.iterator(return_properties=["hotel_id"])})
+                collection = client.collections.get(name)
+
+                # 分批写入：先写入新对象，再删除同一酒店的旧对象，最后记入清单
+                # 在任意一步中断，重新运行时这一批都会被再次发送；写入和删除都按 uuid 进行，重复执行没有副作用
+                def flush(chunk):
+                    with collection.batch.fixed_size(batch_size=batch_size,
+                                                     concurrent_requests=concurrent_requests) as batch:
+                        for hotel, uuid, _ in chunk:
+                            batch.add_object(properties=hotel, uuid=uuid)
+                    failed = {str(obj.object_.uuid) for obj in collection.batch.failed_objects}
+                    if failed:
+                        print("⚠️ 写入失败:", collection.batch.failed_objects[0].message)
+                    chunk = [item for item in chunk if item[1] not in failed]
+                    stats["failed"] += len(failed)
+                    stale = [old_uuid for _, _, old_uuid in chunk if old_uuid is not None]
+                    if stale:
+                        collection.data.delete_many(where=Filter.by_id().contains_any(stale))
+                    manifest.record([(hotel["hotel_id"], uuid) for hotel, uuid, _ in chunk])
+                    stats["updated"] += len(stale)
+                    stats["inserted"] += len(chunk) - len(stale)
+
+                # 边读边与清单比较，需要写入的酒店每凑满 chunk_size 个就写入一批并记入清单，
+                # 内存中只保留当前这一批和已读到的 hotel_id（用于找出被删除的酒店）
+                chunk_size = batch_size * concurrent_requests
+                pending = []
+                seen = set()
+                for hotel in tqdm(iter_json_array(path), desc="导入进度"):
+                    hotel_id = hotel["hotel_id"]
+                    seen.add(hotel_id)
+                    uuid = weaviate.util.generate_uuid5(hotel, name)
+                    old_uuid = manifest.uuids.get(hotel_id)
+                    if old_uuid == uuid:
+                        stats["unchanged"] += 1
+                        continue
+                    pending.append((hotel, uuid, old_uuid))
+                    if len(pending) >= chunk_size:
+                        flush(pending)
+                        pending = []
+                if pending:
+                    flush(pending)
+                removed = [hotel_id for hotel_id in manifest.uuids if hotel_id not in seen]
+                del seen
+                print(f"🔄 {stats['inserted'] + stats['updated']} 条新增或修改，{stats['failed']} 条失败，"
+                      f"{len(removed)} 条删除，{stats['unchanged']} 条未变化")
+
+                for start in range(0, len(removed), chunk_size):
+                    chunk = removed[start:start + chunk_size]
+                    collection.data.delete_many(where=Filter.by_id().contains_any([manifest.uuids[i] for i in chunk]))
+                    manifest.record([(hotel_id, None) for hotel_id in chunk])
+                    stats["deleted"] += len(chunk)
+
+            manifest.compact()
+        finally:
+            manifest.close()
+        if stats["inserted"] or stats["updated"] or stats["deleted"]:
+            self.cache.invalidate()
+            self._facility_index = None
+        print(f"✅ 同步完成: {stats}")
+        return stats
+
+    # 规范化后的查询条件相同的请求直接返回缓存结果
+    # hybrid：为 True 时使用混合检索（见 hybrid_search），默认取构造时的设置
+    def search(self, dsl, name="Hotel", limit=1, hybrid=None):
+        hybrid = self.hybrid if hybrid is None else hybrid
+        key = json.dumps([name, limit, hybrid, canonical_dsl(dsl)], ensure_ascii=False)
+        if hybrid:
+            return self.cache.get_or_compute(key, lambda: self.hybrid_search(dsl, name, limit))
+        return self.cache.get_or_compute(
+            key, lambda: self.pool.run(lambda client: self._search(client, dsl, name, limit)))
+
+    # 批量检索，结果与逐个调用 search 相同，按输入顺序返回：
+    #   规范形式相同的查询只执行一次，并且同样经过结果缓存
+    #   过滤条件相同的查询共用一次 _build_filters 的结果（包括设施位集到 hotel_id 列表的转换）
+    #   各查询作为并发请求发出，由连接池分配到各个连接上（Weaviate 的查询接口没有一次提交多个检索的批量请求）
+    def search_many(self, dsls, name="Hotel", limit=1, hybrid=None):
+        return asyncio.run(self.search_many_async(dsls, name, limit, hybrid))
+
+    async def search_many_async(self, dsls, name="Hotel", limit=1, hybrid=None):
+        hybrid = self.hybrid if hybrid is None else hybrid
+        rows = {}
+        queries = {}
+        for i, dsl in enumerate(dsls):
+            dsl = {k: v for k, v in dsl.items() if v is not None}
+            key = json.dumps([name, limit, hybrid, canonical_dsl(dsl)], ensure_ascii=False)
+            rows.setdefault(key, []).append(i)
+            queries.setdefault(key, dsl)
+
+        prepared = {}
+        tasks = []
+        for key, dsl in queries.items():
+            predicate = canonical_dsl({k: v for k, v in dsl.items() if k in FILTER_SLOTS})
+            if predicate not in prepared:
+                prepared[predicate] = self._build_filters(dsl)
+            if hybrid:
+                compute = lambda dsl=dsl, p=prepared[predicate]: self.hybrid_search(dsl, name, limit, p)
+            else:
+                compute = lambda dsl=dsl, p=prepared[predicate]: self.pool.run(
+                    lambda client: self._search(client, dsl, name, limit, p))
+            tasks.append(asyncio.to_thread(self.cache.get_or_compute, key, compute))
+
+        results = [None] * len(dsls)
+        for indexes, result in zip(rows.values(), await asyncio.gather(*tasks)):
+            for n, i in enumerate(indexes):
+                results[i] = result if n == 0 else [dict(r) for r in result]
+        return results
 
-        # === 1. 构建 filters (v4) ===
+    # 结构化过滤条件，以及词表内设施的精确匹配（转为 hotel_id 过滤）
+    # 返回 (filters, 需要做向量检索的词表外设施)；精确匹配没有任何酒店时返回 None
+    def _build_filters(self, dsl):
         from weaviate.classes.query import Filter
         filters = None
 
@@ -228,80 +511,191 @@ class HotelDB():
             f = Filter.by_property("rating").less_than(dsl["rating_range_upper"])
             filters = f if filters is None else filters & f
 
-        candidates = []
+        # name 子串匹配下推为 _name 中完整分词的 contains_all 过滤（子串匹配的必要条件），结果再做精确的子串检查
+        if dsl.get("name"):
+            tokens = name_filter_tokens(dsl["name"])
+            if tokens:
+                f = Filter.by_property("_name").contains_all(tokens)
+                filters = f if filters is None else filters & f
 
-        # === 2. 向量搜索 (facilities) ===
-        if "facilities" in dsl and dsl["facilities"]:
-            query_text = "酒店提供：" + "，".join(dsl["facilities"])
-            res = collection.query.near_text(
-                query=query_text,
-                limit=_limit,
-                filters=filters,
-                return_properties=output_fields
-            )
-            candidates = [obj.properties for obj in res.objects]
-
-        # === 3. 关键词搜索 (name) ===
-        elif "name" in dsl and dsl["name"]:
-            import re
-            clean_name = " ".join(re.findall(r"[\w\-]+", dsl["name"]))
-            res = collection.query.bm25(
-                query=clean_name,
-                query_properties=["_name"],
-                limit=_limit,
-                filters=filters,
-                return_properties=output_fields
-            )
-            candidates = [obj.properties for obj in res.objects]
-
-        # === 4. 关键词搜索 (address) ===
-        elif "address" in dsl and dsl["address"]:
-            import re
-            clean_addr = " ".join(re.findall(r"[\w\-]+", dsl["address"]))
-            res = collection.query.bm25(
-                query=clean_addr,
-                query_properties=["_address"],
-                limit=_limit,
-                filters=filters,
-                return_properties=output_fields
-            )
-            candidates = [obj.properties for obj in res.objects]
-
-        # === 5. 纯结构化过滤 ===
-        else:
-            res = collection.query.fetch_objects(
-                limit=_limit,
-                filters=filters,
-                return_properties=output_fields
-            )
-            candidates = [obj.properties for obj in res.objects]
-
-        # === 6. 排序 ===
+        unknown = dsl.get("facilities") or []
+        index = self.facility_index()
+        if unknown and index is not None:
+            facility_index, hotel_ids = index
+            known, unknown = facility_index.split(unknown)
+            if known:
+                ids = [hotel_ids[i] for i in np.flatnonzero(facility_index.mask(known))]
+                if not ids:
+                    return None
+                f = Filter.by_property("hotel_id").contains_any(ids)
+                filters = f if filters is None else filters & f
+        return filters, unknown
+
+    # 以下为单路检索，返回属性字典列表
+    def _near_text(self, client, name, facilities, filters, limit, offset=None, distance=None):
+        res = client.collections.get(name).query.near_text(
+            query="酒店提供：" + "，".join(facilities),
+            limit=limit,
+            offset=offset,
+            distance=distance,
+            filters=filters,
+            return_properties=OUTPUT_FIELDS
+        )
+        return [obj.properties for obj in res.objects]
+
+    def _bm25(self, client, name, text, query_property, filters, limit, offset=None):
+        res = client.collections.get(name).query.bm25(
+            # _name/_address 按空格分词存储（逐字切分），查询文本也用同样的方式分词
+            query=" ".join(tokenize(text)),
+            query_properties=[query_property],
+            limit=limit,
+            offset=offset,
+            filters=filters,
+            return_properties=OUTPUT_FIELDS
+        )
+        return [obj.properties for obj in res.objects]
+
+    # 纯过滤查询，sort 为服务端排序（Sort.by_property）
+    def _fetch(self, client, name, filters, limit, offset=None, sort=None):
+        res = client.collections.get(name).query.fetch_objects(
+            limit=limit,
+            offset=offset,
+            filters=filters,
+            sort=sort,
+            return_properties=OUTPUT_FIELDS
+        )
+        return [obj.properties for obj in res.objects]
+
+    # 分页读取 fetch_page(offset, page_size) 的结果，只保留通过 name 精确子串检查的对象，凑满 limit 个为止
+    # 第一页只取 limit 个（name 过滤已下推，通常一页即可），之后每页大小翻倍；limit 为 None 时读完全部结果
+    @staticmethod
+    def _fetch_exact(fetch_page, dsl, limit, max_page_size=100):
+        results = []
+        offset = 0
+        page_size = limit or max_page_size
+        while limit is None or len(results) < limit:
+            page = fetch_page(offset, page_size)
+            results.extend(r for r in page if "name" not in dsl or dsl["name"] in r.get("name", ""))
+            if len(page) < page_size:
+                break
+            offset += len(page)
+            page_size = min(page_size * 2, max_page_size)
+        return results[:limit]
+
+    # 按 sort.slot 排序并做 name 子串过滤，取前 limit 个
+    @staticmethod
+    def _postprocess(candidates, dsl, limit):
         if "sort.slot" in dsl:
             reverse = dsl.get("sort.ordering") == "descend"
             slot = dsl["sort.slot"]
             candidates = sorted(candidates, key=lambda x: x.get(slot, 0), reverse=reverse)
 
-        # === 7. name 后过滤（子串匹配）===
         if "name" in dsl:
-            filtered = []
-            for r in candidates:
-                if dsl["name"] in r.get("name", ""):
-                    filtered.append(r)
-            candidates = filtered
+            candidates = [r for r in candidates if dsl["name"] in r.get("name", "")]
 
         return candidates[:limit]
 
+    # prepared：已构建好的 _build_filters(dsl) 结果（search_many 中过滤条件相同的查询共用），默认在此构建
+    def _search(self, client, dsl, name="Hotel", limit=1, prepared=False):
+        # 清理 DSL
+        dsl = {k: v for k, v in dsl.items() if v is not None}
+
+        # === 1. 构建 filters (v4)，name 已下推为过滤条件 ===
+        if prepared is False:
+            prepared = self._build_filters(dsl)
+        if prepared is None:
+            return []
+        filters, unknown = prepared
+        sort = None
+        if "sort.slot" in dsl:
+            from weaviate.classes.query import Sort
+            sort = Sort.by_property(dsl["sort.slot"], ascending=dsl.get("sort.ordering") != "descend")
+
+        # === 2. 按相关性排序的检索：词表外设施的向量搜索、name/address 的 BM25 ===
+        relevance = None
+        if "facilities" in dsl and dsl["facilities"]:
+            if unknown and sort is not None:
+                # 指定了排序字段时，距离不超过 max_distance 的酒店全部视为匹配：分页读完后按排序字段取前 limit 个
+                candidates = self._fetch_exact(
+                    lambda offset, n: self._near_text(client, name, unknown, filters, n, offset, self.max_distance),
+                    {}, None)
+                return self._postprocess(candidates, dsl, limit)
+            if unknown:
+                relevance = lambda offset, n: self._near_text(client, name, unknown, filters, n, offset)
+        elif "name" in dsl and dsl["name"]:
+            # 指定了排序字段时，name 过滤后的全部结果按该字段排序，走下面的纯过滤查询；
+            # 没有完整分词的 name（如 "itiGO"）BM25 一个也匹配不到，同样走纯过滤查询，逐个检查子串
+            if sort is None and name_filter_tokens(dsl["name"]):
+                relevance = lambda offset, n: self._bm25(client, name, dsl["name"], "_name", filters, n, offset)
+        elif "address" in dsl and dsl["address"]:
+            if sort is None:
+                relevance = lambda offset, n: self._bm25(client, name, dsl["address"], "_address", filters, n, offset)
+            else:
+                # 指定了排序字段时，BM25 能匹配到的酒店（包含任一地址分词）全部视为匹配，
+                # 分词下推为 _address 的 contains_any 过滤，走下面的纯过滤查询
+                from weaviate.classes.query import Filter
+                tokens = tokenize(dsl["address"])
+                if not tokens:
+                    return []
+                f = Filter.by_property("_address").contains_any(tokens)
+                filters = f if filters is None else filters & f
+
+        # === 3. 纯结构化过滤（含词表内设施、name、排序时的 address）：排序下推到服务端，分页取到精确的前 limit 个 ===
+        if relevance is None:
+            return self._fetch_exact(
+                lambda offset, n: self._fetch(client, name, filters, n, offset, sort), dsl, limit)
+
+        # === 4. 不排序的相关性检索：按相关性分页取前 limit 个 ===
+        return self._fetch_exact(relevance, dsl, limit)
+
+    # 混合检索：设施向量检索、name BM25、address BM25 中 DSL 涉及的各路检索并发执行（各自从连接池借用客户端），
+    # 结果用加权 RRF 融合，总耗时接近最慢的单路检索而不是各路之和
+    async def hybrid_search_async(self, dsl, name="Hotel", limit=1, prepared=False):
+        dsl = {k: v for k, v in dsl.items() if v is not None}
+        _limit = limit + 10
+        if prepared is False:
+            prepared = self._build_filters(dsl)
+        if prepared is None:
+            return []
+        filters, unknown = prepared
+
+        branches = {}
+        if unknown:
+            branches["facilities"] = lambda client: self._near_text(client, name, unknown, filters, _limit)
+        if dsl.get("name") and name_filter_tokens(dsl["name"]):
+            branches["name"] = lambda client: self._bm25(client, name, dsl["name"], "_name", filters, _limit)
+        if dsl.get("address"):
+            branches["address"] = lambda client: self._bm25(client, name, dsl["address"], "_address", filters, _limit)
+        if not branches:
+            # 没有相关性检索时不需要融合，按 search 的方式分页取精确的前 limit 个（name 子串检查可能要读多页）
+            return await asyncio.to_thread(self.pool.run, lambda client: self._search(client, dsl, name, limit, prepared))
+
+        rankings = await asyncio.gather(*(asyncio.to_thread(self.pool.run, fn) for fn in branches.values()))
+        weights = [self.hybrid_weights.get(kind, 1.0) for kind in branches]
+        candidates = rrf(list(rankings), weights=weights, top_k=_limit)
+        return self._postprocess(candidates, dsl, limit)
+
+    def hybrid_search(self, dsl, name="Hotel", limit=1, prepared=False):
+        return asyncio.run(self.hybrid_search_async(dsl, name, limit, prepared))
+
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild", action="store_true",
+                        help="drop and recreate the collection instead of syncing only the changed hotels")
+    args = parser.parse_args()
     db = HotelDB()
     try:
         # insert
-        db.insert()
+        if args.rebuild:
+            db.insert()
+        else:
+            db.sync()
         print("✅ 数据导入完成！")
         # 你的逻辑，比如 db.search(...)
         # result = db.search({"facilities": ["wifi"]}, limit=3)
         # print(json.dumps(result, ensure_ascii=False, indent=2))
     finally:
         # 确保连接被关闭
-        db.client.close()
+        db.close()
@@ -0,0 +1,164 @@
+import re
+import json
+import numpy as np
+
+FACILITIES_PREFIX = "酒店提供的设施:"
+
+# 设施词表：hotel.json 中出现的全部设施，外加几个由具体设施推出的概念（wifi 覆盖范围、游泳池、停车位等）
+# 每个概念对应 uint64 位集中的一位
+CONCEPTS = [
+    "24小时热水", "无烟房", "叫醒服务", "行李寄存", "宽带上网", "吹风机", "国际长途电话", "中式餐厅", "早餐服务",
+    "免费早餐", "会议室", "接待外宾", "洗衣服务", "商务中心", "残疾人设施", "西式餐厅", "接机服务", "暖气", "健身房",
+    "租车", "免费市内电话", "酒吧", "棋牌室", "接站服务", "游泳池", "室内游泳池", "室外游泳池", "桑拿", "SPA",
+    "停车位", "收费停车位", "免费国内长途电话", "看护小孩服务", "温泉",
+    "wifi", "公共区域wifi", "部分房间wifi", "所有房间wifi", "酒店各处wifi",
+]
+assert len(CONCEPTS) <= 64
+CONCEPT_BITS = {concept: 1 << i for i, concept in enumerate(CONCEPTS)}
+
+# 同义词：小写、去掉空白后的写法 → 概念列表
+SYNONYMS = {
+    "24小时供应热水": ["24小时热水"], "全天供应热水": ["24小时热水"], "全天都有热水": ["24小时热水"],
+    "全天候提供热水": ["24小时热水"], "热水": ["24小时热水"],
+    "提醒服务": ["叫醒服务"], "叫早服务": ["叫醒服务"], "叫醒": ["叫醒服务"],
+    "行李存放": ["行李寄存"], "寄存行李": ["行李寄存"],
+    "宽带": ["宽带上网"], "有线上网": ["宽带上网"],
+    "吹风器": ["吹风机"], "电吹风": ["吹风机"],
+    "国际电话服务": ["国际长途电话"], "国际电话": ["国际长途电话"], "国际电话机": ["国际长途电话"],
+    "全球电话": ["国际长途电话"], "国际通话": ["国际长途电话"], "国际长途": ["国际长途电话"],
+    "中餐厅": ["中式餐厅"], "西餐厅": ["西式餐厅"],
+    "早餐": ["早餐服务"], "供应早餐": ["早餐服务"], "供应早餐的服务": ["早餐服务"], "提供早餐": ["早餐服务"],
+    "早餐服务免费": ["免费早餐"], "早餐免费": ["免费早餐"],
+    "洗衣": ["洗衣服务"], "干洗": ["洗衣服务"],
+    "企业中心": ["商务中心"], "商务办公中心": ["商务中心"],
+    "无障碍设施": ["残疾人设施"],
+    "健身俱乐部": ["健身房"], "健身中心": ["健身房"],
+    "汽车租赁": ["租车"],
+    "市内通话免费": ["免费市内电话"], "市内电话免费": ["免费市内电话"],
+    "酒馆": ["酒吧"],
+    "泳池": ["游泳池"], "游泳池在室内": ["室内游泳池"], "室内泳池": ["室内游泳池"], "室外泳池": ["室外游泳池"],
+    "付费停车位": ["收费停车位"], "停车场": ["停车位"],
+    "托儿服务": ["看护小孩服务"],
+}
+
+# 具有某个概念的酒店同时具有的概念，构建酒店位集时展开
+IMPLIES = {
+    "免费早餐": ["早餐服务"],
+    "室内游泳池": ["游泳池"],
+    "室外游泳池": ["游泳池"],
+    "收费停车位": ["停车位"],
+    "酒店各处wifi": ["公共区域wifi", "部分房间wifi", "wifi"],
+    "所有房间wifi": ["部分房间wifi", "wifi"],
+    "公共区域wifi": ["wifi"],
+    "部分房间wifi": ["wifi"],
+}
+
+_LOWER_CONCEPTS = {concept.lower(): concept for concept in CONCEPTS}
+
+
+# 含 wifi/无线网络的设施按覆盖范围归一化，例如 "酒店各处提供wifi" → 酒店各处wifi，"公共区域和部分房间提供wifi" → 公共区域wifi + 部分房间wifi
+def _normalize_wifi(term):
+    if "各处" in term:
+        return ["酒店各处wifi"]
+    if re.search(r"所有(房间|客房)", term):
+        return ["所有房间wifi"]
+    concepts = []
+    if "公共区域" in term:
+        concepts.append("公共区域wifi")
+    if re.search(r"(部分|一些)(房间|客房)", term):
+        concepts.append("部分房间wifi")
+    return concepts or ["wifi"]
+
+
+# 把一个设施描述归一化为概念列表，不在词表中时返回 None
+# "a | b" 形式的备选写法取第一个能识别的
+def normalize_facility(term):
+    for alternative in term.split("|"):
+        key = re.sub(r"\s+", "", alternative).lower()
+        if not key:
+            continue
+        if key in _LOWER_CONCEPTS:
+            return [_LOWER_CONCEPTS[key]]
+        if key in SYNONYMS:
+            return SYNONYMS[key]
+        if "wifi" in key or "无线" in key:
+            return _normalize_wifi(key)
+    return None
+
+
+def _with_implied(concepts):
+    result = set()
+    stack = list(concepts)
+    while stack:
+        concept = stack.pop()
+        if concept not in result:
+            result.add(concept)
+            stack.extend(IMPLIES.get(concept, []))
+    return result
+
+
+# 一家酒店设施字段（"酒店提供的设施:a;b;c"）对应的位集
+def facility_bits(facilities):
+    bits = 0
+    for term in (facilities or "").replace(FACILITIES_PREFIX, "", 1).split(";"):
+        for concept in _with_implied(normalize_facility(term) or []):
+            bits |= CONCEPT_BITS[concept]
+    return bits
+
+
+# 设施位集索引：每家酒店一个 uint64，"同时提供 X、Y、Z" 的查询是一次向量化的按位与
+class FacilityIndex:
+    def __init__(self, hotels):
+        self.bits = np.asarray([facility_bits(h.get("facilities")) for h in hotels], dtype=np.uint64)
+
+    # 把查询中的设施分为 (词表内的概念列表, 词表外的原始描述列表)
+    @staticmethod
+    def split(facilities):
+        known = []
+        unknown = []
+        for term in facilities:
+            concepts = normalize_facility(term)
+            if concepts is None:
+                unknown.append(term)
+            else:
+                known.extend(concepts)
+        return known, unknown
+
+    # 同时具有全部概念的酒店位图
+    def mask(self, concepts):
+        required = 0
+        for concept in concepts:
+            required |= CONCEPT_BITS[concept]
+        required = np.uint64(required)
+        return (self.bits & required) == required
+
+
+# 统计测试集中 search 轮次的设施查询有多少可以完全走位集精确匹配
+def coverage_report(data_path):
+    queries = exact = terms = known_terms = 0
+    unknown = {}
+    with open(data_path, "r", encoding="utf-8") as f:
+        for line in f:
+            label = json.loads(json.loads(line)["response"])
+            if label["role"] != "search" or not label["arguments"].get("facilities"):
+                continue
+            facilities = label["arguments"]["facilities"]
+            queries += 1
+            terms += len(facilities)
+            _, missing = FacilityIndex.split(facilities)
+            known_terms += len(facilities) - len(missing)
+            exact += int(not missing)
+            for term in missing:
+                unknown[term] = unknown.get(term, 0) + 1
+    return {"queries": queries, "exact": exact, "terms": terms, "known_terms": known_terms, "unknown": unknown}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", type=str, default="../data/test.jsonl")
+    args = parser.parse_args()
+    report = coverage_report(args.data)
+    print(f"{report['exact']}/{report['queries']} facilities queries take the exact bitset path "
+          f"({report['known_terms']}/{report['terms']} terms in vocabulary)")
+    print(f"out of vocabulary: {report['unknown']}")
@@ -0,0 +1,319 @@
+import re
+import json
+import numpy as np
+from vector_index import IVFIndex, load_vector_index
+from facilities import FACILITIES_PREFIX, FacilityIndex
+from search_cache import canonical_dsl
+
+OUTPUT_FIELDS = ["hotel_id", "name", "type", "address", "phone", "subway", "facilities", "price", "rating"]
+
+
+# 与 hotel.json 中 _name/_address 相同的分词方式：连续的字母数字（含 -）为一个词，其余文字逐字切分，标点丢弃
+def tokenize(text):
+    return re.findall(r"[A-Za-z0-9\-]+|[^\W_]", text)
+
+
+# name 子串匹配可以下推的分词：包含 text 的名称一定包含这些词
+# 位于 text 开头或结尾的字母数字串可能只是名称中某个词的一部分（"W万豪酒店" 中的 W 来自 "JW"），不能下推；
+# 两侧在 text 内都有其他字符时，名称中的同一个串两侧也是这些字符，它就是一个完整的词
+def name_filter_tokens(text):
+    tokens = []
+    for match in re.finditer(r"(?P<run>[A-Za-z0-9\-]+)|[^\W_]", text):
+        if match.group("run") and (match.start() == 0 or match.end() == len(text)):
+            continue
+        tokens.append(match.group())
+    return tokens
+
+
+# BM25 倒排索引：每个词对应 (文档下标数组, 词频数组)，参数与 Weaviate 默认值相同
+class BM25Index:
+    def __init__(self, docs, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(docs)
+        self.doc_lengths = np.asarray([len(tokens) for tokens in docs], dtype=np.float64)
+        avg_length = self.doc_lengths.mean() if self.num_docs and self.doc_lengths.sum() > 0 else 1.0
+        postings = {}
+        for i, tokens in enumerate(docs):
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[i] = counts.get(i, 0) + 1
+        self.postings = {}
+        # 文档长度归一化项与查询无关，提前算好
+        norm = k1 * (1 - b + b * self.doc_lengths / avg_length)
+        for token, counts in postings.items():
+            ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            tf = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+            idf = np.log(1 + (self.num_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.postings[token] = (ids, idf * tf * (k1 + 1) / (tf + norm[ids]))
+
+    # 包含全部查询词的文档位图
+    def contains_all(self, tokens):
+        mask = np.ones(self.num_docs, dtype=bool)
+        for token in set(tokens):
+            posting = np.zeros(self.num_docs, dtype=bool)
+            if token in self.postings:
+                posting[self.postings[token][0]] = True
+            mask &= posting
+        return mask
+
+    # 每个文档对查询词的 BM25 得分，查询中重复的词只计一次
+    def scores(self, tokens):
+        scores = np.zeros(self.num_docs, dtype=np.float64)
+        for token in set(tokens):
+            if token in self.postings:
+                ids, weights = self.postings[token]
+                scores[ids] += weights
+        return scores
+
+
+# 进程内的酒店检索引擎，与 db_client.HotelDB.search 的接口和语义相同，不需要网络：
+#   price/rating 保存为 NumPy 列并预先排序，范围过滤用二分查找得到候选集合
+#   type 的每个取值对应一个布尔位图
+#   name/address 使用 BM25 倒排索引（基于 _name/_address 字段的分词）
+#   facilities 中词表内的设施用位集精确过滤（见 facilities.py），只有词表外的设施才做模糊检索：
+#   给定 embedder 时使用本地向量索引（见 vector_index.py），否则对设施文本做同样的关键词检索
+# vector_cache_dir：设施向量矩阵的缓存目录；ivf_nlist：设置后使用 IVF 索引代替暴力检索
+# max_distance：与 HotelDB 相同，向量检索与排序字段同时使用时，余弦距离不超过该值的酒店视为匹配
+class LocalHotelDB():
+    def __init__(self, path="hotel.json", hotels=None, embedder=None, vector_cache_dir=None,
+                 vector_dtype=np.float32, ivf_nlist=None, max_distance=0.5):
+        if hotels is None:
+            with open(path, "r", encoding="utf-8") as f:
+                hotels = json.load(f)
+        self.embedder = embedder
+        self.vector_cache_dir = vector_cache_dir
+        self.vector_dtype = vector_dtype
+        self.ivf_nlist = ivf_nlist
+        self.max_distance = max_distance
+        self.load(hotels)
+
+    # 根据酒店列表重建全部索引
+    def load(self, hotels):
+        self.hotels = [{k: hotel.get(k) for k in OUTPUT_FIELDS} for hotel in hotels]
+        self.size = len(hotels)
+        self.price = np.asarray([np.nan if h.get("price") is None else h["price"] for h in hotels], dtype=np.float64)
+        self.rating = np.asarray([np.nan if h.get("rating") is None else h["rating"] for h in hotels], dtype=np.float64)
+        # 排序后的取值和对应的下标，NaN 排在最后，不会落入任何范围
+        self.price_order = np.argsort(self.price, kind="stable")
+        self.price_sorted = self.price[self.price_order]
+        self.rating_order = np.argsort(self.rating, kind="stable")
+        self.rating_sorted = self.rating[self.rating_order]
+        # 按 sort.slot 排序时使用的预排序下标：降序同样是稳定排序（同值保持原顺序），NaN 都排在最后
+        self.sort_orders = {
+            ("price", False): self.price_order,
+            ("price", True): np.argsort(-self.price, kind="stable"),
+            ("rating", False): self.rating_order,
+            ("rating", True): np.argsort(-self.rating, kind="stable"),
+        }
+        self.type_bitmaps = {}
+        for i, hotel in enumerate(hotels):
+            bitmap = self.type_bitmaps.setdefault(hotel.get("type"), np.zeros(self.size, dtype=bool))
+            bitmap[i] = True
+        self.name_index = BM25Index([h.get("_name", "").split() for h in hotels])
+        self.address_index = BM25Index([h.get("_address", "").split() for h in hotels])
+        self.facility_bitsets = FacilityIndex(hotels)
+        self.facilities_index = BM25Index(
+            [tokenize((h.get("facilities") or "").replace(FACILITIES_PREFIX, "", 1)) for h in hotels])
+        self.facilities_vectors = None
+        if self.embedder is not None:
+            self.facilities_vectors = load_vector_index(
+                self.embedder, [h.get("facilities") or "" for h in hotels], self.vector_cache_dir, self.vector_dtype)
+            if self.ivf_nlist:
+                self.facilities_vectors = IVFIndex(self.facilities_vectors.vectors, nlist=self.ivf_nlist)
+
+    # 开区间 (lower, upper) 内的文档位图
+    def _range_mask(self, order, values, lower, upper):
+        start = 0 if lower is None else np.searchsorted(values, lower, side="right")
+        end = np.searchsorted(values, np.inf, side="right") if upper is None else np.searchsorted(values, upper, side="left")
+        mask = np.zeros(self.size, dtype=bool)
+        mask[order[start:end]] = True
+        return mask
+
+    # 一个查询中的各个过滤条件，作为合并相同条件的键：结构化过滤、name 分词的 contains_all、词表内设施的位集过滤
+    def _predicates(self, dsl):
+        predicates = []
+        if "type" in dsl:
+            predicates.append(("type", dsl["type"]))
+        if "price_range_lower" in dsl or "price_range_upper" in dsl:
+            predicates.append(("price", dsl.get("price_range_lower"), dsl.get("price_range_upper")))
+        if "rating_range_lower" in dsl or "rating_range_upper" in dsl:
+            predicates.append(("rating", dsl.get("rating_range_lower"), dsl.get("rating_range_upper")))
+        # name 子串匹配的必要条件（包含全部完整的分词）作为过滤位图，与远程查询的下推方式相同
+        if dsl.get("name"):
+            tokens = name_filter_tokens(dsl["name"])
+            if tokens:
+                predicates.append(("name", tuple(sorted(set(tokens)))))
+        if dsl.get("facilities"):
+            known, _ = self.facility_bitsets.split(dsl["facilities"])
+            if known:
+                predicates.append(("facilities", tuple(sorted(set(known)))))
+        return predicates
+
+    # 单个过滤条件的位图，与远程查询一样使用严格的大于/小于
+    def _predicate_mask(self, predicate):
+        kind = predicate[0]
+        if kind == "type":
+            return self.type_bitmaps.get(predicate[1], np.zeros(self.size, dtype=bool))
+        if kind == "price":
+            return self._range_mask(self.price_order, self.price_sorted, *predicate[1:])
+        if kind == "rating":
+            return self._range_mask(self.rating_order, self.rating_sorted, *predicate[1:])
+        if kind == "name":
+            return self.name_index.contains_all(predicate[1])
+        return self.facility_bitsets.mask(predicate[1])
+
+    # 一个查询的过滤位图
+    def filter_mask(self, dsl):
+        mask = np.ones(self.size, dtype=bool)
+        for predicate in self._predicates(dsl):
+            mask &= self._predicate_mask(predicate)
+        return mask
+
+    # 一批查询的过滤位图，每行对应一个查询；多个查询中取值相同的过滤条件只计算一次，再与到所有用到它的行上
+    def filter_masks(self, dsls):
+        masks = np.ones((len(dsls), self.size), dtype=bool)
+        rows = {}
+        for row, dsl in enumerate(dsls):
+            for predicate in self._predicates(dsl):
+                rows.setdefault(predicate, []).append(row)
+        for predicate, predicate_rows in rows.items():
+            mask = self._predicate_mask(predicate)
+            for row in predicate_rows:
+                masks[row] &= mask
+        return masks
+
+    # 按得分从高到低取前 k 个得分大于 0 的文档，同分时按下标排序
+    @staticmethod
+    def _top_k(scores, mask, k):
+        if mask is not None:
+            scores = np.where(mask, scores, 0.0)
+        hits = np.flatnonzero(scores > 0)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        return hits[np.lexsort((hits, -scores[hits]))]
+
+    # 按顺序检查候选文档的 name 子串，取前 limit 个
+    def _take(self, hits, dsl, limit):
+        results = []
+        for i in hits:
+            hotel = self.hotels[i]
+            if "name" not in dsl or dsl["name"] in hotel.get("name", ""):
+                results.append(dict(hotel))
+                if len(results) == limit:
+                    break
+        return results
+
+    def search(self, dsl, name="Hotel", limit=1):
+        dsl = {k: v for k, v in dsl.items() if v is not None}
+        mask = self.filter_mask(dsl)
+        kind = self._relevance_kind(dsl)
+        query_vectors = {}
+        if kind is not None and kind[0] == "vector":
+            query_vectors[kind[1]] = self.embedder.embed([kind[1]])[0]
+        return self._search(dsl, mask, self._relevance(kind, mask, query_vectors, {}, "sort.slot" in dsl), limit)
+
+    # 批量检索，结果与逐个调用 search 相同，按输入顺序返回：
+    #   规范形式相同的查询只执行一次
+    #   全部查询的过滤位图一次算出（相同的过滤条件合并，见 filter_masks）
+    #   按检索方式分组：相同文本的 BM25 得分只算一次，词表外设施的查询文本一次性批量向量化
+    def search_many(self, dsls, name="Hotel", limit=1):
+        rows = {}
+        for i, dsl in enumerate(dsls):
+            rows.setdefault(canonical_dsl(dsl), []).append(i)
+        queries = [{k: v for k, v in dsls[indexes[0]].items() if v is not None} for indexes in rows.values()]
+        masks = self.filter_masks(queries)
+
+        # 需要相关性排序的查询：(检索方式, 查询文本)，与 search 中的优先级相同
+        kinds = [self._relevance_kind(dsl) for dsl in queries]
+        query_vectors = {}
+        texts = sorted({kind[1] for kind in kinds if kind is not None and kind[0] == "vector"})
+        if texts:
+            query_vectors = dict(zip(texts, self.embedder.embed(texts)))
+        scores = {}
+
+        results = [None] * len(dsls)
+        for dsl, mask, kind, indexes in zip(queries, masks, kinds, rows.values()):
+            result = self._search(dsl, mask, self._relevance(kind, mask, query_vectors, scores, "sort.slot" in dsl), limit)
+            for n, i in enumerate(indexes):
+                results[i] = result if n == 0 else [dict(r) for r in result]
+        return results
+
+    # 查询的相关性检索方式及其查询文本，纯结构化过滤（含词表内设施、按排序字段取 name 过滤结果）时返回 None
+    # 词表外设施给定 embedder 时走向量索引，否则对设施文本做关键词检索
+    def _relevance_kind(self, dsl):
+        if dsl.get("facilities"):
+            _, unknown = self.facility_bitsets.split(dsl["facilities"])
+            if not unknown:
+                return None
+            if self.facilities_vectors is not None:
+                return "vector", "酒店提供：" + "，".join(unknown)
+            return "facilities", "，".join(unknown)
+        if dsl.get("name"):
+            # 没有完整分词的 name 按 BM25 得不到任何候选，与指定了排序字段时一样只做过滤
+            return None if "sort.slot" in dsl or not name_filter_tokens(dsl["name"]) else ("name", dsl["name"])
+        if dsl.get("address"):
+            return "address", dsl["address"]
+        return None
+
+    # 相关性检索，返回 mask 内全部有得分的文档（按得分从高到低）；query_vectors 为查询文本的向量，
+    # scores 缓存同一批查询中已算过的 BM25 得分；cutoff 时向量检索只返回余弦距离不超过 max_distance 的文档
+    def _relevance(self, kind, mask, query_vectors, scores, cutoff=False):
+        if kind is None:
+            return None
+        if kind[0] == "vector":
+            def vector_hits():
+                hits, similarities = self.facilities_vectors.search(query_vectors[kind[1]], self.size, mask)
+                return hits[1 - similarities <= self.max_distance] if cutoff else hits
+            return vector_hits
+        if kind not in scores:
+            index = {"facilities": self.facilities_index, "name": self.name_index, "address": self.address_index}[kind[0]]
+            scores[kind] = index.scores(tokenize(kind[1]))
+        return lambda: self._top_k(scores[kind], mask, self.size)
+
+    # 执行一个查询：mask 为全部过滤条件的位图，relevance() 返回 mask 内全部有得分的文档（按得分从高到低）
+    def _search(self, dsl, mask, relevance, limit):
+        sort_slot = dsl.get("sort.slot")
+        descend = dsl.get("sort.ordering") == "descend"
+        if relevance is not None:
+            # 相关性检索：不排序时按得分顺序取；排序时与远程查询一致，全部匹配的文档（BM25 得分大于 0，
+            # 向量检索距离不超过 max_distance）都是候选，与纯结构化过滤一样按排序字段取精确的前 limit 个
+            hits = relevance()
+            if sort_slot is None:
+                return self._take(hits, dsl, limit)
+            mask = np.zeros(self.size, dtype=bool)
+            mask[hits] = True
+
+        # 纯结构化过滤：有排序字段时沿预排序下标依次取 mask 内的文档，得到精确的前 limit 个
+        if sort_slot is None:
+            hits = np.flatnonzero(mask)
+        elif (sort_slot, descend) in self.sort_orders:
+            order = self.sort_orders[(sort_slot, descend)]
+            hits = order[mask[order]]
+        else:
+            hits = sorted(np.flatnonzero(mask), key=lambda i: self.hotels[i].get(sort_slot, 0), reverse=descend)
+        return self._take(hits, dsl, limit)
+
+    # 与 HotelDB 接口保持一致，没有需要释放的连接
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    import time
+    start = time.perf_counter()
+    db = LocalHotelDB()
+    print(f"built index over {db.size} hotels in {(time.perf_counter() - start) * 1000:.1f} ms")
+    queries = [
+        {"type": "豪华型", "price_range_upper": 1000},
+        {"rating_range_lower": 4.5, "sort.slot": "price", "sort.ordering": "ascend"},
+        {"name": "北京贵都大酒店"},
+        {"address": "西城区广安门", "type": "高档型"},
+        {"facilities": ["wifi", "叫醒服务"], "price_range_lower": 300},
+    ]
+    for dsl in queries:
+        start = time.perf_counter()
+        for _ in range(1000):
+            result = db.search(dsl, limit=3)
+        elapsed = (time.perf_counter() - start) / 1000 * 1e6
+        print(f"{elapsed:8.1f} us  {json.dumps(dsl, ensure_ascii=False)} -> {[r['name'] for r in result]}")
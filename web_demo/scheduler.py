@@ -0,0 +1,345 @@
+import time
+import queue
+import threading
+from collections import deque
+import torch
+from transformers import DynamicCache
+from streaming import IncrementalDecoder, STOP_STRINGS
+
+
+# 调度器中的一个生成请求；迭代时依次返回新生成的文本片段，stats() 给出首 token 延迟、token 数和解码速度
+# cancel() 之后调度器在下一步把它移出 batch，迭代随即结束
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens, decoder, session=None):
+        self.prompt_ids = prompt_ids
+        self.session = session
+        self.max_new_tokens = max_new_tokens
+        self.decoder = decoder
+        self.queue = queue.Queue()
+        self.cancelled = False
+        self.error = None
+        self.start = time.perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self.num_tokens = 0
+        # 调度器内部状态：prefill 之后、并入解码 batch 之前每层的 (key, value)，形状为 (1, heads, length, head_dim)；
+        # 序列的长度（KV cache 覆盖的 token 数），以及下一步的输入 token
+        self.past = None
+        self.length = 0
+        self.next_token = None
+        # 从前缀 KV cache 中复用的提示 token 数
+        self.reused = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        if self.first_token_time is None:
+            return {"ttft": None, "tokens": 0, "decode_seconds": 0.0, "tokens_per_second": 0.0,
+                    "prefill_tokens": 0, "reused_tokens": self.reused}
+        decode_seconds = (self.end_time or time.perf_counter()) - self.first_token_time
+        return {
+            "ttft": self.first_token_time - self.start,
+            "prefill_tokens": len(self.prompt_ids) - self.reused,
+            "reused_tokens": self.reused,
+            "tokens": self.num_tokens,
+            "decode_seconds": decode_seconds,
+            "tokens_per_second": (self.num_tokens - 1) / decode_seconds if decode_seconds > 0 else 0.0,
+        }
+
+
+# 解码 batch 的 KV cache：每层一块预先分配的 (batch, heads, capacity, head_dim) 缓冲区，各行左填充对齐到同一宽度
+# 模型每一步只把新 token 的 key/value 写入缓冲区末尾，返回前 width 个位置的视图，不再拼接整个 cache；
+# 容量不够时按 1.5 倍扩容，均摊下来每个 token 的复制量与上下文长度无关
+class BatchKVCache(DynamicCache):
+    def __init__(self, keys, values, width):
+        super().__init__()
+        self.key_buffers = keys
+        self.value_buffers = values
+        self.key_cache = [k[:, :, :width] for k in keys]
+        self.value_cache = [v[:, :, :width] for v in values]
+        self._seen_tokens = width
+
+    @property
+    def width(self):
+        return self.key_cache[0].shape[2]
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[2]
+        start = self.key_cache[layer_idx].shape[2]
+        end = start + key_states.shape[2]
+        if end > self.key_buffers[layer_idx].shape[2]:
+            self.key_buffers[layer_idx] = self._grow(self.key_buffers[layer_idx], start, end)
+            self.value_buffers[layer_idx] = self._grow(self.value_buffers[layer_idx], start, end)
+        self.key_buffers[layer_idx][:, :, start:end] = key_states
+        self.value_buffers[layer_idx][:, :, start:end] = value_states
+        self.key_cache[layer_idx] = self.key_buffers[layer_idx][:, :, :end]
+        self.value_cache[layer_idx] = self.value_buffers[layer_idx][:, :, :end]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    @staticmethod
+    def _grow(buffer, used, needed):
+        capacity = max(needed, buffer.shape[2] + buffer.shape[2] // 2)
+        grown = buffer.new_zeros(buffer.shape[:2] + (capacity,) + buffer.shape[3:])
+        grown[:, :, :used] = buffer[:, :, :used]
+        return grown
+
+
+# 连续批处理的推理调度器：多个会话的请求共用同一个模型，在后台线程中按 token 粒度调度
+#   每一步先把新到的请求（最多凑满 max_batch_size）左填充后一起 prefill，再把所有进行中的序列合成一个 batch 解码一个 token
+#   进行中的序列共用一个 BatchKVCache，各行左填充到相同宽度，用 attention_mask 屏蔽填充、用 position_ids 给出各自的位置
+#   只有序列加入或离开 batch 时才重新填充、拼接 cache；其余每一步只追加新 token 的 key/value
+#   序列生成出停止 token/停止串、达到长度上限或被取消时立即离开 batch，空出的位置在下一步由等待中的请求补上
+# prefix_cache：PrefixKVCache，提交时指定了 session 的请求只 prefill 与该会话已缓存前缀不同的部分，结束后把 KV cache 存回
+# 只做贪心解码，与 Evaluator 的生成配置相同
+class InferenceScheduler:
+    def __init__(self, model, tokenizer, max_batch_size=8, stop=STOP_STRINGS, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.stop = stop
+        self.device = model.device
+        self.stop_token_ids = {tokenizer.convert_tokens_to_ids("<|im_end|>")}
+        if tokenizer.eos_token_id is not None:
+            self.stop_token_ids.add(tokenizer.eos_token_id)
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.waiting = deque()
+        # 解码 batch 中的序列，顺序与 self.batch 的行一致
+        self.running = []
+        self.batch = None
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stats = {"steps": 0, "prefill_batches": 0, "prefill_tokens": 0, "reused_tokens": 0, "decode_tokens": 0,
+                      "max_running": 0}
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    # 提交一个提示，返回 GenerationRequest；session 为会话标识，用于复用该会话上一轮的 KV cache
+    def submit(self, prompt, max_new_tokens=1024, session=None):
+        prompt_ids = self.tokenizer(prompt, add_special_tokens=False)["input_ids"]
+        request = GenerationRequest(prompt_ids, max_new_tokens, IncrementalDecoder(self.tokenizer, self.stop), session)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("scheduler is closed")
+            self.waiting.append(request)
+            self.condition.notify()
+        return request
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.closed and not self.waiting and not self.running:
+                    self.condition.wait()
+                if self.closed:
+                    pending = list(self.waiting) + self.running
+                    self.waiting.clear()
+                    break
+                joining = []
+                while self.waiting and len(self.running) + len(joining) < self.max_batch_size:
+                    request = self.waiting.popleft()
+                    if request.cancelled:
+                        self._finish(request)
+                    else:
+                        joining.append(request)
+            try:
+                with torch.no_grad():
+                    if joining:
+                        self._prefill(joining)
+                    self._rebatch([r for r in self.running if not self._done(r)],
+                                  [r for r in joining if not self._done(r)])
+                    if self.running:
+                        self._decode(self.running)
+                        self._rebatch([r for r in self.running if not self._done(r)], [])
+            except Exception as e:
+                # 出错时结束当前 batch 中的全部请求（包括 prefill 失败、还没加入 running 的请求），调度器继续服务之后的请求
+                for request in self.running + [r for r in joining if r not in self.running]:
+                    request.error = e
+                    self._finish(request)
+                self.running = []
+                self.batch = None
+            self.stats["steps"] += 1
+        for request in pending:
+            request.cancelled = True
+            self._finish(request)
+
+    # 判断序列是否结束，结束时输出剩余文本并通知迭代方
+    def _done(self, request):
+        if request.cancelled or request.decoder.stopped or request.num_tokens >= request.max_new_tokens \
+                or (request.num_tokens and request.next_token in self.stop_token_ids):
+            self._finish(request)
+            return True
+        return False
+
+    def _finish(self, request):
+        request.end_time = time.perf_counter()
+        # KV cache 覆盖提示和除最后一个以外的生成 token，存入前缀缓存供同一会话的下一次请求使用
+        if self.prefix_cache is not None and request.session is not None and request.error is None:
+            past = self._request_past(request)
+            if past is not None:
+                ids = (request.prompt_ids + request.decoder.ids)[:request.length]
+                self.prefix_cache.store(request.session, ids, past)
+        request.past = None
+        chunk = request.decoder.finish()
+        if chunk:
+            request.queue.put(chunk)
+        request.queue.put(None)
+
+    # 序列自己的 KV cache：还没并入 batch 时为 request.past，否则取 batch 中它那一行去掉左填充的部分
+    def _request_past(self, request):
+        if request.past is not None or self.batch is None or request not in self.running:
+            return request.past
+        row = self.running.index(request)
+        width = self.batch.width
+        return [(k[row:row + 1, :, width - request.length:], v[row:row + 1, :, width - request.length:])
+                for k, v in zip(self.batch.key_cache, self.batch.value_cache)]
+
+    # batch 的成员变为 staying（原有序列中留下的，保持原顺序）加上 joining（刚 prefill 完的序列）
+    # 成员不变时什么也不做；否则按新的最大长度重新左填充，并预留 reserve 个位置供之后的解码步写入
+    def _rebatch(self, staying, joining, reserve=64):
+        if not joining and len(staying) == len(self.running):
+            return
+        requests = staying + joining
+        if not requests:
+            self.running = []
+            self.batch = None
+            return
+        width = max(r.length for r in requests)
+        rows = [self.running.index(r) for r in staying]
+        template = self.batch.key_cache if self.batch is not None else [k for k, _ in joining[0].past]
+        keys, values = [], []
+        for layer in range(len(template)):
+            shape = template[layer].shape
+            k = template[layer].new_zeros((len(requests), shape[1], width + reserve, shape[3]))
+            v = template[layer].new_zeros((len(requests), shape[1], width + reserve, shape[3]))
+            if rows:
+                # 留下的序列都不长于 width，取旧 batch 中最后 keep 个位置即可
+                keep = min(width, self.batch.width)
+                index = torch.tensor(rows, device=k.device)
+                k[:len(rows), :, width - keep:width] = self.batch.key_cache[layer].index_select(0, index)[:, :, -keep:]
+                v[:len(rows), :, width - keep:width] = self.batch.value_cache[layer].index_select(0, index)[:, :, -keep:]
+            for row, request in enumerate(joining, len(rows)):
+                k[row, :, width - request.length:width] = request.past[layer][0][0]
+                v[row, :, width - request.length:width] = request.past[layer][1][0]
+            keys.append(k)
+            values.append(v)
+        for request in joining:
+            request.past = None
+        self.running = requests
+        self.batch = BatchKVCache(keys, values, width)
+        self.stats["max_running"] = max(self.stats["max_running"], len(requests))
+
+    # 接收一个新生成的 token
+    def _emit(self, request, token, now):
+        if request.first_token_time is None:
+            request.first_token_time = now
+        request.num_tokens += 1
+        request.next_token = token
+        chunk = request.decoder.push([token])
+        if chunk:
+            request.queue.put(chunk)
+
+    # 新加入的请求一起 prefill，得到各自的 KV cache 和第一个生成的 token
+    # 命中前缀缓存的请求只输入未缓存的后缀：已缓存的 KV 左填充到相同长度 P 放在前面，后缀左填充到相同长度 S 放在后面，
+    # attention_mask 屏蔽两段各自的填充，position_ids 从各自已缓存的长度开始
+    def _prefill(self, requests):
+        cached = []
+        for request in requests:
+            reused, past = 0, None
+            if self.prefix_cache is not None and request.session is not None:
+                reused, past = self.prefix_cache.lookup(request.session, request.prompt_ids,
+                                                        limit=len(request.prompt_ids) - 1)
+            request.reused = reused
+            cached.append(past)
+        past_length = max(r.reused for r in requests)
+        suffix_length = max(len(r.prompt_ids) - r.reused for r in requests)
+        input_ids = torch.full((len(requests), suffix_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), past_length + suffix_length), dtype=torch.long)
+        position_ids = torch.zeros((len(requests), suffix_length), dtype=torch.long)
+        for row, request in enumerate(requests):
+            suffix = request.prompt_ids[request.reused:]
+            input_ids[row, suffix_length - len(suffix):] = torch.tensor(suffix)
+            attention_mask[row, past_length - request.reused:past_length] = 1
+            attention_mask[row, past_length + suffix_length - len(suffix):] = 1
+            position_ids[row, suffix_length - len(suffix):] = torch.arange(request.reused, len(request.prompt_ids))
+        past_key_values = None
+        if past_length:
+            template = next(p for p in cached if p is not None)
+            past_key_values = tuple(self._pad_left([p[layer] if p is not None else None for p in cached],
+                                                   [r.reused for r in requests], past_length, template[layer])
+                                    for layer in range(len(template)))
+        outputs = self.model(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device),
+                             position_ids=position_ids.to(self.device), past_key_values=past_key_values,
+                             use_cache=True)
+        tokens = outputs.logits[:, -1, :].argmax(-1).tolist()
+        past = self._legacy(outputs.past_key_values)
+        now = time.perf_counter()
+        for row, request in enumerate(requests):
+            suffix = len(request.prompt_ids) - request.reused
+            request.past = [self._unpad(k, v, row, past_length, request.reused, suffix) for k, v in past]
+            request.length = len(request.prompt_ids)
+            self._emit(request, tokens[row], now)
+        self.stats["prefill_batches"] += 1
+        self.stats["prefill_tokens"] += sum(len(r.prompt_ids) - r.reused for r in requests)
+        self.stats["reused_tokens"] += sum(r.reused for r in requests)
+
+    # 把各序列同一层的 (key, value) 左填充到 length 后拼成一个 batch；kv 为 None 的序列（长度为 0）整段填充
+    @staticmethod
+    def _pad_left(kvs, lengths, length, template):
+        keys, values = [], []
+        for kv, n in zip(kvs, lengths):
+            k, v = kv if kv is not None else (template[0][:, :, :0], template[1][:, :, :0])
+            pad = length - n
+            if pad:
+                k = torch.cat([k.new_zeros(k.shape[:2] + (pad,) + k.shape[3:]), k], dim=2)
+                v = torch.cat([v.new_zeros(v.shape[:2] + (pad,) + v.shape[3:]), v], dim=2)
+            keys.append(k)
+            values.append(v)
+        return torch.cat(keys), torch.cat(values)
+
+    # 取出 batch 中第 row 个序列的 (key, value)，去掉缓存段和后缀段各自的左填充
+    @staticmethod
+    def _unpad(k, v, row, past_length, reused, suffix):
+        total = k.shape[2]
+        # 后缀没有填充时两段相连
+        if total - suffix == past_length:
+            return k[row:row + 1, :, past_length - reused:], v[row:row + 1, :, past_length - reused:]
+        parts = [(past_length - reused, past_length), (total - suffix, total)]
+        return (torch.cat([k[row:row + 1, :, a:b] for a, b in parts], dim=2),
+                torch.cat([v[row:row + 1, :, a:b] for a, b in parts], dim=2))
+
+    # batch 中的序列一起解码一个 token：新 token 的 key/value 追加到 self.batch 末尾，各行左侧的填充在 attention_mask 中置 0
+    def _decode(self, requests):
+        width = self.batch.width
+        lengths = torch.tensor([r.length for r in requests], dtype=torch.long)
+        input_ids = torch.tensor([[r.next_token] for r in requests], dtype=torch.long)
+        attention_mask = (torch.arange(width + 1) >= (width - lengths)[:, None]).long()
+        position_ids = lengths[:, None]
+        outputs = self.model(input_ids=input_ids.to(self.device), attention_mask=attention_mask.to(self.device),
+                             position_ids=position_ids.to(self.device), past_key_values=self.batch, use_cache=True)
+        tokens = outputs.logits[:, -1, :].argmax(-1).tolist()
+        now = time.perf_counter()
+        for row, request in enumerate(requests):
+            request.length += 1
+            self._emit(request, tokens[row], now)
+        self.stats["decode_tokens"] += len(requests)
+
+    @staticmethod
+    def _legacy(past_key_values):
+        return past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
@@ -0,0 +1,151 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def _normalize_value(value):
+    if isinstance(value, bool):
+        return value
+    # 300、300.0 视为同一个数
+    if isinstance(value, (int, float)):
+        value = float(value)
+        return int(value) if value.is_integer() else value
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return [_normalize_value(v) for v in value]
+    return value
+
+
+# 查询条件的规范形式：去掉值为 None 的字段，数字统一表示，设施去重排序；作为缓存键的一部分
+def canonical_dsl(dsl):
+    canonical = {}
+    for k, v in dsl.items():
+        if v is None:
+            continue
+        v = _normalize_value(v)
+        if k == "facilities":
+            v = sorted(set(v))
+        canonical[k] = v
+    return json.dumps(canonical, sort_keys=True, ensure_ascii=False)
+
+
+# HotelDB.search 的结果缓存：内存中为 LRU + TTL，可选的 SQLite 磁盘层供多个 Gradio worker 进程共享
+# 磁盘层保存一个版本号，insert() 重建集合时调用 invalidate() 使版本号加一，各进程的内存层在下次访问时发现并清空
+class SearchCache:
+    def __init__(self, max_entries=1024, ttl=600, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "hit_seconds": 0.0, "miss_seconds": 0.0}
+        self.conn = None
+        self.generation = 0
+        if disk_path is not None:
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires REAL NOT NULL, generation INTEGER NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0)")
+            self.conn.commit()
+            self.generation = self._disk_generation()
+
+    def _disk_generation(self):
+        return self.conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+
+    # 其他进程已使缓存失效时清空内存层
+    def _sync_generation(self):
+        if self.conn is not None:
+            generation = self._disk_generation()
+            if generation != self.generation:
+                self.generation = generation
+                self.entries.clear()
+
+    def _get(self, key, now):
+        self._sync_generation()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            del self.entries[key]
+        if self.conn is not None:
+            row = self.conn.execute(
+                "SELECT value, expires FROM results WHERE key = ? AND generation = ?", (key, self.generation)).fetchone()
+            if row is not None and row[1] > now:
+                self._put_memory(key, row[0], row[1])
+                self.stats["disk_hits"] += 1
+                return row[0]
+        return None
+
+    def _put_memory(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _put(self, key, value, now):
+        expires = now + self.ttl
+        self._put_memory(key, value, expires)
+        if self.conn is not None:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, expires, generation) VALUES (?, ?, ?, ?)",
+                (key, value, expires, self.generation))
+            self.conn.execute("DELETE FROM results WHERE expires <= ?", (now,))
+            self.conn.commit()
+
+    # 命中时返回缓存结果，否则调用 compute() 查询并写入缓存
+    # 结果以 JSON 字符串保存，每次返回新的对象，调用方修改结果不会影响缓存
+    def get_or_compute(self, key, compute):
+        start = time.perf_counter()
+        with self.lock:
+            value = self._get(key, time.time())
+        if value is not None:
+            result = json.loads(value)
+            with self.lock:
+                self.stats["hit_seconds"] += time.perf_counter() - start
+            return result
+        result = compute()
+        value = json.dumps(result, ensure_ascii=False)
+        with self.lock:
+            self._put(key, value, time.time())
+            self.stats["misses"] += 1
+            self.stats["miss_seconds"] += time.perf_counter() - start
+        return json.loads(value)
+
+    # 清空缓存；有磁盘层时同时使其他进程的内存层失效
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            if self.conn is not None:
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+                self.conn.execute("DELETE FROM results")
+                self.conn.commit()
+                self.generation = self._disk_generation()
+
+    # 命中率和平均耗时（毫秒）
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+        hits = stats["hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        return {
+            "hits": stats["hits"],
+            "disk_hits": stats["disk_hits"],
+            "misses": stats["misses"],
+            "evictions": stats["evictions"],
+            "hit_rate": hits / total if total else 0.0,
+            "avg_hit_ms": stats["hit_seconds"] / hits * 1000 if hits else 0.0,
+            "avg_miss_ms": stats["miss_seconds"] / stats["misses"] * 1000 if stats["misses"] else 0.0,
+        }
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,92 @@
+STOP_STRINGS = ("<|im_end|>", "<|endoftext|>")
+IM_START = "<|im_start|>"
+MAX_ROLE_LENGTH = 32
+
+
+# 增量解码：逐批接收生成的 token，只返回已经确定的新文本
+#   每次只解码上一次输出位置之后的几个 token（与前一段一起解码以保证分词边界正确），而不是整段重新解码
+#   末尾是不完整的 UTF-8 字符（解码为 �）时先不输出，等后续 token 补全
+#   任一停止串出现时截断并标记 stopped；文本末尾可能是停止串开头的部分先扣留，确认不是停止串后再输出
+class IncrementalDecoder:
+    def __init__(self, tokenizer, stop=STOP_STRINGS):
+        self.tokenizer = tokenizer
+        self.stop = [s for s in stop if s]
+        self.ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ""
+        self.emitted = 0
+        self.stopped = False
+
+    def _decode_new(self):
+        prefix = self.tokenizer.decode(self.ids[self.prefix_offset:self.read_offset], skip_special_tokens=False)
+        full = self.tokenizer.decode(self.ids[self.prefix_offset:], skip_special_tokens=False)
+        if full.endswith("�") or len(full) <= len(prefix):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        return full[len(prefix):]
+
+    # 末尾可能是某个停止串开头的最长长度
+    def _held_back(self):
+        held = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(self.text)), held, -1):
+                if self.text.endswith(s[:n]):
+                    held = n
+                    break
+        return held
+
+    # 加入新生成的 token，返回可以输出的新文本
+    def push(self, token_ids):
+        if self.stopped:
+            return ""
+        self.ids.extend(token_ids)
+        new_text = self._decode_new()
+        if not new_text:
+            return ""
+        # 停止串可能跨越上一段文本的末尾
+        start = max(0, len(self.text) - max((len(s) for s in self.stop), default=0))
+        self.text += new_text
+        cut = min((i for i in (self.text.find(s, start) for s in self.stop) if i != -1), default=-1)
+        if cut != -1:
+            self.text = self.text[:cut]
+            self.stopped = True
+            end = len(self.text)
+        else:
+            end = len(self.text) - self._held_back()
+        chunk = self.text[self.emitted:end]
+        self.emitted = max(self.emitted, end)
+        return chunk
+
+    # 生成结束：输出扣留的文本
+    def finish(self):
+        chunk = self.text[self.emitted:]
+        self.emitted = len(self.text)
+        return chunk
+
+
+# 从流式文本中分出回复的角色：回复以 "<|im_start|>角色\n" 开头，角色确定之前不返回任何内容
+# 依次返回 (角色, 到目前为止的回复内容)；开头 MAX_ROLE_LENGTH 个字符内没有换行（没有角色行）的回复视为 assistant
+def stream_roles(chunks):
+    text = ""
+    role = None
+    for chunk in chunks:
+        text += chunk
+        if role is None:
+            body = text[len(IM_START):] if text.startswith(IM_START) else text
+            if IM_START.startswith(body):
+                continue
+            if "\n" in body:
+                newline = text.index("\n", len(text) - len(body))
+                role = text[len(text) - len(body):newline].strip()
+                offset = newline + 1
+            elif len(body) < MAX_ROLE_LENGTH:
+                continue
+            else:
+                role = "assistant"
+                offset = len(text) - len(body)
+        yield role, text[offset:].replace(IM_START, "")
+    if role is None:
+        body = text[len(IM_START):] if text.startswith(IM_START) else text
+        yield "assistant", body.replace("assistant", "", 1)
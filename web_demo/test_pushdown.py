@@ -0,0 +1,216 @@
+# 排序与 name 过滤下推的离线测试：不连接云端，用基于 hotel.json 的本地替身客户端执行 Weaviate 查询
+# 运行：python test_pushdown.py（也可以用 pytest 收集其中的 test_ 函数）
+import json
+import random
+from types import SimpleNamespace
+from weaviate.classes.query import Filter
+from db_client import HotelDB, OUTPUT_FIELDS
+from local_db import LocalHotelDB, BM25Index, tokenize, name_filter_tokens
+from search_cache import SearchCache
+
+with open("hotel.json", "r", encoding="utf-8") as f:
+    HOTELS = json.load(f)
+
+
+# 在本地酒店列表上求值 Weaviate 的过滤条件（只支持 HotelDB 用到的算子）
+def matches(hotel, filters):
+    if filters is None:
+        return True
+    if hasattr(filters, "filters"):
+        results = [matches(hotel, f) for f in filters.filters]
+        return all(results) if type(filters).__name__ == "_FilterAnd" else any(results)
+    value = hotel.get(filters.target)
+    operator = filters.operator.value
+    if operator == "Equal":
+        return value == filters.value
+    if operator == "GreaterThan":
+        return value is not None and value > filters.value
+    if operator == "LessThan":
+        return value is not None and value < filters.value
+    # 文本属性按空白分词（_name/_address），其他属性作为单个值
+    values = set(value.split()) if isinstance(value, str) else {value}
+    if operator == "ContainsAny":
+        return bool(values & set(filters.value))
+    if operator == "ContainsAll":
+        return set(filters.value) <= values
+    raise NotImplementedError(operator)
+
+
+# Weaviate 客户端的本地替身：fetch_objects 支持过滤、排序、分页，bm25 按得分排序；记录返回的对象数
+class FakeWeaviateClient:
+    def __init__(self, hotels=HOTELS):
+        self.hotels = hotels
+        self.indexes = {prop: BM25Index([h.get(prop, "").split() for h in hotels]) for prop in ["_name", "_address"]}
+        self.fetched = 0
+
+    def is_ready(self):
+        return True
+
+    def close(self):
+        pass
+
+    def _page(self, ids, limit, offset, return_properties):
+        ids = ids[offset or 0:(offset or 0) + limit]
+        self.fetched += len(ids)
+        return SimpleNamespace(objects=[
+            SimpleNamespace(properties={k: self.hotels[i][k] for k in return_properties}) for i in ids])
+
+    def fetch_objects(self, limit, offset=None, filters=None, sort=None, return_properties=None):
+        ids = [i for i, h in enumerate(self.hotels) if matches(h, filters)]
+        if sort is not None:
+            for s in reversed(sort.sorts):
+                ids = sorted(ids, key=lambda i: self.hotels[i][s.prop], reverse=not s.ascending)
+        return self._page(ids, limit, offset, return_properties)
+
+    def bm25(self, query, query_properties, limit, offset=None, filters=None, return_properties=None):
+        scores = self.indexes[query_properties[0]].scores(query.split())
+        ids = [i for i in range(len(self.hotels)) if scores[i] > 0 and matches(self.hotels[i], filters)]
+        ids = sorted(ids, key=lambda i: -scores[i])
+        return self._page(ids, limit, offset, return_properties)
+
+    @property
+    def collections(self):
+        return SimpleNamespace(get=lambda name: SimpleNamespace(query=self))
+
+
+# 下推之前的做法：只取 limit + 10 个候选，再在 Python 中排序并做 name 子串过滤
+def legacy_search(client, dsl, limit):
+    dsl = {k: v for k, v in dsl.items() if v is not None}
+    filters = None
+    if "rating_range_lower" in dsl:
+        filters = Filter.by_property("rating").greater_than(dsl["rating_range_lower"])
+    if "type" in dsl:
+        f = Filter.by_property("type").equal(dsl["type"])
+        filters = f if filters is None else filters & f
+    candidates = [obj.properties for obj in client.fetch_objects(limit + 10, filters=filters,
+                                                                 return_properties=OUTPUT_FIELDS).objects]
+    if "sort.slot" in dsl:
+        candidates = sorted(candidates, key=lambda x: x.get(dsl["sort.slot"], 0),
+                            reverse=dsl.get("sort.ordering") == "descend")
+    if "name" in dsl:
+        candidates = [r for r in candidates if dsl["name"] in r.get("name", "")]
+    return candidates[:limit]
+
+
+# 正确答案：在全部酒店上过滤、排序后取前 limit 个
+def expected(dsl, limit):
+    hotels = [h for h in HOTELS
+              if ("type" not in dsl or h["type"] == dsl["type"])
+              and ("rating_range_lower" not in dsl or h["rating"] > dsl["rating_range_lower"])
+              and ("name" not in dsl or dsl["name"] in h["name"])]
+    if "sort.slot" in dsl:
+        hotels = sorted(hotels, key=lambda h: h[dsl["sort.slot"]], reverse=dsl.get("sort.ordering") == "descend")
+    return [h["hotel_id"] for h in hotels[:limit]]
+
+
+def random_dsls(n, seed=0):
+    rng = random.Random(seed)
+    names = ["北京", "如家", "7天", "酒店", "速8", "汉庭", "大酒店", "宾馆"]
+    dsls = []
+    for _ in range(n):
+        dsl = {"sort.slot": rng.choice(["price", "rating"]), "sort.ordering": rng.choice(["ascend", "descend"])}
+        if rng.random() < 0.5:
+            dsl["type"] = rng.choice(["经济型", "舒适型", "高档型", "豪华型"])
+        if rng.random() < 0.5:
+            dsl["rating_range_lower"] = rng.choice([4.0, 4.5])
+        if rng.random() < 0.5:
+            dsl["name"] = rng.choice(names)
+        dsls.append(dsl)
+    return dsls
+
+
+def ids(results):
+    return [r["hotel_id"] for r in results]
+
+
+def test_legacy_search_is_wrong():
+    client = FakeWeaviateClient()
+    dsl = {"rating_range_lower": 4.5, "sort.slot": "price", "sort.ordering": "ascend"}
+    assert ids(legacy_search(client, dsl, 3)) != expected(dsl, 3)
+    wrong = sum(ids(legacy_search(client, dsl, 3)) != expected(dsl, 3) for dsl in random_dsls(200))
+    assert wrong > 100, wrong
+
+
+def test_remote_pushdown_is_exact():
+    client = FakeWeaviateClient()
+    db = HotelDB(connect=lambda: client, cache=SearchCache(max_entries=0))
+    for limit in [1, 3]:
+        fetched = []
+        for dsl in random_dsls(200):
+            client.fetched = 0
+            assert ids(db.search(dsl, limit=limit)) == expected(dsl, limit), dsl
+            # name 开头或结尾的字母数字（"7天" 的 7、"速8" 的 8）不能下推，这类查询需要多读几页，不计入平均值
+            if "name" not in dsl or name_filter_tokens(dsl["name"]) == tokenize(dsl["name"]):
+                fetched.append(client.fetched)
+        # 平均读取的对象数应接近 limit，远小于原来每次读取的 limit + 10 个
+        assert sum(fetched) / len(fetched) < limit + 1, (limit, sum(fetched) / len(fetched))
+    db.close()
+
+
+def test_local_pushdown_is_exact():
+    db = LocalHotelDB(hotels=HOTELS)
+    for dsl in random_dsls(200):
+        for limit in [1, 3]:
+            assert ids(db.search(dsl, limit=limit)) == expected(dsl, limit), dsl
+
+
+# 查询的开头或结尾是名称中某个字母数字词的一部分时（JW 中的 W、HOME 中的 OME、CitiGO 中的 itiGO），
+# 这部分不能作为分词下推，否则会漏掉匹配的酒店
+def test_partial_word_names():
+    client = FakeWeaviateClient()
+    db = HotelDB(connect=lambda: client, cache=SearchCache(max_entries=0))
+    local = LocalHotelDB(hotels=HOTELS)
+    for name in ["W万豪酒店", "OME连锁酒店(北京王府井店)", "itiGO", "北京JW万豪"]:
+        matched = [h["hotel_id"] for h in HOTELS if name in h["name"]]
+        assert matched, name
+        for search in [db.search, local.search]:
+            # 排序时是精确的前 k 个；不排序时按相关性排序，只比较命中的集合
+            dsl = {"name": name, "sort.slot": "price", "sort.ordering": "ascend"}
+            assert ids(search(dsl, limit=3)) == expected(dsl, 3), dsl
+            assert sorted(ids(search({"name": name}, limit=len(matched)))) == sorted(matched), name
+    db.close()
+
+
+# address 与排序字段同时出现时，包含任一地址分词的酒店（BM25 能匹配到的全部酒店）都是候选，按排序字段取精确的前 k 个
+# 原来只在 BM25 得分最高的 limit + 10 个候选内排序，得到的不是真正的前 k 个
+def test_sorted_address():
+    client = FakeWeaviateClient()
+    db = HotelDB(connect=lambda: client, cache=SearchCache(max_entries=0))
+    local = LocalHotelDB(hotels=HOTELS)
+    rng = random.Random(0)
+    for address in ["朝阳区", "海淀区中关村", "王府井", "西城区广安门内大街", "建国路"]:
+        for _ in range(10):
+            dsl = {"address": address, "sort.slot": rng.choice(["price", "rating"]),
+                   "sort.ordering": rng.choice(["ascend", "descend"])}
+            if rng.random() < 0.5:
+                dsl["type"] = rng.choice(["经济型", "舒适型", "高档型", "豪华型"])
+            tokens = set(tokenize(address))
+            hotels = [h for h in HOTELS if tokens & set(h["_address"].split())
+                      and ("type" not in dsl or h["type"] == dsl["type"])]
+            hotels = sorted(hotels, key=lambda h: h[dsl["sort.slot"]], reverse=dsl["sort.ordering"] == "descend")
+            for limit in [1, 3]:
+                client.fetched = 0
+                assert ids(db.search(dsl, limit=limit)) == [h["hotel_id"] for h in hotels[:limit]], dsl
+                assert client.fetched <= limit, dsl
+                assert ids(local.search(dsl, limit=limit)) == [h["hotel_id"] for h in hotels[:limit]], dsl
+    db.close()
+
+
+# search_many 按输入顺序返回与逐个 search 相同的结果（含重复的查询和没有排序字段的查询）
+def test_search_many_matches_search():
+    dsls = random_dsls(100) + [{"type": "经济型"}, {"name": "如家"}, {"facilities": ["wifi"], "type": "舒适型"},
+                               {"address": "朝阳区", "sort.slot": "price", "sort.ordering": "descend"}]
+    dsls = dsls + dsls[::3]
+    client = FakeWeaviateClient()
+    db = HotelDB(connect=lambda: client, cache=SearchCache(max_entries=0))
+    assert db.search_many(dsls, limit=3) == [db.search(dsl, limit=3) for dsl in dsls]
+    db.close()
+    db = LocalHotelDB(hotels=HOTELS)
+    assert db.search_many(dsls, limit=3) == [db.search(dsl, limit=3) for dsl in dsls]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,135 @@
+import os
+import json
+import zlib
+import hashlib
+import numpy as np
+
+
+# 确定性的哈希向量化：字符 n-gram 经 crc32 映射到 dim 维并带符号累加，最后做 L2 归一化
+# 不依赖模型和网络，同样的文本在任何进程中得到同样的向量，用于测试和离线演示
+class HashingEmbedder:
+    def __init__(self, dim=256, ngram_range=(1, 2)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.name = f"hashing-{dim}-{ngram_range[0]}-{ngram_range[1]}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+                for i in range(len(text) - n + 1):
+                    h = zlib.crc32(text[i:i + n].encode("utf-8"))
+                    vectors[row, h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+# sentence-transformers 模型，默认与远程 Weaviate 集合使用同一个多语言模型；依赖在使用时才导入
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2", device=None):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise ImportError("SentenceTransformerEmbedder requires `pip install sentence-transformers`")
+        self.model = SentenceTransformer(model_name, device=device)
+        self.name = model_name.replace("/", "--")
+
+    def embed(self, texts):
+        return self.model.encode(list(texts), normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+# 在 scores 中取 mask 为 True 的前 k 个，按得分从高到低返回 (下标, 得分)
+def _top_k(scores, k, mask=None):
+    candidates = np.arange(len(scores)) if mask is None else np.flatnonzero(mask)
+    if len(candidates) > k:
+        candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order], scores[candidates[order]]
+
+
+# 暴力检索的向量索引：所有向量存放在一个 (n, dim) 矩阵中（float32 或 float16），保存为 .npy 后以 memmap 方式加载
+# 查询时一次矩阵乘法算出全部余弦相似度（向量已归一化），结构化过滤条件以布尔掩码的形式在取 top-k 之前生效
+class VectorIndex:
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, embedder, texts, path=None, dtype=np.float32, batch_size=256):
+        dim = embedder.embed(texts[:1]).shape[1] if texts else 0
+        if path is None:
+            vectors = np.zeros((len(texts), dim), dtype=dtype)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp_path = f"{path}.tmp-{os.getpid()}.npy"
+            vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(len(texts), dim))
+        for start in range(0, len(texts), batch_size):
+            vectors[start:start + batch_size] = embedder.embed(texts[start:start + batch_size])
+        if path is None:
+            return cls(vectors)
+        vectors.flush()
+        del vectors
+        os.replace(tmp_path, path)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, query, k, mask=None):
+        scores = np.asarray(self.vectors @ query.astype(self.vectors.dtype), dtype=np.float32)
+        return _top_k(scores, k, mask)
+
+
+# 倒排文件（IVF）索引，用于更大的酒店库：k-means 把向量划分到 nlist 个簇，查询时只计算最近的 nprobe 个簇内的向量
+# 过滤掩码同样在簇内取 top-k 之前生效；nprobe 等于 nlist 时与暴力检索结果相同
+class IVFIndex:
+    def __init__(self, vectors, nlist=32, nprobe=4, iterations=10, seed=42):
+        self.vectors = vectors
+        self.nprobe = nprobe
+        data = np.asarray(vectors, dtype=np.float32)
+        nlist = max(1, min(nlist, len(data)))
+        rng = np.random.default_rng(seed)
+        centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = data[assign == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        self.centroids = centroids
+        assign = np.argmax(data @ centroids.T, axis=1)
+        self.lists = [np.flatnonzero(assign == c) for c in range(nlist)]
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, query, k, mask=None):
+        query = query.astype(np.float32)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        candidates = np.sort(np.concatenate([self.lists[c] for c in probes]))
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+        scores = np.asarray(self.vectors[candidates] @ query.astype(self.vectors.dtype), dtype=np.float32)
+        order, top_scores = _top_k(scores, k)
+        return candidates[order], top_scores
+
+
+# 向量矩阵的缓存文件：文件名包含向量化模型名称、精度和全部文本的哈希，文本或模型变化时自动重建
+def vector_cache_path(cache_dir, embedder, texts, dtype):
+    h = hashlib.sha256(json.dumps(texts, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{embedder.name}-{np.dtype(dtype).name}-{h}.npy")
+
+
+# 加载或构建文本的向量索引；cache_dir 为 None 时只在内存中构建
+def load_vector_index(embedder, texts, cache_dir=None, dtype=np.float32):
+    if cache_dir is None:
+        return VectorIndex.build(embedder, texts, dtype=dtype)
+    path = vector_cache_path(cache_dir, embedder, texts, dtype)
+    if os.path.exists(path):
+        return VectorIndex.load(path)
+    return VectorIndex.build(embedder, texts, path=path, dtype=dtype)
@@ -3,11 +3,17 @@ warnings.filterwarnings('ignore')
 import sys
 sys.path.append('../qwen2')
 import json
+import time
 import torch
 import argparse
 import gradio as gr
 import pandas as pd
 from db_client import HotelDB
+from local_db import LocalHotelDB
+from search_cache import SearchCache
+from streaming import IM_START, stream_roles
+from scheduler import InferenceScheduler
+from kv_cache import PrefixKVCache
 from evaluate import load_model, origin_load_model
 from data_preprocess import build_prompt, parse_json
 
@@ -15,21 +21,31 @@ from data_preprocess import build_prompt, parse_json
 parser = argparse.ArgumentParser()
 parser.add_argument("--model", type=str, default=None, required=True, help="main model weights")
 parser.add_argument("--ckpt", type=str, default=None, required=True, help="The checkpoint path")
+parser.add_argument("--db", type=str, default="weaviate", choices=["weaviate", "local"], help="hotel search backend; local searches hotel.json in process")
+parser.add_argument("--search_cache", type=str, default=None, help="SQLite file shared by workers to cache search results")
+parser.add_argument("--hybrid_search", action="store_true", help="fuse facilities/name/address retrievals with RRF instead of using only one of them")
+parser.add_argument("--max_batch_size", type=int, default=8, help="most sequences decoded together by the inference scheduler")
+parser.add_argument("--kv_cache_mb", type=int, default=1024, help="memory budget in MB for reusing each session's KV cache across turns; 0 disables")
+parser.add_argument("--stream_log", type=str, default=None, help="JSONL file to append per-turn time-to-first-token and tokens/s")
 args = parser.parse_args()
 
-db = HotelDB()
+db = LocalHotelDB("hotel.json") if args.db == "local" else HotelDB(
+    cache=SearchCache(disk_path=args.search_cache), hybrid=args.hybrid_search)
 # 加载微调模型
 tokenizer, model = load_model(args.model, args.ckpt)
 # 加载原始模型
 # tokenizer, model = origin_load_model(args.model)
 
 
+# 所有会话的生成请求都提交给同一个调度器，在共享的 batch 中解码
+# 每个会话上一轮的 KV cache 保存在 prefix_cache 中，下一轮只需 prefill 新增的对话内容
+prefix_cache = PrefixKVCache(max_bytes=args.kv_cache_mb << 20) if args.kv_cache_mb > 0 else None
+scheduler = InferenceScheduler(model, tokenizer, max_batch_size=args.max_batch_size, prefix_cache=prefix_cache)
+
+
 def get_completion(prompt):
-    inputs = tokenizer([prompt], return_tensors="pt").to("cuda")
-    with torch.no_grad():
-        outputs = model.generate(**inputs, max_new_tokens=1024)
-        response = tokenizer.decode(outputs[:,inputs['input_ids'].shape[1]:][0], skip_special_tokens=True)
-    return response
+    response = "".join(scheduler.submit(prompt, max_new_tokens=1024))
+    return response.replace(IM_START, "")
 
 
 def remove_search_history(context):
@@ -70,7 +86,47 @@ def lora_chat(user_input, chatbot, context, search_field, return_field):
 # =========================================================================
 
 
-def chat(user_input, chatbot, context, search_field, return_field):
+# 流式生成一条回复，依次返回 (角色, 到目前为止的回复内容)；生成结束后把本次的耗时统计加入 stats
+# 页面关闭或请求被中断（生成器被关闭）时取消生成，调度器随即把该序列移出 batch
+# session 为 Gradio 会话标识，同一会话的请求复用之前缓存的 KV cache
+def stream_completion(prompt, stats, session=None):
+    generation = scheduler.submit(prompt, max_new_tokens=1024, session=session)
+    try:
+        yield from stream_roles(generation)
+    finally:
+        generation.cancel()
+        stats.append(generation.stats())
+
+
+# 记录一轮对话的首 token 延迟和生成速度：打印到控制台，设置了 --stream_log 时追加到文件
+def log_turn(stats, turn_start, first_reply_time, search_seconds):
+    tokens = sum(s["tokens"] for s in stats)
+    decode_seconds = sum(s["decode_seconds"] for s in stats)
+    record = {
+        "ttft": stats[0]["ttft"] if stats else None,
+        "first_reply": None if first_reply_time is None else first_reply_time - turn_start,
+        "search": search_seconds,
+        "prefill_tokens": sum(s["prefill_tokens"] for s in stats),
+        "reused_tokens": sum(s["reused_tokens"] for s in stats),
+        "tokens": tokens,
+        "tokens_per_second": (tokens - len(stats)) / decode_seconds if decode_seconds > 0 else 0.0,
+        "total": time.perf_counter() - turn_start,
+    }
+    print("【本轮生成统计】", json.dumps(record, ensure_ascii=False))
+    if args.stream_log:
+        with open(args.stream_log, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+# 流式对话：回复逐段显示在 chatbot 中
+# 回复开头的角色为 search 时不显示在 chatbot 中（查询条件逐段显示在 search 框里），
+# 生成结束后执行查询，再把查询结果发给模型流式生成最终回复
+def chat(user_input, chatbot, context, search_field, return_field, request: gr.Request = None):
+    session = request.session_hash if request is not None else None
+    turn_start = time.perf_counter()
+    stats = []
+    first_reply_time = None
+    search_seconds = None
     context.append({'role':'user','content':user_input})
     # 构建 prompt 并打印
     prompt = build_prompt(context)
@@ -78,21 +134,28 @@ def chat(user_input, chatbot, context, search_field, return_field):
     print("【发送给模型的 Prompt】")
     print(prompt)
     print("=" * 50 + "\n")
-    response = get_completion(prompt)
-    #print(response)
-    # 判断以search命令开头时去执行搜索
-    if "search" in response:
-        # 取出最新一条 'search' 后面的json查询条件
+    chatbot.append((user_input, ""))
+    role, response = None, ""
+    for role, response in stream_completion(prompt, stats, session):
+        if role == "search":
+            search_field = response
+        else:
+            first_reply_time = first_reply_time or time.perf_counter()
+            chatbot[-1] = (user_input, response)
+        yield "", chatbot, context, search_field, return_field
+    # 回复以search命令开头时去执行搜索
+    if role == "search":
+        # 取出 'search' 后面的json查询条件
         search_query = parse_json(response)
-        if search_query is not None:
+        if search_query is None:
+            response = "search\n" + response
+        else:
+            search_start = time.perf_counter()
             search_field = json.dumps(search_query,indent=4,ensure_ascii=False)
             remove_search_history(context)
             context.append({'role':'search','arguments':search_query})
-            # 调用酒店查询接口
-            try:
-                return_field = db.search(search_query, limit=3)
-            finally:
-                db.client.close()
+            # 调用酒店查询接口，连接由 db 的连接池管理，在请求之间复用
+            return_field = db.search(search_query, limit=3)
 
             context.append({'role':'return','records':return_field})
             keys = []
@@ -101,16 +164,25 @@ def chat(user_input, chatbot, context, search_field, return_field):
             data = {key: [item[key] for item in return_field] for key in keys}
             data = data or {"hotel": []}
             return_field = pd.DataFrame(data)
+            search_seconds = time.perf_counter() - search_start
+            yield "", chatbot, context, search_field, return_field
             # 将查询结果发给LLM，再次那么让LLM生成回复
-            response = get_completion(build_prompt(context))
+            for _, response in stream_completion(build_prompt(context), stats, session):
+                first_reply_time = first_reply_time or time.perf_counter()
+                chatbot[-1] = (user_input, response)
+                yield "", chatbot, context, search_field, return_field
 
-    reply = response.replace("assistant", "")
-    chatbot.append((user_input, reply))
+    reply = response
+    chatbot[-1] = (user_input, reply)
     context.append({'role':'assistant','content':reply})
-    return "", chatbot, context, search_field, return_field
+    log_turn(stats, turn_start, first_reply_time, search_seconds)
+    yield "", chatbot, context, search_field, return_field
 
 
-def reset_state():
+# 清空对话时释放该会话缓存的 KV cache
+def reset_state(request: gr.Request = None):
+    if prefix_cache is not None and request is not None:
+        prefix_cache.drop_session(request.session_hash)
     return [], [], "", "", None
 
 
@@ -140,7 +212,8 @@ def main():
         submitBtn.click(chat, [user_input, chatbot, context, search_field, return_field],[user_input, chatbot, context, search_field, return_field])
         emptyBtn.click(reset_state, outputs=[chatbot, context, user_input, search_field, return_field])
 
-    demo.queue().launch(share=False, server_name='0.0.0.0', server_port=6006, inbrowser=True)
+    # Gradio 3.x 默认一次只处理一个排队的事件，调度器就看不到并发的会话；让同时处理的事件数与解码 batch 的大小一致
+    demo.queue(concurrency_count=args.max_batch_size).launch(share=False, server_name='0.0.0.0', server_port=6006, inbrowser=True)
 
 if __name__ == "__main__":
     main()